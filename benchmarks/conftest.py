@@ -0,0 +1,108 @@
+import gzip
+import random
+
+from dataclasses import dataclass
+from pathlib import Path
+
+import pytest
+
+from hostile import prefilter
+
+
+data_dir = Path(__file__).parent.parent / "tests/data"
+BASES = "ACGT"
+REVCOMP = str.maketrans("ACGT", "TGCA")
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("hostile benchmarks")
+    group.addoption("--reads", type=int, default=100_000, help="reads per mix")
+    group.addoption("--read-length", type=int, default=150)
+    group.addoption("--host-proportion", type=float, default=0.5)
+    group.addoption(
+        "--host-reference",
+        type=Path,
+        default=data_dir / "sars-cov-2/sars-cov-2.fasta.gz",
+        help="fasta[.gz] from which host reads are simulated",
+    )
+    group.addoption(
+        "--bowtie2-index",
+        type=Path,
+        default=data_dir / "sars-cov-2/sars-cov-2",
+        help="Bowtie2 index built from the host reference",
+    )
+    group.addoption(
+        "--minimap2-index",
+        type=Path,
+        default=data_dir / "sars-cov-2/sars-cov-2.fasta.gz",
+        help="Minimap2 reference or index built from the host reference",
+    )
+
+
+@dataclass
+class Mix:
+    fastq1: Path
+    fastq2: Path
+    n_reads: int
+    read_length: int
+    host_reference: Path
+
+    @property
+    def n_bases(self) -> int:
+        return self.n_reads * self.read_length
+
+
+def read_reference(path: Path) -> str:
+    with prefilter.open_fasta(path) as fh:
+        return "".join(
+            line.decode().strip() for line in fh if not line.startswith(b">")
+        ).upper()
+
+
+def simulate_pair(
+    genome: str, read_length: int, rng: random.Random, error_rate: float = 0.0
+):
+    """Sample a fragment of 2-3x read length and return its two mates"""
+    fragment_length = min(len(genome), rng.randint(2 * read_length, 3 * read_length))
+    start = rng.randrange(len(genome) - fragment_length + 1)
+    fragment = genome[start : start + fragment_length]
+    if rng.random() < 0.5:
+        fragment = fragment.translate(REVCOMP)[::-1]
+    mates = [fragment[:read_length], fragment[-read_length:].translate(REVCOMP)[::-1]]
+    if error_rate:
+        mates = [
+            "".join(
+                rng.choice(BASES) if rng.random() < error_rate else base
+                for base in mate
+            )
+            for mate in mates
+        ]
+    return mates
+
+
+@pytest.fixture(scope="session")
+def mix(request, tmp_path_factory) -> Mix:
+    """Paired fastq.gz of simulated host and microbial reads, shuffled together"""
+    n_reads = request.config.getoption("--reads")
+    read_length = request.config.getoption("--read-length")
+    host_proportion = request.config.getoption("--host-proportion")
+    host_reference = request.config.getoption("--host-reference")
+    rng = random.Random(42)
+    host = read_reference(host_reference)
+    microbe = "".join(rng.choices(BASES, k=max(100_000, 10 * read_length)))
+    out_dir = tmp_path_factory.mktemp("mix")
+    fastq1, fastq2 = out_dir / "mix_1.fastq.gz", out_dir / "mix_2.fastq.gz"
+    quality = "I" * read_length
+    with gzip.open(fastq1, "wt", compresslevel=1) as fh1, gzip.open(
+        fastq2, "wt", compresslevel=1
+    ) as fh2:
+        for i in range(n_reads):
+            is_host = rng.random() < host_proportion
+            genome = host if is_host else microbe
+            mate1, mate2 = simulate_pair(
+                genome, read_length, rng, error_rate=0.005 if is_host else 0.0
+            )
+            label = "host" if is_host else "microbe"
+            fh1.write(f"@{label}_{i}/1\n{mate1}\n+\n{quality}\n")
+            fh2.write(f"@{label}_{i}/2\n{mate2}\n+\n{quality}\n")
+    return Mix(fastq1, fastq2, n_reads, read_length, host_reference)
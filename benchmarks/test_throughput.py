@@ -0,0 +1,240 @@
+"""End-to-end and per-stage throughput benchmarks. Run with pytest benchmarks"""
+import io
+import resource
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from hostile import bam, compress, lib, prefilter, stream, util
+
+
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    """Peak RSS so far, which for children is the largest of any child process"""
+    rss = resource.getrusage(who).ru_maxrss
+    return round(rss / 2**20 if util.get_platform() == "darwin" else rss / 2**10, 1)
+
+
+def record_throughput(benchmark, n_reads: int, n_bases: int, who: int) -> None:
+    mean = benchmark.stats.stats.mean
+    benchmark.extra_info["reads"] = n_reads
+    benchmark.extra_info["reads_per_s"] = round(n_reads / mean)
+    benchmark.extra_info["mbp_per_s"] = round(n_bases / mean / 1e6, 2)
+    benchmark.extra_info["peak_rss_mb"] = peak_rss_mb(who)
+
+
+def import_times_ms(module: str) -> dict[str, float]:
+    """Cumulative import time of each module loaded by importing module"""
+    run = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in run.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def requires(binary: str):
+    return pytest.mark.skipif(not shutil.which(binary), reason=f"{binary} not found")
+
+
+ALIGNERS = [
+    pytest.param(lib.ALIGNER.bowtie2, marks=requires("bowtie2"), id="bowtie2"),
+    pytest.param(lib.ALIGNER.minimap2, marks=requires("minimap2"), id="minimap2"),
+]
+
+
+def aligner_index(request, aligner):
+    option = "--bowtie2-index" if aligner == lib.ALIGNER.bowtie2 else "--minimap2-index"
+    return request.config.getoption(option)
+
+
+@pytest.mark.parametrize("aligner", ALIGNERS)
+def test_clean_fastqs(benchmark, request, tmp_path, mix, aligner):
+    index = aligner_index(request, aligner)
+    benchmark.pedantic(
+        lib.clean_fastqs,
+        kwargs=dict(
+            fastqs=[mix.fastq1],
+            index=index,
+            aligner=aligner,
+            out_dir=tmp_path,
+            force=True,
+        ),
+        rounds=3,
+    )
+    record_throughput(benchmark, mix.n_reads, mix.n_bases, resource.RUSAGE_CHILDREN)
+
+
+@pytest.mark.parametrize("aligner", ALIGNERS)
+def test_clean_paired_fastqs(benchmark, request, tmp_path, mix, aligner):
+    index = aligner_index(request, aligner)
+    benchmark.pedantic(
+        lib.clean_paired_fastqs,
+        kwargs=dict(
+            fastqs=[(mix.fastq1, mix.fastq2)],
+            index=index,
+            aligner=aligner,
+            out_dir=tmp_path,
+            force=True,
+        ),
+        rounds=3,
+    )
+    record_throughput(
+        benchmark, 2 * mix.n_reads, 2 * mix.n_bases, resource.RUSAGE_CHILDREN
+    )
+
+
+SCALING_THREADS = [
+    n for n in (1, 2, 4, 8, 16, 32, 64, 128) if n <= util.get_cpu_count()
+]
+
+
+@pytest.mark.parametrize("threads", [lib.THREADS] + SCALING_THREADS)
+@pytest.mark.parametrize("aligner", ALIGNERS)
+def test_clean_paired_scaling(benchmark, request, tmp_path, mix, aligner, threads):
+    """Scaling curve of paired throughput with alignment threads, against which
+    lib.plan_resources is tuned. threads=0 is the planned default"""
+    index = aligner_index(request, aligner)
+    benchmark.pedantic(
+        lib.clean_paired_fastqs,
+        kwargs=dict(
+            fastqs=[(mix.fastq1, mix.fastq2)],
+            index=index,
+            aligner=aligner,
+            out_dir=tmp_path,
+            threads=threads,
+            force=True,
+        ),
+        rounds=1,
+    )
+    benchmark.extra_info["threads"] = lib.plan_resources(
+        1, 1, threads, util.get_cpu_count(), 0, 0, True
+    ).aligner_threads
+    record_throughput(
+        benchmark, 2 * mix.n_reads, 2 * mix.n_bases, resource.RUSAGE_CHILDREN
+    )
+
+
+@pytest.fixture(scope="module")
+def sam(mix) -> bytes:
+    """Unaligned paired SAM records for the mix after a header, as emitted by an
+    aligner"""
+    records = [bam.SAM_HEADER]
+    for name, mates in stream.read_input([mix.fastq1, mix.fastq2]):
+        for flag, (seq, qual) in zip((77, 141), mates):
+            records.append(
+                b"%b\t%d\t*\t0\t0\t*\t*\t0\t0\t%b\t%b\n" % (name, flag, seq, qual)
+            )
+    return b"".join(records)
+
+
+def test_stage_number(benchmark, tmp_path, mix):
+    benchmark(stream.number, [mix.fastq1, mix.fastq2], io.BytesIO())
+    record_throughput(benchmark, 2 * mix.n_reads, 2 * mix.n_bases, resource.RUSAGE_SELF)
+
+
+@pytest.mark.parametrize("processes", [1, 4])
+def test_stage_screen(benchmark, tmp_path, mix, processes):
+    filter_path = tmp_path / "host.bloom"
+    with prefilter.open_fasta(mix.host_reference) as fh:
+        prefilter.build(fh, filter_path, size_bits=24)
+    bypass_path = tmp_path / "bypass.fastq"
+    benchmark(
+        stream.screen,
+        [mix.fastq1, mix.fastq2],
+        io.BytesIO(),
+        filter_path,
+        bypass_path,
+        processes=processes,
+    )
+    record_throughput(benchmark, 2 * mix.n_reads, 2 * mix.n_bases, resource.RUSAGE_SELF)
+
+
+@pytest.mark.parametrize("reorder_window", [0, stream.REORDER_WINDOW])
+def test_stage_filter(benchmark, tmp_path, mix, sam, reorder_window):
+    if reorder_window:  # Prefix names with ordinals as the number stage would
+        lines = sam.splitlines(keepends=True)
+        header = [line for line in lines if line.startswith(b"@")]
+        records = lines[len(header) :]
+        sam = b"".join(
+            header + [b"%d|%b" % (i // 2, line) for i, line in enumerate(records)]
+        )
+    count_paths = (str(tmp_path / "in.txt"), str(tmp_path / "out.txt"))
+
+    def run():
+        fastq_out = stream.FastqOutput(
+            [str(tmp_path / "out_1.fastq"), str(tmp_path / "out_2.fastq")],
+            paired=True,
+            compression="none",
+        )
+        stream.filter_sam(
+            io.BytesIO(sam),
+            paired=True,
+            count_paths=count_paths,
+            fastq_out=fastq_out,
+            reorder_window=reorder_window,
+        )
+
+    benchmark(run)
+    record_throughput(benchmark, 2 * mix.n_reads, 2 * mix.n_bases, resource.RUSAGE_SELF)
+
+
+@pytest.mark.parametrize("compression", ["gzip", "bgzf", "zstd"])
+@pytest.mark.parametrize("level", [1, 6, 9])
+@pytest.mark.parametrize("threads", [1, 4])
+def test_stage_compression(benchmark, tmp_path, mix, sam, compression, level, threads):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    records = [line.split(b"\t", 11) for line in sam.splitlines()]
+    fastq = b"".join(
+        stream.format_fastq(f[0], int(f[1]), f[9], f[10], paired=True) for f in records
+    )
+
+    path = tmp_path / f"out.fastq{compress.SUFFIXES[compression]}"
+
+    def run():
+        with compress.open_writer(path, compression, level, threads) as writer:
+            for i in range(0, len(fastq), 2**16):
+                writer.write(fastq[i : i + 2**16])
+
+    benchmark(run)
+    record_throughput(benchmark, 2 * mix.n_reads, 2 * mix.n_bases, resource.RUSAGE_SELF)
+    benchmark.extra_info["ratio"] = round(len(fastq) / path.stat().st_size, 2)
+
+
+@pytest.mark.parametrize("compression", ["gzip", "bgzf"])
+@pytest.mark.parametrize("threads", [1, 4, 16])
+def test_stage_decompression(benchmark, tmp_path, mix, sam, compression, threads):
+    """Input decompression, which bounds aligners reading fastq.gz on one thread"""
+    records = [line.split(b"\t", 11) for line in sam.splitlines()]
+    fastq = b"".join(
+        stream.format_fastq(f[0], int(f[1]), f[9], f[10], paired=True) for f in records
+    )
+    path = tmp_path / "reads.fastq.gz"
+    with compress.open_writer(path, compression, 6, 4) as writer:
+        writer.write(fastq)
+
+    def run():
+        with compress.open_reader(path, threads) as fh:
+            while fh.read(compress.BLOCK_SIZE):
+                pass
+
+    benchmark(run)
+    record_throughput(benchmark, 2 * mix.n_reads, 2 * mix.n_bases, resource.RUSAGE_SELF)
+
+
+def test_cli_startup(benchmark):
+    """Import time of the CLI, which every invocation pays before parsing arguments.
+    Modules only needed by fetch or clean must not load eagerly"""
+    times = benchmark.pedantic(import_times_ms, args=("hostile.cli",), rounds=5)
+    benchmark.extra_info["import_ms"] = round(times["hostile.cli"], 1)
+    benchmark.extra_info["defopt_ms"] = round(times["defopt"], 1)
+    assert not {"httpx", "tqdm", "http.server"} & set(times)
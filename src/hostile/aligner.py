@@ -1,12 +1,28 @@
+import json
 import logging
+import os
 import shutil
 import subprocess
+import sys
 import tempfile
 
 from dataclasses import dataclass
 from pathlib import Path
 
-from hostile import util
+from hostile import bam, compress, pin, prefilter, stream, util
+
+
+STREAM_CMD = f"{util.quote(sys.executable)} -m hostile.stream"
+CAPABILITIES_FILENAME = "capabilities.json"
+
+
+def timed(cmd: str, label: str, timings_path: Path | None) -> str:
+    """Wrap a pipeline stage to record its wall time, CPU time and peak RSS"""
+    if not timings_path:
+        return cmd
+    return (
+        f"{STREAM_CMD} time --label {label} --out {util.quote(timings_path)} -- {cmd}"
+    )
 
 
 @dataclass
@@ -18,10 +34,14 @@ class Aligner:
     data_dir: Path
     cmd: str
     paired_cmd: str
+    interleaved_cmd: str = ""
     idx_archive_fn: str = ""
     ref_archive_fn: str = ""
     idx_name: str = ""
     idx_paths: tuple[Path, ...] = tuple()
+    preset: str = ""
+    paired_preset: str = ""
+    flags: tuple[str, ...] = tuple()  # Long options hostile relies on
 
     def __post_init__(self):
         self.ref_archive_url = f"{self.cdn_base_url}/{self.ref_archive_fn}"
@@ -29,44 +49,382 @@ class Aligner:
         self.ref_archive_path = self.data_dir / self.ref_archive_fn
         self.idx_archive_path = self.data_dir / self.idx_archive_fn
         self.idx_path = self.data_dir / self.idx_name
-        Path(self.data_dir).mkdir(exist_ok=True, parents=True)
+        self.version = ""
+        self.capabilities_path = self.data_dir / CAPABILITIES_FILENAME
 
-    def check(self, using_custom_index: bool):
-        """Test aligner and check/download a ref/index if necessary"""
+    def check(self, using_custom_index: bool, paired: bool = False, preset: str = ""):
+        """Test aligner and check/download a ref/index if necessary, reusing results
+        cached in data_dir while the aligner binary and index files are unchanged.
+        preset overrides the Minimap2 preset otherwise chosen from paired"""
+        self.data_dir.mkdir(exist_ok=True, parents=True)  # Not at import, for startup
+        capabilities = self.load_capabilities()
+        if capabilities:
+            self.version = capabilities["version"]
+        else:
+            try:
+                capabilities = self.probe_capabilities()
+            except subprocess.CalledProcessError:
+                logging.warning(f"Failed to execute {self.bin_path}")
+                raise RuntimeError(f"Failed to execute {self.bin_path}")
         if not using_custom_index:
-            if self.name == "Bowtie2":
-                if not all(path.exists() for path in self.idx_paths):
-                    self.fetch_default_index()
-                else:
-                    logging.info(f"Found cached index ({self.idx_path})")
-            elif self.name == "Minimap2":
-                if not self.ref_archive_path.exists():
-                    self.fetch_default_index()
-                else:
-                    logging.info(f"Found cached genome ({self.ref_archive_path})")
+            preset = preset or (self.paired_preset if paired else self.preset)
+            if capabilities["index"].get(preset) != self.index_stamp():
+                self.check_default_index(paired, preset)
+                capabilities["index"][preset] = self.index_stamp()
+            if logging.getLogger().isEnabledFor(logging.DEBUG):  # mincore is slow
+                self.report_residency()
+        self.save_capabilities(capabilities)
+
+    def binary_stamp(self) -> dict | None:
+        """Resolved path, size and mtime of the aligner binary, if on PATH"""
+        path = shutil.which(self.bin_path)
+        if not path:
+            return None
+        path = Path(path).resolve()
+        stat = path.stat()
+        return {"path": str(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def index_stamp(self) -> dict[str, list[int]]:
+        """Sizes and mtimes of the default index files"""
+        return {
+            str(path): [path.stat().st_size, path.stat().st_mtime_ns]
+            for path in self.index_paths()
+        }
+
+    def load_capabilities(self) -> dict | None:
+        """Cached version, supported flags and index stamps, unless the binary changed"""
         try:
-            util.run(f"{self.bin_path} --version", cwd=self.data_dir)
-        except subprocess.CalledProcessError:
-            logging.warning(f"Failed to execute {self.bin_path}")
-            raise RuntimeError(f"Failed to execute {self.bin_path}")
+            cache = json.loads(self.capabilities_path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        entry = cache.get(self.name)
+        if entry and entry["binary"] == self.binary_stamp():
+            return entry
+        return None
+
+    def save_capabilities(self, capabilities: dict) -> None:
+        if not capabilities["binary"]:
+            return
+        try:
+            cache = json.loads(self.capabilities_path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            cache = {}
+        if cache.get(self.name) == capabilities:
+            return
+        cache[self.name] = capabilities
+        with tempfile.NamedTemporaryFile(  # Unique per thread, unlike a pid suffix
+            "w", dir=self.data_dir, suffix=".tmp", delete=False
+        ) as fh:
+            fh.write(json.dumps(cache, indent=4))
+        os.replace(fh.name, self.capabilities_path)
+
+    def probe_capabilities(self) -> dict:
+        """Run the aligner for its version and which of the flags it supports"""
+        self.get_version()
+        run = subprocess.run(
+            [str(self.bin_path), "--help"], capture_output=True, text=True
+        )
+        flags = [flag for flag in self.flags if flag in run.stdout + run.stderr]
+        if missing := set(self.flags) - set(flags):
+            logging.warning(
+                f"{self.name} {self.version} lacks {', '.join(sorted(missing))},"
+                " consider upgrading"
+            )
+        return {
+            "binary": self.binary_stamp(),
+            "version": self.version,
+            "flags": flags,
+            "index": {},
+        }
+
+    def check_default_index(self, paired: bool = False, preset: str = "") -> None:
+        """Download the default ref/index if missing, and build Minimap2's index"""
+        if self.name == "Bowtie2":
+            if not all(path.exists() for path in self.idx_paths):
+                self.fetch_default_index()
+            else:
+                logging.info(f"Found cached index ({self.idx_path})")
+        elif self.name == "Minimap2":
+            if not self.ref_archive_path.exists():
+                self.fetch_default_index()
+            else:
+                logging.info(f"Found cached genome ({self.ref_archive_path})")
+            self.build_mmi(preset or (self.paired_preset if paired else self.preset))
+
+    def get_version(self) -> str:
+        run = util.run(f"{util.quote(self.bin_path)} --version", cwd=self.data_dir)
+        self.version = run.stdout.strip().splitlines()[0]
+        return self.version
+
+    def mmi_path(self, preset: str) -> Path | None:
+        """Path of the prebuilt Minimap2 index for a preset and Minimap2 version"""
+        if not self.version or not self.ref_archive_fn:
+            return None
+        ref_stem = self.ref_archive_fn.removesuffix(".gz").removesuffix(".fa")
+        return self.data_dir / f"{ref_stem}.{preset}.{self.version}.mmi"
+
+    def build_mmi(self, preset: str) -> None:
+        """Build a Minimap2 index once so that later runs skip indexing the genome"""
+        mmi_path = self.mmi_path(preset)
+        if not mmi_path:
+            return
+        if mmi_path.exists():
+            logging.info(f"Found cached index ({mmi_path})")
+            return
+        logging.info(f"Building {preset} index ({mmi_path})")
+        tmp_path = mmi_path.with_suffix(".mmi.tmp")
+        util.run(
+            f"{util.quote(self.bin_path)} -x {preset} -d {util.quote(tmp_path)}"
+            f" {util.quote(self.ref_archive_path)}"
+        )
+        shutil.move(tmp_path, mmi_path)
+        logging.info(f"Saved {preset} index ({mmi_path})")
+
+    def choose_ref_path(self, preset: str, index: Path | None, aligner_args: str):
+        """Use a prebuilt index for the default genome unless args change indexing"""
+        indexing_args = {"-x", "-k", "-w", "-H"}
+        if index:
+            return Path(index)
+        if indexing_args.intersection(aligner_args.split()):
+            return self.ref_archive_path
+        mmi_path = self.mmi_path(preset)
+        if mmi_path and mmi_path.exists():
+            return mmi_path
+        return self.ref_archive_path
+
+    def index_paths(self, index: Path | None = None) -> list[Path]:
+        """Files read by aligner processes for an index, including both presets'
+        prebuilt Minimap2 indexes"""
+        if self.name == "Bowtie2":
+            idx_path = Path(index) if index else self.idx_path
+            return sorted(idx_path.parent.glob(f"{idx_path.name}.*bt2*"))
+        if not self.version:
+            self.get_version()
+        paths = {
+            self.choose_ref_path(preset, index, "")
+            for preset in (self.preset, self.paired_preset)
+        }
+        return sorted(path for path in paths if path.exists())
+
+    def report_residency(self) -> None:
+        """Log how much of the default index is in page cache, and if it is pinned"""
+        paths = self.index_paths()
+        if not paths:
+            return
+        try:
+            fraction = pin.resident_fraction(paths)
+        except OSError:  # E.g. mincore unavailable
+            return
+        pinned_paths = (pin.read_state(self.data_dir) or {}).get("paths", [])
+        pinned = all(str(p.resolve()) in pinned_paths for p in paths)
+        logging.debug(
+            f"Index {fraction:.0%} resident in page cache{' (pinned)' if pinned else ''}"
+        )
+
+    def prefilter_path(self, index: Path | None) -> Path:
+        """Path of the host k-mer filter, cached next to the index it was built from"""
+        name = Path(index).name if index else self.idx_name
+        for suffix in (".gz", ".fasta", ".fa", ".fna"):
+            name = name.removesuffix(suffix)
+        parent = Path(index).parent if index else self.data_dir
+        return parent / f"{name}.k{prefilter.K}s{prefilter.SAMPLING}.bloom"
+
+    def build_prefilter(self, index: Path | None) -> Path:
+        """Build a host k-mer filter from the index's reference once"""
+        path = self.prefilter_path(index)
+        if path.exists():
+            logging.info(f"Found cached host k-mer filter ({path})")
+            return path
+        logging.info(f"Building host k-mer filter, this may take some time ({path})")
+        if self.name == "Bowtie2":  # Recover reference sequences from the index
+            idx_path = Path(index) if index else self.idx_path
+            inspect = subprocess.Popen(
+                [f"{self.bin_path}-inspect", str(idx_path)], stdout=subprocess.PIPE
+            )
+            prefilter.build(inspect.stdout, path)
+            if inspect.wait():
+                path.unlink()
+                raise RuntimeError(f"Failed to read sequences from index {idx_path}")
+        else:
+            ref_path = Path(index) if index else self.ref_archive_path
+            if ref_path.suffix == ".mmi":
+                raise ValueError("Prefiltering requires a fasta reference, not .mmi")
+            with prefilter.open_fasta(ref_path) as fh:
+                prefilter.build(fh, path)
+        logging.info(f"Saved host k-mer filter ({path})")
+        return path
+
+    def estimate_index_memory(
+        self, index: Path | None, paired: bool = False, preset: str = ""
+    ) -> int:
+        """Rough resident size in bytes of the index used by one aligner process"""
+        if self.name == "Bowtie2":
+            idx_path = Path(index) if index else self.idx_path
+            paths = idx_path.parent.glob(f"{idx_path.name}*.bt2*")
+        else:
+            preset = preset or (self.paired_preset if paired else self.preset)
+            ref_path = self.choose_ref_path(preset, index, "")
+            if ref_path.suffix == ".mmi":
+                return ref_path.stat().st_size if ref_path.exists() else 0
+            paths = [ref_path]
+        size = sum(path.stat().st_size for path in paths if path.exists())
+        if self.name == "Minimap2":  # Minimap2 indexes a genome in memory
+            size *= 8 if str(paths[0]).endswith(".gz") else 3
+        return size
 
     def fetch_default_index(self):
         self.data_dir.mkdir(exist_ok=True, parents=True)
         if self.name == "Bowtie2":
-            logging.info(f"Fetching human index ({self.idx_archive_url})")
-            with tempfile.NamedTemporaryFile(delete=False) as temporary_file:
-                tmp_path = Path(temporary_file.name)
-                util.download(self.idx_archive_url, tmp_path)
-                logging.info("Extracting index…")
-                util.untar_file(tmp_path, self.data_dir)
+            logging.info(
+                f"Fetching and extracting human index ({self.idx_archive_url})"
+            )
+            util.download_and_untar(
+                self.idx_archive_url,
+                self.data_dir,
+                sha256=util.fetch_checksum(self.cdn_base_url, self.idx_archive_fn),
+            )
             logging.info(f"Saved human index ({self.idx_path})")
         if self.name == "Minimap2":
             logging.info(f"Fetching human reference ({self.ref_archive_url})")
-            with tempfile.NamedTemporaryFile(delete=False) as temporary_file:
-                tmp_path = Path(temporary_file.name)
-                util.download(self.ref_archive_url, tmp_path)
-                shutil.move(tmp_path, self.ref_archive_path)
+            util.download(
+                self.ref_archive_url,
+                self.ref_archive_path,
+                sha256=util.fetch_checksum(self.cdn_base_url, self.ref_archive_fn),
+            )
             logging.info(f"Saved human reference ({self.ref_archive_path})")
+            if not self.version:
+                self.get_version()
+            for preset in (self.preset, self.paired_preset):
+                self.build_mmi(preset)
+
+    def gen_input_cmd(
+        self,
+        fastqs: list[Path],
+        bypass_path: Path,
+        reorder: bool,
+        prefilter_path: Path | None,
+        timings_path: Path | None = None,
+        decompression_threads: int = 1,
+        interleaved: bool = False,
+        screen_processes: int = 1,
+    ) -> tuple[str, str]:
+        """Build the stage feeding the aligner's stdin, if any, and filter stage
+        arguments for reads diverted around the aligner through a named pipe"""
+        fastqs_fmt = " ".join(util.quote(fastq) for fastq in fastqs)
+        timings_args = f" --timings {util.quote(timings_path)}" if timings_path else ""
+        threads_args = f" --threads {decompression_threads}"
+        if interleaved:  # Pair consecutive records of a single fastq
+            threads_args += " --interleaved"
+        if prefilter_path:
+            screen_cmd = (
+                f"{STREAM_CMD} screen --filter {util.quote(prefilter_path)}"
+                f" --bypass {util.quote(bypass_path)}{' --number' if reorder else ''}"
+                f" --processes {screen_processes}{timings_args}{threads_args}"
+                f" {fastqs_fmt}"
+            )
+            cleanup_cmd = f"rm -f {util.quote(bypass_path)}"  # Expanded at exit
+            input_cmd = (
+                f"rm -f {util.quote(bypass_path)} && mkfifo {util.quote(bypass_path)}"
+                f" && trap {util.quote(cleanup_cmd)} EXIT"
+                f" && {timed(screen_cmd, 'input', timings_path)} | "
+            )
+            return input_cmd, f" --bypass {util.quote(bypass_path)}"
+        if reorder:
+            number_cmd = f"{STREAM_CMD} number{timings_args}{threads_args} {fastqs_fmt}"
+            return f"{timed(number_cmd, 'input', timings_path)} | ", ""
+        if bam.detect_format(fastqs[0]) != "fastq":  # Convert BAM/CRAM to fastq
+            cat_cmd = f"{STREAM_CMD} cat{threads_args} {fastqs_fmt}"
+            return f"{timed(cat_cmd, 'input', timings_path)} | ", ""
+        return "", ""
+
+    def gen_decompress_cmd(
+        self, fastqs: list[Path], fifo_stem: Path, threads: int
+    ) -> tuple[str, list[Path], str]:
+        """Decompress gzipped inputs on threads into named pipes read by the aligner
+        in place of the files. Return a command starting decompression, paths for
+        the aligner to read, and a command surfacing any decompression failure"""
+        gzipped = [util.is_gzip(fastq) for fastq in fastqs]
+        if threads < 2 or not any(gzipped):
+            return "", fastqs, ""
+        fifo_paths = [Path(f"{fifo_stem}.{i + 1}.fifo") for i in range(len(fastqs))]
+        fifo_paths = [p if gz else f for p, f, gz in zip(fifo_paths, fastqs, gzipped)]
+        fifos_fmt = " ".join(util.quote(p) for p, gz in zip(fifo_paths, gzipped) if gz)
+        decompress_cmds = [
+            f" {STREAM_CMD} decompress --threads {threads} {util.quote(fastq)}"
+            f" > {util.quote(fifo_path)} &"
+            f' pids="$pids $!";'
+            for fastq, fifo_path, gz in zip(fastqs, fifo_paths, gzipped)
+            if gz
+        ]
+        # Single quoted, so that bash expands nothing in paths when setting the trap
+        cleanup_cmd = f"rm -f {fifos_fmt}; kill $(jobs -p) 2>/dev/null || true"
+        cmd = (
+            f"set -e; rm -f {fifos_fmt}; mkfifo {fifos_fmt};"
+            f" trap {util.quote(cleanup_cmd)} EXIT;"
+            f"{''.join(decompress_cmds)} "
+        )
+        return cmd, fifo_paths, "; for pid in $pids; do wait $pid; done"
+
+    def gen_sharded_cmd(
+        self,
+        fastqs: list[Path],
+        alignment_cmd: str,
+        filter_cmd: str,
+        fifo_stem: Path,
+        shards: int,
+        count_paths: list[Path],
+        out_paths: list[Path],
+        rename: bool,
+        decompression_threads: int = 1,
+        interleaved: bool = False,
+    ) -> str:
+        """Deal reads between shards through named pipes, each shard with its own
+        aligner and filter stage writing hidden parts of the outputs, then join the
+        parts in order. Shard count files are summed by gather_stats"""
+        fifo_paths = [Path(f"{fifo_stem}.shard{i}.fifo") for i in range(shards)]
+        fifos_fmt = " ".join(util.quote(path) for path in fifo_paths)
+        fastqs_fmt = " ".join(util.quote(fastq) for fastq in fastqs)
+        outs_fmt = " ".join(f"--out {util.quote(path)}" for path in fifo_paths)
+        shard_cmds = []
+        for i, fifo_path in enumerate(fifo_paths):
+            shard_filter_cmd = filter_cmd
+            for path in count_paths + out_paths:
+                shard_filter_cmd = shard_filter_cmd.replace(
+                    f" {util.quote(path)}", f" {util.quote(util.shard_path(path, i))}"
+                )
+            if rename:
+                shard_filter_cmd += f" --rename-start {i + 1} --rename-step {shards}"
+            shard_cmds.append(
+                f" {{ {alignment_cmd} < {util.quote(fifo_path)}"
+                f" | {shard_filter_cmd}; }} &"
+                f' pids="$pids $!";'
+            )
+        concat_cmds = []
+        for path in out_paths:
+            parts_fmt = " ".join(
+                util.quote(util.shard_path(path, i)) for i in range(shards)
+            )
+            concat_cmds.append(
+                f" {STREAM_CMD} concat --out {util.quote(path)} {parts_fmt};"
+            )
+        cleanup_cmd = f"rm -f {fifos_fmt}; kill $(jobs -p) 2>/dev/null || true"
+        cmd = (
+            # Remove named pipes, and stop remaining stages if any stage fails
+            f"set -eo pipefail; rm -f {fifos_fmt}; mkfifo {fifos_fmt};"
+            f" trap {util.quote(cleanup_cmd)} EXIT;"
+            # Deal chunks of reads to shards as they are ready for them, keeping
+            # stdin, which bash otherwise replaces for background jobs
+            f" {STREAM_CMD} shard --progress --threads {decompression_threads}"
+            f" --chunk-size {stream.SHARD_CHUNK_SIZE}"
+            f"{' --interleaved' if interleaved else ''} {outs_fmt} {fastqs_fmt} <&0 &"
+            f' pids="$!";'
+            # Align and filter each shard
+            f"{''.join(shard_cmds)}"
+            f" for pid in $pids; do wait $pid; done;"
+            # Join shard outputs
+            f"{''.join(concat_cmds)}"
+        )
+        return cmd
 
     def gen_clean_cmd(
         self,
@@ -78,63 +436,124 @@ class Aligner:
         aligner_args: str,
         threads: int,
         force: bool,
+        compression: str = "gzip",
+        compression_level: int = 6,
+        compression_threads: int = 4,
+        prefilter_path: Path | None = None,
+        timings: bool = False,
+        shards: int = 1,
+        decompression_threads: int = 1,
+        output_format: str = "fastq",
+        stdout: bool = False,
+        preset: str = "",
+        screen_processes: int = 1,
     ) -> str:
         fastq, out_dir = Path(fastq), Path(out_dir)
+        preset = preset or self.preset
         out_dir.mkdir(exist_ok=True, parents=True)
         fastq_stem = util.fastq_path_to_stem(fastq)
-        fastq_out_path = out_dir / f"{fastq_stem}.clean.fastq.gz"
+        fastq_out_path = (
+            Path(compress.STDIO)
+            if stdout
+            else util.fastq_out_path(
+                out_dir, fastq_stem, "clean", compression, output_format
+            )
+        )
         count_before_path = out_dir / f"{fastq_stem}.reads_in.txt"
         count_after_path = out_dir / f"{fastq_stem}.reads_out.txt"
-        if not force and fastq_out_path.exists():
+        timings_path = out_dir / f"{fastq_stem}.timings.jsonl" if timings else None
+        timings_args = f" --timings {util.quote(timings_path)}" if timings else ""
+        clear_timings_cmd = f"rm -f {util.quote(timings_path)} && " if timings else ""
+        if not force and not stdout and fastq_out_path.exists():
             raise FileExistsError(
                 f"Output file already exists. Use --force to overwrite"
             )
+        idx_path = Path(index) if index else self.idx_path
         if index:
-            self.idx_path = Path(index)
-            self.ref_archive_path = Path(index)
             logging.info(f"Using custom index {index}")
-        reorder_cmd = " | samtools sort -n -O sam -@ 6 -m 1G" if reorder else ""
-        rename_cmd = (
-            # ' | awk \'BEGIN{{FS=OFS="\\t"}} {{$1=int(NR)" "; print $0}}\''
-            # Skips header lines (starting with @) and begins counter from first record
-            ' | awk \'BEGIN {{ FS=OFS="\\t"; line_count=0 }} /^@/ {{ next }}'
-            ' {{ $1=int(line_count+1)" "; print $0; line_count++ }}\''
-            if rename
-            else ""
+        input_stage = (
+            reorder
+            or prefilter_path
+            or shards > 1
+            or bam.detect_format(fastq) != "fastq"
+        )
+        decompress_cmd, (fastq_in,), wait_cmd = self.gen_decompress_cmd(
+            [fastq],
+            out_dir / f".{fastq_stem}",
+            1 if input_stage else decompression_threads,
         )
         cmd_template = {  # Templating for Aligner.cmd
-            "{BIN_PATH}": str(self.bin_path),
-            "{REF_ARCHIVE_PATH}": str(self.ref_archive_path),
-            "{INDEX_PATH}": str(self.idx_path),
-            "{FASTQ}": str(fastq),
+            "{BIN_PATH}": util.quote(self.bin_path),
+            "{PRESET}": preset,
+            "{REF_ARCHIVE_PATH}": util.quote(
+                self.choose_ref_path(preset, index, aligner_args)
+            ),
+            "{INDEX_PATH}": util.quote(idx_path),
+            "{FASTQ}": "-" if input_stage else util.quote(fastq_in),
             "{ALIGNER_ARGS}": str(aligner_args),
             "{THREADS}": str(threads),
         }
         alignment_cmd = self.cmd
         for k in cmd_template.keys():
             alignment_cmd = alignment_cmd.replace(k, cmd_template[k])
+        input_cmd, bypass_args = self.gen_input_cmd(
+            [fastq],
+            out_dir / f".{fastq_stem}.bypass",
+            reorder,
+            prefilter_path,
+            timings_path,
+            decompression_threads,
+            screen_processes=screen_processes,
+        )
+        filter_cmd = (
+            # Count primary records, discard mapped reads and count remaining reads
+            f"{STREAM_CMD} filter{' --progress' if shards == 1 else ''}"
+            f" --reads-in {util.quote(count_before_path)}"
+            f" --reads-out {util.quote(count_after_path)}"
+            # Optionally restore input order and merge diverted reads
+            f"{f' --reorder-window {stream.REORDER_WINDOW}' if reorder else ''}"
+            f"{bypass_args}"
+            # Stream remaining records into compressed fastq or BAM/CRAM files,
+            # optionally replacing read names with integers
+            f" --out1 {util.quote(fastq_out_path)} --output-format {output_format}"
+            f" --compression {compression}"
+            f" --compression-level {compression_level}"
+            f" --compression-threads {compression_threads}"
+            f"{' --rename' if rename else ''}"
+            f"{timings_args}"
+        )
+        if shards > 1:
+            return self.gen_sharded_cmd(
+                [fastq],
+                alignment_cmd,
+                filter_cmd,
+                out_dir / f".{fastq_stem}",
+                shards,
+                [count_before_path, count_after_path],
+                [fastq_out_path],
+                rename,
+                decompression_threads,
+            )
         cmd = (
+            # Fail if any stage fails, not only the last
+            "set -o pipefail; "
+            # Optionally decompress input on several threads into named pipes
+            f"{decompress_cmd}"
+            # Optionally record per-stage resource usage
+            f"{clear_timings_cmd}"
+            # Optionally number reads and divert those without host k-mers
+            f"{input_cmd}"
             # Align, stream reads to stdout in SAM format
-            f"{alignment_cmd}"
-            # Count reads in stream before filtering (2048 + 256 = 2304)
-            f" | tee >(samtools view -F 2304 -c - > '{count_before_path}')"
-            # Discard mapped reads
-            f" | samtools view -f 4 -"
-            # Count reads in stream after filtering
-            f" | tee >(samtools view -F 256 -c - > '{count_after_path}')"
-            # Optionally sort reads by name
-            f"{reorder_cmd}"
-            # Optionally replace read headers with integers
-            f"{rename_cmd}"
-            # Stream remaining records into fastq files
-            f" | samtools fastq --threads 4 -c 6 -0 '{fastq_out_path}'"
+            f"{timed(alignment_cmd, 'align', timings_path)}"
+            f" | {timed(filter_cmd, 'filter', timings_path)}"
+            f"{wait_cmd}"
         )
         return cmd
 
     def gen_paired_clean_cmd(
         self,
         fastq1: Path,
-        fastq2: Path,
+        fastq2: Path | None,
         out_dir: Path,
         index: Path | None,
         rename: bool,
@@ -142,65 +561,222 @@ class Aligner:
         aligner_args: str,
         threads: int,
         force: bool,
+        compression: str = "gzip",
+        compression_level: int = 6,
+        compression_threads: int = 4,
+        prefilter_path: Path | None = None,
+        timings: bool = False,
+        shards: int = 1,
+        decompression_threads: int = 1,
+        output_format: str = "fastq",
+        stdout: bool = False,
+        interleave_output: bool = False,
+        screen_processes: int = 1,
     ) -> str:
-        fastq1, fastq2, out_dir = Path(fastq1), Path(fastq2), Path(out_dir)
+        fastqs = [Path(fastq1), Path(fastq2)] if fastq2 else [Path(fastq1)]
+        out_dir = Path(out_dir)
         out_dir.mkdir(exist_ok=True, parents=True)
         fastq1_stem = util.fastq_path_to_stem(fastq1)
-        fastq2_stem = util.fastq_path_to_stem(fastq2)
-        fastq1_out_path = out_dir / f"{fastq1_stem}.clean_1.fastq.gz"
-        fastq2_out_path = out_dir / f"{fastq2_stem}.clean_2.fastq.gz"
+        fastq1_out_path, fastq2_out_path = util.paired_out_paths(
+            out_dir,
+            fastq1,
+            fastq2,
+            compression,
+            output_format,
+            stdout,
+            interleave_output,
+        )
+        out_paths = [path for path in (fastq1_out_path, fastq2_out_path) if path]
+        out2_args = f" --out2 {util.quote(fastq2_out_path)}" if fastq2_out_path else ""
         count_before_path = out_dir / f"{fastq1_stem}.reads_in.txt"
         count_after_path = out_dir / f"{fastq1_stem}.reads_out.txt"
-        if not force and (fastq1_out_path.exists() or fastq2_out_path.exists()):
+        timings_path = out_dir / f"{fastq1_stem}.timings.jsonl" if timings else None
+        timings_args = f" --timings {util.quote(timings_path)}" if timings else ""
+        clear_timings_cmd = f"rm -f {util.quote(timings_path)} && " if timings else ""
+        if not force and not stdout and any(path.exists() for path in out_paths):
             raise FileExistsError(
                 f"Output files already exist. Use --force to overwrite"
             )
+        idx_path = Path(index) if index else self.idx_path
         if index:
-            self.idx_path = Path(index)
-            self.ref_archive_path = Path(index)
             logging.info(f"Using custom index ({index})")
-        reorder_cmd = ""
-        if reorder:  # Under MacOS, Bowtie2's native --reorder is very slow
-            if util.get_platform() == "darwin":
-                reorder_cmd = " | samtools sort -n -O sam -@ 6 -m 1G" if reorder else ""
-            else:  # Under Linux, Bowtie2's --reorder option works very well
-                reorder_cmd = ""
-                aligner_args += " --reorder"
-        rename_cmd = (
-            # ' | awk \'BEGIN{{FS=OFS="\\t"; start=0}} /^@/{{next}} !start && !/^@/{{start=1}} start{{$1=int((NR+1)/2)" "; print $0}}\''
-            # Skips header lines (starting with @) and begins counter from first record
-            ' | awk \'BEGIN {{ FS=OFS="\\t"; start=0; line_count=1 }} /^@/ {{ next }}'
-            ' !start && !/^@/ {{ start=1 }} start {{ $1=int((line_count+1)/2)" ";'
-            " print $0; line_count++ }}'"
-            if rename
-            else ""
+        input_format = bam.detect_format(fastq1)
+        interleaved = not fastq2 and input_format == "fastq"  # Else mates share BAM
+        input_stage = reorder or prefilter_path or shards > 1 or input_format != "fastq"
+        decompress_cmd, fastqs_in, wait_cmd = self.gen_decompress_cmd(
+            fastqs,
+            out_dir / f".{fastq1_stem}",
+            1 if input_stage else decompression_threads,
+        )
+        cmd_template = {  # Templating for Aligner.cmd
+            "{BIN_PATH}": util.quote(self.bin_path),
+            "{PRESET}": self.paired_preset,
+            "{REF_ARCHIVE_PATH}": util.quote(
+                self.choose_ref_path(self.paired_preset, index, aligner_args)
+            ),
+            "{INDEX_PATH}": util.quote(idx_path),
+            "{FASTQ}": "-" if input_stage else util.quote(fastqs_in[0]),
+            "{FASTQ1}": util.quote(fastqs_in[0]),
+            "{FASTQ2}": util.quote(fastqs_in[-1]),
+            "{ALIGNER_ARGS}": str(aligner_args),
+            "{THREADS}": str(threads),
+        }
+        input_cmd, bypass_args = self.gen_input_cmd(
+            fastqs,
+            out_dir / f".{fastq1_stem}.bypass",
+            reorder,
+            prefilter_path,
+            timings_path,
+            decompression_threads,
+            interleaved,
+            screen_processes,
+        )
+        alignment_cmd = (  # Mates are interleaved by the input stage or in fastq1
+            self.interleaved_cmd if input_stage or not fastq2 else self.paired_cmd
+        )
+        for k in cmd_template.keys():
+            alignment_cmd = alignment_cmd.replace(k, cmd_template[k])
+        filter_cmd = (
+            # Count primary records, discard mapped reads and reads with mapped
+            # mates, and count remaining reads
+            f"{STREAM_CMD} filter --paired{' --progress' if shards == 1 else ''}"
+            f" --reads-in {util.quote(count_before_path)}"
+            f" --reads-out {util.quote(count_after_path)}"
+            # Optionally restore input order and merge diverted reads
+            f"{f' --reorder-window {stream.REORDER_WINDOW}' if reorder else ''}"
+            f"{bypass_args}"
+            # Stream remaining records into compressed fastq or BAM/CRAM files,
+            # optionally replacing read names with integers
+            f" --out1 {util.quote(fastq1_out_path)}{out2_args}"
+            f" --output-format {output_format}"
+            f" --compression {compression} --compression-level {compression_level}"
+            f" --compression-threads {compression_threads}"
+            f"{' --rename' if rename else ''}"
+            f"{timings_args}"
+        )
+        if shards > 1:
+            return self.gen_sharded_cmd(
+                fastqs,
+                alignment_cmd,
+                filter_cmd,
+                out_dir / f".{fastq1_stem}",
+                shards,
+                [count_before_path, count_after_path],
+                out_paths,
+                rename,
+                decompression_threads,
+                interleaved,
+            )
+        cmd = (
+            # Fail if any stage fails, not only the last
+            "set -o pipefail; "
+            # Optionally decompress input on several threads into named pipes
+            f"{decompress_cmd}"
+            # Optionally record per-stage resource usage
+            f"{clear_timings_cmd}"
+            # Optionally number reads and divert those without host k-mers,
+            # interleaving mates
+            f"{input_cmd}"
+            # Align, stream reads to stdout in SAM format
+            f"{timed(alignment_cmd, 'align', timings_path)}"
+            f" | {timed(filter_cmd, 'filter', timings_path)}"
+            f"{wait_cmd}"
         )
+        return cmd
+
+    def gen_batch_clean_cmd(
+        self,
+        fastqs: list[Path] | list[tuple[Path, Path]],
+        manifest_path: Path,
+        out_dir: Path,
+        index: Path | None,
+        rename: bool,
+        reorder: bool,
+        aligner_args: str,
+        threads: int,
+        force: bool,
+        paired: bool,
+        compression: str = "gzip",
+        compression_level: int = 6,
+        compression_threads: int = 4,
+        interleave_output: bool = False,
+        preset: str = "",
+    ) -> str:
+        """Stream many samples through one aligner process, tagging read names"""
+        out_dir = Path(out_dir)
+        out_dir.mkdir(exist_ok=True, parents=True)
+        samples = []
+        for fastq in fastqs:
+            fastq1, fastq2 = fastq if paired else (fastq, None)
+            fastq1_stem = util.fastq_path_to_stem(fastq1)
+            sample = {
+                "fastq1": str(fastq1),
+                "count_before_path": str(out_dir / f"{fastq1_stem}.reads_in.txt"),
+                "count_after_path": str(out_dir / f"{fastq1_stem}.reads_out.txt"),
+            }
+            if paired:
+                fastq1_out_path, fastq2_out_path = util.paired_out_paths(
+                    out_dir, fastq1, fastq2, compression, interleave=interleave_output
+                )
+                sample["fastq1_out_path"] = str(fastq1_out_path)
+                if fastq2:  # Else mates are interleaved in fastq1
+                    sample["fastq2"] = str(fastq2)
+                if fastq2_out_path:  # Else mates are interleaved in one output
+                    sample["fastq2_out_path"] = str(fastq2_out_path)
+            else:
+                sample["fastq1_out_path"] = str(
+                    util.fastq_out_path(out_dir, fastq1_stem, "clean", compression)
+                )
+            samples.append(sample)
+        out_paths = [
+            Path(sample[k])
+            for sample in samples
+            for k in ("fastq1_out_path", "fastq2_out_path")
+            if k in sample
+        ]
+        if len(set(out_paths)) < len(out_paths):
+            raise ValueError("Fastq filenames must be unique in batch mode")
+        if not force and any(path.exists() for path in out_paths):
+            raise FileExistsError(
+                f"Output files already exist. Use --force to overwrite"
+            )
+        idx_path = Path(index) if index else self.idx_path
+        if index:
+            logging.info(f"Using custom index ({index})")
+        if reorder and self.name == "Bowtie2":  # Minimap2 preserves input order
+            aligner_args += " --reorder"
+        preset = preset or (self.paired_preset if paired else self.preset)
+        manifest = {
+            "paired": paired,
+            "rename": rename,
+            "compression": compression,
+            "compression_level": compression_level,
+            "compression_threads": compression_threads,
+            "samples": samples,
+        }
+        Path(manifest_path).write_text(json.dumps(manifest))
         cmd_template = {  # Templating for Aligner.cmd
-            "{BIN_PATH}": str(self.bin_path),
-            "{REF_ARCHIVE_PATH}": str(self.ref_archive_path),
-            "{INDEX_PATH}": str(self.idx_path),
-            "{FASTQ1}": str(fastq1),
-            "{FASTQ2}": str(fastq2),
+            "{BIN_PATH}": util.quote(self.bin_path),
+            "{PRESET}": preset,
+            "{REF_ARCHIVE_PATH}": util.quote(
+                self.choose_ref_path(preset, index, aligner_args)
+            ),
+            "{INDEX_PATH}": util.quote(idx_path),
+            "{FASTQ}": "-",
             "{ALIGNER_ARGS}": str(aligner_args),
             "{THREADS}": str(threads),
         }
-        alignment_cmd = self.paired_cmd
+        alignment_cmd = self.interleaved_cmd if paired else self.cmd
         for k in cmd_template.keys():
             alignment_cmd = alignment_cmd.replace(k, cmd_template[k])
         cmd = (
+            # Fail if any stage fails, not only the last
+            "set -o pipefail; "
+            # Concatenate samples into one stream with sample-tagged read names
+            f"{STREAM_CMD} tag {util.quote(manifest_path)}"
             # Align, stream reads to stdout in SAM format
-            f"{alignment_cmd}"
-            # Count reads in stream before filtering (2048 + 256 = 2304)
-            f" | tee >(samtools view -F 2304 -c - > '{count_before_path}')"
-            # Discard mapped reads and reads with mapped mates
-            f" | samtools view -f 12 -"
-            # Count reads in stream after filtering
-            f" | tee >(samtools view -F 256 -c - > '{count_after_path}')"
-            # Optionally sort reads by name
-            f"{reorder_cmd}"
-            # Optionally replace paired read headers with integers
-            f"{rename_cmd}"
-            # Stream remaining records into fastq files
-            f" | samtools fastq --threads 4 -c 6 -N -1 '{fastq1_out_path}' -2 '{fastq2_out_path}'"
+            f" | {alignment_cmd}"
+            # Count, discard mapped reads and write fastq files per sample
+            f" | {STREAM_CMD} demux --progress {util.quote(manifest_path)}"
         )
         return cmd
@@ -0,0 +1,144 @@
+"""Unaligned BAM encoding and decoding, with CRAM read and written via samtools"""
+import gzip
+import signal
+import struct
+import subprocess
+
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+from hostile import compress
+
+
+FORMATS = ("fastq", "bam", "cram")
+MAGIC = b"BAM\x01"
+CODES = b"=ACMGRSVTWYHKDBN"
+DECODE_SEQ = bytes.maketrans(b"0123456789abcdef", CODES)
+ENCODE_QUAL = bytes.maketrans(bytes(range(33, 127)), bytes(range(94)))
+DECODE_QUAL = bytes.maketrans(bytes(range(94)), bytes(range(33, 127)))
+REVCOMP = bytes.maketrans(b"ACGTNacgtn", b"TGCANtgcan")
+RECORD = struct.Struct("<iiBBHHHIiii")  # Fixed length fields after block_size
+BIN_UNMAPPED = 4680
+SAM_HEADER = b"@HD\tVN:1.6\tSO:unsorted\n@PG\tID:hostile\tPN:hostile\n"
+
+
+def seq_encoding() -> bytes:
+    """Translation from bases to BAM 4-bit codes as hex digits, treating others as N"""
+    table = bytearray(b"f" * 256)
+    for code, base in enumerate(CODES):
+        table[base] = table[ord(chr(base).lower())] = b"0123456789abcdef"[code]
+    return bytes(table)
+
+
+ENCODE_SEQ = seq_encoding()
+
+
+def detect_format(path: Path) -> str:
+    """Tell fastq[.gz] from BAM and CRAM by their magic bytes. Stdin must be fastq"""
+    if compress.is_stdio(path):
+        return "fastq"
+    with open(path, "rb") as fh:
+        head = fh.peek(4)[:4]
+        if head == b"CRAM":
+            return "cram"
+        if head[:2] == b"\x1f\x8b":
+            with gzip.GzipFile(fileobj=fh) as gz:
+                if gz.read(4) == MAGIC:
+                    return "bam"
+    return "fastq"
+
+
+class CramReader(gzip.GzipFile):
+    """BAM decoded from CRAM by samtools, which is reaped on close"""
+
+    def __init__(self, path: Path, threads: int = 1):
+        self.process = subprocess.Popen(
+            ["samtools", "view", "-u", "--no-PG", "-@", str(threads), str(path)],
+            stdout=subprocess.PIPE,
+        )
+        super().__init__(fileobj=self.process.stdout)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        super().close()
+        self.process.stdout.close()  # Stops samtools with SIGPIPE if unread
+        if self.process.wait() not in (0, -signal.SIGPIPE):
+            raise subprocess.CalledProcessError(self.process.returncode, "samtools")
+
+
+def open_alignments(path: Path, threads: int = 1) -> BinaryIO:
+    """Open a BAM file decompressed, or a CRAM file decoded to BAM by samtools"""
+    if detect_format(path) == "cram":
+        return CramReader(path, threads)
+    return compress.open_reader(path, threads)
+
+
+def read_records(fh: BinaryIO) -> Iterator[tuple[bytes, int, bytes, bytes]]:
+    """Yield (name, flag, seq, qual) of primary records, oriented as sequenced"""
+    if fh.read(4) != MAGIC:
+        raise ValueError("Not a BAM file")
+    (l_text,) = struct.unpack("<i", fh.read(4))
+    fh.read(l_text)
+    (n_ref,) = struct.unpack("<i", fh.read(4))
+    for _ in range(n_ref):
+        (l_name,) = struct.unpack("<i", fh.read(4))
+        fh.read(l_name + 4)
+    while size := fh.read(4):
+        record = fh.read(int.from_bytes(size, "little"))
+        _, _, l_name, _, _, n_cigar, flag, l_seq, _, _, _ = RECORD.unpack_from(record)
+        if flag & 0x900:  # Secondary or supplementary
+            continue
+        start = RECORD.size + l_name + 4 * n_cigar
+        end = start + (l_seq + 1) // 2
+        name = record[RECORD.size : RECORD.size + l_name - 1]
+        seq = record[start:end].hex().encode().translate(DECODE_SEQ)[:l_seq]
+        qual = record[end : end + l_seq]
+        qual = b"*" if qual[:1] == b"\xff" else qual.translate(DECODE_QUAL)
+        if flag & 16:
+            seq, qual = seq.translate(REVCOMP)[::-1], qual[::-1]
+        yield name, flag, seq, qual
+
+
+def read_reads(fh: BinaryIO) -> Iterator[tuple[bytes, list[tuple[bytes, bytes]]]]:
+    """Yield (name, [(seq, qual), ...]) for each read, or pair of adjacent mates"""
+    pending = None
+    for name, flag, seq, qual in read_records(fh):
+        if not flag & 1:
+            yield name, [(seq, qual)]
+        elif not pending:
+            pending = name, flag, seq, qual
+        elif pending[0] != name:
+            raise ValueError(f"Mates of {pending[0].decode()} are not adjacent")
+        else:
+            mates = [pending[2:], (seq, qual)]
+            yield name, mates if pending[1] & 64 else mates[::-1]
+            pending = None
+    if pending:
+        raise ValueError(f"Mate of {pending[0].decode()} is missing")
+
+
+def is_paired(path: Path) -> bool:
+    """True if the first primary record of a BAM or CRAM file is paired"""
+    with open_alignments(path) as fh:
+        for _, flag, _, _ in read_records(fh):
+            return bool(flag & 1)
+    return False
+
+
+def encode_header(text: bytes = SAM_HEADER) -> bytes:
+    return MAGIC + struct.pack("<i", len(text)) + text + struct.pack("<i", 0)
+
+
+def encode_record(name: bytes, flag: int, seq: bytes, qual: bytes) -> bytes:
+    """Encode an unaligned BAM record, including its block_size"""
+    l_seq = len(seq)
+    packed = bytes.fromhex(
+        (seq.translate(ENCODE_SEQ) + (b"0" if l_seq % 2 else b"")).decode()
+    )
+    qual = b"\xff" * l_seq if qual == b"*" else qual.translate(ENCODE_QUAL)
+    fields = RECORD.pack(
+        -1, -1, len(name) + 1, 0, BIN_UNMAPPED, 0, flag, l_seq, -1, -1, 0
+    )
+    block = fields + name + b"\0" + packed + qual
+    return struct.pack("<i", len(block)) + block
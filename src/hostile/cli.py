@@ -1,5 +1,7 @@
+import functools
 import json
 import logging
+import sys
 
 from enum import Enum
 from pathlib import Path
@@ -7,7 +9,7 @@ from typing import Literal
 
 import defopt
 
-from hostile import lib
+from hostile import bam, compress, lib
 
 
 class ALIGNER(Enum):
@@ -18,6 +20,12 @@ class ALIGNER(Enum):
     auto = "auto"
 
 
+def update_progress_bar(bar: "tqdm", progress: lib.Progress) -> None:
+    bar.total = progress.reads_total
+    bar.update(progress.reads - bar.n)
+    bar.set_postfix_str(f"{progress.mbp_per_s:.1f} Mbp/s", refresh=False)
+
+
 def clean(
     *,
     fastq1: Path,
@@ -29,21 +37,43 @@ def clean(
     out_dir: Path = lib.CWD,
     threads: int = lib.THREADS,
     aligner_args: str = "",
+    compression: lib.COMPRESSION = "gzip",
+    compression_level: int = 6,
+    compression_threads: int = 0,
+    prefilter: bool = False,
+    timings: bool = False,
+    shards: int = 1,
+    decompression_threads: int = 0,
+    output_format: lib.OUTPUT_FORMAT = "fastq",
+    interleaved: bool = False,
+    interleave_output: bool = False,
+    stdout: bool = False,
     force: bool = False,
     debug: bool = False,
 ) -> None:
     """
-    Remove reads aligning to a target genome from fastq[.gz] input files
+    Remove reads aligning to a target genome from fastq[.gz] or unaligned BAM/CRAM input files
 
-    :arg fastq1: path to forward fastq.gz] file
+    :arg fastq1: path to forward fastq[.gz] file, or unaligned BAM/CRAM file of single or paired reads. Use - for stdin
     :arg fastq2: optional path to reverse fastq[.gz] file
-    :arg aligner: alignment algorithm. Use Bowtie2 for short reads and Minimap2 for long reads
+    :arg aligner: alignment algorithm. Use Bowtie2 for short reads and Minimap2 for long reads. auto chooses for unpaired reads (and Minimap2's preset) from the length, quality and names of the first reads
     :arg index: path to custom genome or index. For Bowtie2, exclude the .1.bt2 suffix
     :arg rename: replace read names with incrementing integers
     :arg reorder: ensure deterministic output order
     :arg out_dir: path to output directory
-    :arg threads: number of alignment threads. A sensible default is chosen automatically
+    :arg threads: number of alignment threads. 0 chooses automatically from available cores
     :arg aligner_args: additional arguments for alignment
+    :arg compression: output fastq compression format. zstd requires hostile[zstd]
+    :arg compression_level: output compression level
+    :arg compression_threads: number of output compression threads. 0 chooses automatically
+    :arg prefilter: skip aligning reads sharing no sampled k-mers with the target genome. Screening uses cores left free by --threads, so is only faster with cores to spare. Host reads with many sequencing errors or little exact similarity to the target genome can reach the output without being aligned
+    :arg timings: report wall time, CPU time, peak RSS and bytes through each pipeline stage
+    :arg shards: split a large sample between this many aligner processes. Output order is not preserved
+    :arg decompression_threads: number of input decompression threads. 0 chooses automatically
+    :arg output_format: output file format. CRAM requires samtools
+    :arg interleaved: fastq1 contains paired reads with mates interleaved
+    :arg interleave_output: write paired reads to one fastq file with mates interleaved
+    :arg stdout: write cleaned reads to stdout (interleaving mates) and the report to stderr
     :arg force: overwrite existing output files
     :arg debug: show debug messages
     """
@@ -60,7 +90,14 @@ def clean(
         if aligner == ALIGNER.auto or aligner == ALIGNER.minimap2
         else lib.ALIGNER.bowtie2
     )
-    if fastq2:
+    from tqdm import tqdm
+
+    bar = tqdm(desc="Cleaning", unit=" reads", unit_scale=True, disable=None)
+    progress = functools.partial(update_progress_bar, bar)
+    paired_alignments = (
+        not fastq2 and bam.detect_format(fastq1) != "fastq" and bam.is_paired(fastq1)
+    )
+    if fastq2 or interleaved or paired_alignments:
         stats = lib.clean_paired_fastqs(
             [(fastq1, fastq2)],
             index=index,
@@ -70,9 +107,27 @@ def clean(
             aligner=aligner_paired,
             aligner_args=aligner_args,
             threads=threads,
+            compression=compression,
+            compression_level=compression_level,
+            compression_threads=compression_threads,
+            prefilter=prefilter,
+            timings=timings,
+            progress=progress,
+            shards=shards,
+            decompression_threads=decompression_threads,
+            output_format=output_format,
+            stdout=stdout,
+            interleave_output=interleave_output,
             force=force,
         )
     else:
+        routing = (
+            lib.route_reads(fastq1, index, aligner.name)
+            if aligner != ALIGNER.bowtie2 and not compress.is_stdio(fastq1)
+            else None
+        )
+        if routing and aligner == ALIGNER.auto:
+            aligner_unpaired = lib.ALIGNER[routing["aligner"]]
         stats = lib.clean_fastqs(
             [fastq1],
             index=index,
@@ -82,7 +137,103 @@ def clean(
             aligner=aligner_unpaired,
             aligner_args=aligner_args,
             threads=threads,
+            compression=compression,
+            compression_level=compression_level,
+            compression_threads=compression_threads,
+            prefilter=prefilter,
+            timings=timings,
+            progress=progress,
+            shards=shards,
+            decompression_threads=decompression_threads,
+            output_format=output_format,
+            stdout=stdout,
+            force=force,
+            preset=routing["preset"] if routing else "",
+            routing=routing,
+        )
+    bar.close()
+    print(json.dumps(stats, indent=4), file=sys.stderr if stdout else sys.stdout)
+
+
+def clean_many(
+    *,
+    samplesheet: Path,
+    aligner: ALIGNER = ALIGNER.auto,
+    index: Path | None = None,
+    rename: bool = False,
+    reorder: bool = False,
+    out_dir: Path = lib.CWD,
+    threads: int = lib.THREADS,
+    aligner_args: str = "",
+    compression: lib.COMPRESSION = "gzip",
+    compression_level: int = 6,
+    compression_threads: int = 0,
+    interleave_output: bool = False,
+    force: bool = False,
+    debug: bool = False,
+) -> None:
+    """
+    Remove reads aligning to a target genome from many samples, loading the index once
+
+    :arg samplesheet: path to CSV with fastq1 and optional fastq2 and interleaved (true/false) columns. Relative paths are resolved from the samplesheet directory
+    :arg aligner: alignment algorithm. Use Bowtie2 for short reads and Minimap2 for long reads
+    :arg index: path to custom genome or index. For Bowtie2, exclude the .1.bt2 suffix
+    :arg rename: replace read names with incrementing integers
+    :arg reorder: ensure deterministic output order
+    :arg out_dir: path to output directory
+    :arg threads: number of alignment threads. 0 chooses automatically from available cores
+    :arg aligner_args: additional arguments for alignment
+    :arg compression: output fastq compression format. zstd requires hostile[zstd]
+    :arg compression_level: output compression level
+    :arg compression_threads: number of output compression threads. 0 chooses automatically
+    :arg interleave_output: write paired reads to one fastq file per sample with mates interleaved
+    :arg force: overwrite existing output files
+    :arg debug: show debug messages
+    """
+    if debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    fastqs, paired_fastqs = lib.parse_samplesheet(samplesheet)
+    stats = []
+    if paired_fastqs:
+        stats += lib.clean_paired_fastqs(
+            paired_fastqs,
+            index=index,
+            rename=rename,
+            reorder=reorder,
+            out_dir=out_dir,
+            aligner=(
+                lib.ALIGNER.minimap2
+                if aligner == ALIGNER.minimap2
+                else lib.ALIGNER.bowtie2
+            ),
+            aligner_args=aligner_args,
+            threads=threads,
+            compression=compression,
+            compression_level=compression_level,
+            compression_threads=compression_threads,
+            interleave_output=interleave_output,
+            force=force,
+            batch=True,
+        )
+    if fastqs:
+        stats += lib.clean_fastqs(
+            fastqs,
+            index=index,
+            rename=rename,
+            reorder=reorder,
+            out_dir=out_dir,
+            aligner=(
+                lib.ALIGNER.bowtie2
+                if aligner == ALIGNER.bowtie2
+                else lib.ALIGNER.minimap2
+            ),
+            aligner_args=aligner_args,
+            threads=threads,
+            compression=compression,
+            compression_level=compression_level,
+            compression_threads=compression_threads,
             force=force,
+            batch=True,
         )
     print(json.dumps(stats, indent=4))
 
@@ -137,45 +288,76 @@ def fetch(
             lib.ALIGNER.bowtie2.value.fetch_default_index()
 
 
+def serve(
+    port: int | None = None,
+    socket: Path | None = None,
+    concurrency: int = 1,
+    threads: int = lib.THREADS,
+    debug: bool = False,
+) -> None:
+    """
+    Run a local server accepting clean jobs as JSON, avoiding per-sample startup.
+    POST a job to /clean, e.g. {"fastq1": "/data/reads.fastq.gz", "out_dir": "/data/clean"}, to receive its report once cleaned. GET /status reports queued and running jobs
+
+    :arg port: localhost port to listen on instead of a Unix socket
+    :arg socket: path of the Unix socket to listen on. Defaults to hostile-<uid>.sock in $XDG_RUNTIME_DIR or the temporary directory
+    :arg concurrency: number of jobs to run at once. Others wait in a queue
+    :arg threads: alignment threads per job. 0 divides available cores between concurrent jobs
+    :arg debug: show debug messages
+    """
+    if debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    from hostile import server
+
+    server.serve(port, socket, concurrency, threads)
+
+
+def index_pin(
+    aligner: Literal["minimap2", "bowtie2", "both"] = "both", index: Path | None = None
+) -> None:
+    """
+    Keep indexes resident in memory for fast aligner startup, until unpinned or
+    restarted. Indexes are locked in memory if RLIMIT_MEMLOCK allows, and
+    otherwise reread periodically
+
+    :arg aligner: aligner(s) whose default index to pin
+    :arg index: path to custom genome or index to pin instead. For Bowtie2, exclude the .1.bt2 suffix
+    """
+    state = lib.pin_index(aligner, index)
+    print(json.dumps(state, indent=4))
+
+
+def index_unpin() -> None:
+    """
+    Release indexes pinned with hostile index pin
+    """
+    state = lib.unpin_index()
+    print(json.dumps(state, indent=4))
+
+
+def index_status(
+    aligner: Literal["minimap2", "bowtie2", "both"] = "both", index: Path | None = None
+) -> None:
+    """
+    Show how much of each index is resident in memory, and whether it is pinned
+
+    :arg aligner: aligner(s) whose default index to check
+    :arg index: path to custom genome or index to check instead. For Bowtie2, exclude the .1.bt2 suffix
+    """
+    print(json.dumps(lib.index_status(aligner, index), indent=4))
+
+
 def main():
     defopt.run(
-        {"clean": clean, "mask": mask, "fetch": fetch},
+        {
+            "clean": clean,
+            "clean-many": clean_many,
+            "mask": mask,
+            "fetch": fetch,
+            "serve": serve,
+            "index": {"pin": index_pin, "unpin": index_unpin, "status": index_status},
+        },
         no_negated_flags=True,
         strict_kwonly=False,
         short={},
     )
-
-
-# def clean_many(
-#     *fastqs: str,
-#     aligner: lib.ALIGNER = lib.ALIGNER.bowtie2,
-#     index: Path | None = None,
-#     out_dir: Path = lib.CWD,
-#     threads: int = lib.THREADS,
-#     debug: bool = False,
-# ) -> None:
-#     """
-#     Remove human reads from comma-separated pairs of fastq(.gz) files
-
-#     :arg fastqs: path to fastq(.gz) or bam file(s). Paired fastq paths should be comma-separated, e.g. reads_1.fastq.gz,reads_2.fastq.gz
-#     :arg aligner: alignment algorithm
-#     :arg index: path to custom genome or index. For Bowtie2, provide an index path without the .bt2 extension
-#     :arg out_dir: path to output directory
-#     :arg threads: number of threads to use
-#     :arg debug: show debug messages
-#     """
-#     if "," in fastqs[0]:  # Paired fastq
-#         paired_fastqs = [tuple(pair.split(",")) for pair in fastqs]
-#         paired_fastqs = [tuple([Path(fq1), Path(fq2)]) for fq1, fq2 in paired_fastqs]
-#         stats = lib.clean_paired_fastqs(
-#             paired_fastqs,
-#             out_dir=out_dir,
-#             threads=threads,
-#             aligner=aligner,
-#             index=index,
-#         )
-#         print(json.dumps(stats, indent=4))
-#     else:
-#         raise NotImplementedError(
-#             "Forward and reverse fastq(.gz) paths should be separated with a comma"
-#         )
@@ -0,0 +1,256 @@
+"""Parallel block compression for fastq output, and decompression for input"""
+import concurrent.futures
+import gzip
+import io
+import struct
+import sys
+import zlib
+
+from collections import deque
+from pathlib import Path
+from typing import BinaryIO
+
+
+FORMATS = ("gzip", "bgzf", "zstd", "none")
+SUFFIXES = {"gzip": ".gz", "bgzf": ".gz", "zstd": ".zst", "none": ""}
+BLOCK_SIZE = 2**20
+STDIO = "-"  # Path meaning stdin for inputs and stdout for outputs
+BGZF_BLOCK_SIZE = 0xFF00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def compress_gzip(data: bytes, level: int) -> bytes:
+    """Compress a block as a standalone gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_bgzf(data: bytes, level: int) -> bytes:
+    """Compress a block as a run of BGZF blocks"""
+    blocks = []
+    for i in range(0, len(data), BGZF_BLOCK_SIZE):
+        chunk = data[i : i + BGZF_BLOCK_SIZE]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(chunk) + compressor.flush()
+        if len(deflated) > 2**16 - 26:  # Incompressible, store instead
+            compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+            deflated = compressor.compress(chunk) + compressor.flush()
+        header = struct.pack(
+            "<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated) + 25
+        )
+        trailer = struct.pack("<II", zlib.crc32(chunk), len(chunk))
+        blocks.append(header + deflated + trailer)
+    return b"".join(blocks)
+
+
+def import_rapidgzip():
+    try:
+        import rapidgzip
+    except ImportError:
+        return None
+    return rapidgzip
+
+
+def is_bgzf(header: bytes) -> bool:
+    """True if header starts a gzip member carrying a BGZF block size subfield"""
+    return (
+        header[:4] == b"\x1f\x8b\x08\x04"
+        and len(header) >= 16
+        and header[12:14] == b"BC"
+    )
+
+
+def bgzf_block_size(data: bytes | memoryview, start: int) -> int:
+    """Total size of the BGZF block starting at start, from its BC subfield"""
+    xlen = int.from_bytes(data[start + 10 : start + 12], "little")
+    i, end = start + 12, start + 12 + xlen
+    while i + 4 <= end:
+        slen = int.from_bytes(data[i + 2 : i + 4], "little")
+        if data[i : i + 2] == b"BC":
+            return int.from_bytes(data[i + 4 : i + 6], "little") + 1
+        i += 4 + slen
+    raise ValueError("Malformed BGZF block")
+
+
+def split_bgzf_blocks(data: bytes) -> int:
+    """Return the length of the longest run of whole BGZF blocks at the start of data"""
+    end = 0
+    while end + 18 <= len(data):
+        size = bgzf_block_size(data, end)
+        if end + size > len(data):
+            break
+        end += size
+    return end
+
+
+def decompress_bgzf(data: bytes) -> bytes:
+    """Inflate a run of whole BGZF blocks"""
+    out, start = [], 0
+    while start < len(data):
+        end = start + bgzf_block_size(data, start)
+        xlen = int.from_bytes(data[start + 10 : start + 12], "little")
+        block = zlib.decompress(data[start + 12 + xlen : end - 8], -15)
+        if len(block) != int.from_bytes(data[end - 4 : end], "little"):
+            raise ValueError("Corrupt BGZF block")
+        out.append(block)
+        start = end
+    return b"".join(out)
+
+
+class BgzfReader(io.RawIOBase):
+    """Inflate runs of BGZF blocks on a thread pool, returning data in order"""
+
+    def __init__(self, fh: BinaryIO, threads: int):
+        self.fh, self.max_pending = fh, threads * 2
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.pending, self.remainder = deque(), b""
+        self.buffer, self.offset, self.eof = b"", 0, False
+
+    def readable(self) -> bool:
+        return True
+
+    def submit(self) -> None:
+        while not self.eof and len(self.pending) < self.max_pending:
+            data = self.remainder + self.fh.read(BLOCK_SIZE)
+            if len(data) == len(self.remainder):
+                if self.remainder:
+                    raise EOFError("Truncated BGZF input")
+                self.eof = True
+                break
+            end = split_bgzf_blocks(data)
+            self.remainder = data[end:]
+            self.pending.append(self.executor.submit(decompress_bgzf, data[:end]))
+
+    def readinto(self, b) -> int:
+        while self.offset == len(self.buffer):
+            self.submit()
+            if not self.pending:
+                return 0
+            self.buffer, self.offset = self.pending.popleft().result(), 0
+        n = min(len(b), len(self.buffer) - self.offset)
+        b[:n] = self.buffer[self.offset : self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self.executor.shutdown(cancel_futures=True)
+            self.fh.close()
+        super().close()
+
+
+def is_stdio(path: Path | str) -> bool:
+    return str(path) == STDIO
+
+
+def open_reader(path: Path | str, threads: int = 1) -> BinaryIO:
+    """Open a fastq[.gz] file for reading, decompressing on threads if more than one.
+    BGZF blocks are inflated in parallel; plain gzip uses rapidgzip's speculative
+    parallel inflate if installed, and zlib otherwise"""
+    fh = (
+        open(sys.stdin.fileno(), "rb", closefd=False)
+        if is_stdio(path)
+        else open(path, "rb")
+    )
+    header = fh.peek(18)[:18]
+    if header[:2] != b"\x1f\x8b":
+        return fh
+    if threads > 1 and is_bgzf(header):
+        return io.BufferedReader(BgzfReader(fh, threads), buffer_size=BLOCK_SIZE)
+    if threads > 1 and (rapidgzip := import_rapidgzip()):
+        return rapidgzip.open(fh, parallelization=threads)
+    return gzip.GzipFile(fileobj=fh)
+
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "zstd compression requires the zstandard package"
+            " (pip install 'hostile[zstd]')"
+        )
+    return zstandard
+
+
+class BlockWriter:
+    """Compress buffered blocks on a thread pool and write them in order"""
+
+    def __init__(
+        self,
+        fh: BinaryIO,
+        compression: str = "gzip",
+        level: int = 6,
+        threads: int = 1,
+        executor: concurrent.futures.Executor | None = None,
+    ):
+        if compression not in FORMATS:
+            raise ValueError(f"Compression must be one of {', '.join(FORMATS)}")
+        self.compression, self.level = compression, level
+        self.buffer, self.submitted = bytearray(), False
+        self.pending = deque()
+        self.max_pending = max(2, threads * 2)
+        self.compress = {"gzip": compress_gzip, "bgzf": compress_bgzf}.get(compression)
+        if compression == "zstd":  # Zstandard manages its own worker threads
+            zstandard = import_zstandard()
+            fh = zstandard.ZstdCompressor(
+                level=level, threads=threads if threads > 1 else 0
+            ).stream_writer(fh)
+        self.fh = fh
+        self.own_executor = executor is None and self.compress and threads > 1
+        if self.own_executor:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.executor = executor if self.compress else None
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+        if len(self.buffer) >= BLOCK_SIZE:
+            self.submit()
+
+    def submit(self) -> None:
+        block = bytes(self.buffer)
+        self.buffer.clear()
+        self.submitted = True
+        if not self.compress:
+            self.fh.write(block)
+        elif not self.executor:
+            self.fh.write(self.compress(block, self.level))
+        else:
+            self.pending.append(self.executor.submit(self.compress, block, self.level))
+            while len(self.pending) > self.max_pending or (
+                self.pending and self.pending[0].done()
+            ):
+                self.fh.write(self.pending.popleft().result())
+
+    def close(self) -> None:
+        if self.buffer or (self.compression == "gzip" and not self.submitted):
+            self.submit()  # Empty output is still a valid gzip member
+        while self.pending:
+            self.fh.write(self.pending.popleft().result())
+        if self.compression == "bgzf":
+            self.fh.write(BGZF_EOF)
+        if self.own_executor:
+            self.executor.shutdown()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_writer(
+    path: Path | str,
+    compression: str = "gzip",
+    level: int = 6,
+    threads: int = 1,
+    mode: str = "wb",
+    executor: concurrent.futures.Executor | None = None,
+) -> BlockWriter:
+    fh = (
+        open(sys.stdout.fileno(), mode, closefd=False)
+        if is_stdio(path)
+        else open(path, mode)
+    )
+    return BlockWriter(fh, compression, level, threads, executor)
@@ -1,15 +1,22 @@
+import csv
+import itertools
 import logging
 import gzip
-import multiprocessing
+import math
+import re
 import shutil
+import threading
+import time
 
 from enum import Enum
 from dataclasses import dataclass
 from pathlib import Path
 
+from typing import Callable, Literal
+
 from platformdirs import user_data_dir
 
-from hostile import util
+from hostile import bam, compress, pin, stream, util
 from hostile.aligner import Aligner
 
 
@@ -20,20 +27,163 @@ logging.basicConfig(
 )
 
 
+CORES_PER_PIPELINE = 16  # Automatic concurrency gives each pipeline at least this many
+STREAM_CORES = 1  # Reserved per pipeline for the filter and output stage
+COMPRESSION_SHARE = 5  # One compression thread per this many pipeline cores
+DECOMPRESSION_SHARE = 8  # One input decompression thread per this many aligner threads
+SCREEN_MBP_PER_PROCESS = 1.5  # Prefilter screening throughput of one core, measured
+ALIGNER_MBP_PER_THREAD = 3.0  # Roughly, given 22-32Mbp/s measured with 8 threads
+ROUTING_SAMPLE_READS = 1000  # Reads sampled from the start of input to choose aligner
+ROUTING_QUALITY_BASES = 1000  # Bases per sampled read used to estimate quality
+SHORT_READ_MAX_LENGTH = 500  # Longest median read length aligned as short reads
+SHORT_READ_MIN_QUALITY = 25  # Below this, short reads are e.g. ONT amplicons
+HIFI_MIN_QUALITY = 20  # Mean base quality distinguishing PacBio HiFi from CLR reads
+PACBIO_NAME = re.compile(rb"m\d+_\w+/\d+/")  # e.g. m64011_190830_220126/1/ccs
+
+
+@dataclass
+class ResourcePlan:
+    concurrency: int
+    aligner_threads: int
+    compression_threads: int
+    decompression_threads: int = 1
+    screen_processes: int = 1
+
+
+def plan_resources(
+    n_samples: int,
+    concurrency: int,
+    threads: int,
+    cpu_count: int,
+    memory: int,
+    index_memory: int,
+    shared_index: bool,
+    compression_threads: int = 0,
+    decompression_threads: int = 0,
+    prefilter: bool = False,
+) -> ResourcePlan:
+    """Split cores between concurrent pipelines, then within each pipeline between
+    alignment, compression and the stream stage. Zero concurrency, threads or
+    (de)compression_threads chooses automatically. Concurrency is capped so that
+    aligner processes fit in memory, if known; Bowtie2 indexes loaded with --mm are
+    shared. Input decompression takes over work from the aligner's own input thread,
+    so only becomes parallel once there are enough aligner threads to outpace it.
+    Prefilter screening uses cores left over, as many as it needs to keep pace with
+    the aligner. Screening costs more per read than alignment, so taking cores from
+    the aligner for it would only slow the pipeline down"""
+    if concurrency < 1:
+        concurrency = max(1, cpu_count // CORES_PER_PIPELINE)
+    concurrency = max(1, min(concurrency, n_samples))
+    if memory and index_memory and not shared_index:
+        concurrency = max(1, min(concurrency, memory // index_memory))
+    cores = max(1, cpu_count // concurrency - STREAM_CORES)
+    if not compression_threads:
+        compression_threads = max(1, cores // COMPRESSION_SHARE)
+    available = max(1, cores - compression_threads)
+    if not threads:
+        threads = available
+    elif concurrency > 1:  # Honour explicit thread counts for a single pipeline
+        threads = min(threads, available)
+    if not decompression_threads:
+        decompression_threads = max(1, threads // DECOMPRESSION_SHARE)
+    screen_processes = 1
+    if prefilter:
+        spare = cores - compression_threads - threads
+        needed = math.ceil(threads * ALIGNER_MBP_PER_THREAD / SCREEN_MBP_PER_PROCESS)
+        screen_processes = max(1, min(spare, needed))
+    return ResourcePlan(
+        concurrency,
+        threads,
+        compression_threads,
+        decompression_threads,
+        screen_processes,
+    )
+
+
+def check_prefilter_plan(plan: ResourcePlan) -> None:
+    """Warn if prefilter screening cannot keep pace with the planned aligner"""
+    screen_rate = plan.screen_processes * SCREEN_MBP_PER_PROCESS
+    aligner_rate = plan.aligner_threads * ALIGNER_MBP_PER_THREAD
+    if screen_rate < aligner_rate:
+        logging.warning(
+            f"Prefiltering on {plan.screen_processes} processes screens about"
+            f" {screen_rate:.1f}Mbp/s, slower than aligning every read with"
+            f" {plan.aligner_threads} threads (about {aligner_rate:.1f}Mbp/s), so it"
+            " will likely slow this run down. Pass fewer --threads to leave cores for"
+            " screening, or omit --prefilter"
+        )
+
+
 def choose_default_thread_count(cpu_count: int) -> int:
-    """Choose a sensible number of threads for alignment"""
-    cpu_count = int(cpu_count)
-    if cpu_count == 1:
-        return 1
-    elif 1 < cpu_count < 17:
-        return int(cpu_count / 2)
-    elif cpu_count > 16:
-        return 10
+    """Choose a sensible number of threads for aligning a single sample"""
+    return plan_resources(1, 1, 0, int(cpu_count), 0, 0, True).aligner_threads
 
 
+@dataclass
+class Progress:
+    """Reads through the filter stage so far, across all samples being cleaned"""
+
+    reads: int
+    reads_total: int | None  # Estimated from input file sizes, None for stdin
+    bases: int  # Estimated from the mean length of sampled input reads
+    elapsed: float
+
+    @property
+    def reads_per_s(self) -> float:
+        return self.reads / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def mbp_per_s(self) -> float:
+        return self.bases / self.elapsed / 1e6 if self.elapsed else 0.0
+
+    @property
+    def eta(self) -> float | None:
+        """Estimated seconds remaining"""
+        if not self.reads_per_s or self.reads_total is None:
+            return None
+        return max(0.0, self.reads_total - self.reads) / self.reads_per_s
+
+
+def track_progress(
+    callback: Callable[[Progress], None],
+    fastqs: list[Path],
+    paired: bool,
+    interleaved: list[bool] | None = None,
+) -> Callable[[int, int], None]:
+    """Combine record counts reported by each pipeline into Progress for callback.
+    Paired totals double the estimate for each fastq1, unless it is interleaved and
+    so already counts both mates"""
+    interleaved = interleaved or [False] * len(fastqs)
+    estimates = [util.estimate_fastq_reads(fastq) for fastq in fastqs]
+    n_reads = sum(n for n, _ in estimates)
+    mean_length = sum(n * length for n, length in estimates) / max(1, n_reads)
+    reads_total = sum(
+        n * (2 if paired and not mates_interleaved else 1)
+        for (n, _), mates_interleaved in zip(estimates, interleaved)
+    )
+    counts, lock, start = {}, threading.Lock(), time.monotonic()
+
+    def on_progress(i: int, reads: int) -> None:
+        with lock:
+            counts[i] = reads
+            reads = sum(counts.values())
+            callback(
+                Progress(
+                    reads=reads,
+                    reads_total=max(reads_total, reads) if reads_total else None,
+                    bases=round(reads * mean_length),
+                    elapsed=time.monotonic() - start,
+                )
+            )
+
+    return on_progress
+
+
+COMPRESSION = Literal["gzip", "bgzf", "zstd", "none"]
+OUTPUT_FORMAT = Literal["fastq", "bam", "cram"]
 CWD = Path.cwd().resolve()
 XDG_DATA_DIR = Path(user_data_dir("hostile", "Bede Constantinides"))
-THREADS = choose_default_thread_count(multiprocessing.cpu_count())
+THREADS = 0  # Choose automatically
 
 
 ALIGNER = Enum(
@@ -47,13 +197,18 @@ ALIGNER = Enum(
             cdn_base_url=f"https://objectstorage.uk-london-1.oraclecloud.com/n/lrbvkel2wjot/b/human-genome-bucket/o",
             data_dir=XDG_DATA_DIR,
             cmd=(
-                "{BIN_PATH} -x '{INDEX_PATH}' -U '{FASTQ}'"
+                "{BIN_PATH} -x {INDEX_PATH} -U {FASTQ}"
                 " -k 1 --mm -p {THREADS} {ALIGNER_ARGS}"
             ),
             paired_cmd=(
-                "{BIN_PATH} -x '{INDEX_PATH}' -1 '{FASTQ1}' -2 '{FASTQ2}'"
+                "{BIN_PATH} -x {INDEX_PATH} -1 {FASTQ1} -2 {FASTQ2}"
+                " -k 1 --mm -p {THREADS} {ALIGNER_ARGS}"
+            ),
+            interleaved_cmd=(
+                "{BIN_PATH} -x {INDEX_PATH} --interleaved {FASTQ}"
                 " -k 1 --mm -p {THREADS} {ALIGNER_ARGS}"
             ),
+            flags=("--interleaved", "--mm", "--reorder"),
             idx_archive_fn="human-t2t-hla.tar",
             idx_name="human-t2t-hla",
             idx_paths=(
@@ -72,10 +227,13 @@ ALIGNER = Enum(
             # cdn_base_url="http://localhost:8000",  # python -m http.server
             cdn_base_url=f"https://objectstorage.uk-london-1.oraclecloud.com/n/lrbvkel2wjot/b/human-genome-bucket/o",
             data_dir=XDG_DATA_DIR,
-            cmd="{BIN_PATH} -ax map-ont -m 40 --secondary no -t {THREADS} {ALIGNER_ARGS} '{REF_ARCHIVE_PATH}' '{FASTQ}'",
-            paired_cmd="{BIN_PATH} -ax sr -m 40 --secondary no -t {THREADS} {ALIGNER_ARGS} '{REF_ARCHIVE_PATH}' '{FASTQ1}' '{FASTQ2}'",
+            cmd="{BIN_PATH} -ax {PRESET} -m 40 --secondary no -t {THREADS} {ALIGNER_ARGS} {REF_ARCHIVE_PATH} {FASTQ}",
+            paired_cmd="{BIN_PATH} -ax {PRESET} -m 40 --secondary no -t {THREADS} {ALIGNER_ARGS} {REF_ARCHIVE_PATH} {FASTQ1} {FASTQ2}",
+            interleaved_cmd="{BIN_PATH} -ax {PRESET} -m 40 --secondary no -t {THREADS} {ALIGNER_ARGS} {REF_ARCHIVE_PATH} {FASTQ}",
             ref_archive_fn="human-t2t-hla.fa.gz",
             idx_name="human-t2t-hla.fa.gz",
+            preset="map-ont",
+            paired_preset="sr",
         ),
     },
 )
@@ -98,22 +256,49 @@ class SampleReport:
     fastq2_in_path: str | None = None
     fastq2_out_name: str | None = None
     fastq2_out_path: str | None = None
+    preset: str | None = None
+    routing: dict[str, str | int | float | None] | None = None
+    timings: dict[str, dict[str, float | int]] | None = None
+
+
+def gather_timings(out_dir: Path, stem: str) -> dict | None:
+    timings_path = Path(out_dir) / f"{stem}.timings.jsonl"
+    if not timings_path.exists():
+        return None
+    timings = util.parse_timings_file(timings_path)
+    timings_path.unlink()
+    return timings
 
 
 def gather_stats(
-    rename: bool, fastqs: list[Path], out_dir: Path, aligner: str, index: Path | None
+    rename: bool,
+    fastqs: list[Path],
+    out_dir: Path,
+    aligner: str,
+    index: Path | None,
+    compression: str = "gzip",
+    timings: bool = False,
+    shards: int = 1,
+    output_format: str = "fastq",
+    stdout: bool = False,
+    preset: str = "",
+    routing: dict | None = None,
 ) -> list[dict[str, str | int | float]]:
     stats = []
     for fastq1 in fastqs:
         fastq1_stem = util.fastq_path_to_stem(fastq1)
-        fastq1_out_path = out_dir / f"{fastq1_stem}.clean.fastq.gz"
+        fastq1_out_path = (
+            Path(compress.STDIO)
+            if stdout
+            else util.fastq_out_path(
+                out_dir, fastq1_stem, "clean", compression, output_format
+            )
+        )
         n_reads_in_path = out_dir / (fastq1_stem + ".reads_in.txt")
         n_reads_out_path = out_dir / (fastq1_stem + ".reads_out.txt")
-        n_reads_in = util.parse_count_file(n_reads_in_path)
-        n_reads_out = util.parse_count_file(n_reads_out_path)
+        n_reads_in = util.pop_count_files(n_reads_in_path, shards)
+        n_reads_out = util.pop_count_files(n_reads_out_path, shards)
         n_reads_removed = n_reads_in - n_reads_out
-        n_reads_in_path.unlink()
-        n_reads_out_path.unlink()
         try:
             proportion_removed = round(n_reads_removed / n_reads_in, 5)
         except ArithmeticError:  # ZeroDivisionError
@@ -136,6 +321,13 @@ def gather_stats(
             reads_out=n_reads_out,
             reads_removed=n_reads_removed,
             reads_removed_proportion=proportion_removed,
+            preset=(
+                preset or ALIGNER.minimap2.value.preset
+                if aligner == ALIGNER.minimap2.name
+                else None
+            ),
+            routing=routing,
+            timings=gather_timings(out_dir, fastq1_stem) if timings else None,
         ).__dict__
         stats.append({k: v for k, v in report.items() if v is not None})
     return stats
@@ -143,24 +335,34 @@ def gather_stats(
 
 def gather_stats_paired(
     rename: bool,
-    fastqs: list[tuple[Path, Path]],
+    fastqs: list[tuple[Path, Path | None]],
     out_dir: Path,
     aligner: str,
     index: Path | None,
+    compression: str = "gzip",
+    timings: bool = False,
+    shards: int = 1,
+    output_format: str = "fastq",
+    stdout: bool = False,
+    interleave_output: bool = False,
 ) -> list[dict[str, str | int | float]]:
     stats = []
     for fastq1, fastq2 in fastqs:
         fastq1_stem = util.fastq_path_to_stem(fastq1)
-        fastq2_stem = util.fastq_path_to_stem(fastq2)
-        fastq1_out_path = out_dir / f"{fastq1_stem}.clean_1.fastq.gz"
-        fastq2_out_path = out_dir / f"{fastq2_stem}.clean_2.fastq.gz"
+        fastq1_out_path, fastq2_out_path = util.paired_out_paths(
+            out_dir,
+            fastq1,
+            fastq2,
+            compression,
+            output_format,
+            stdout,
+            interleave_output,
+        )
         n_reads_in_path = out_dir / (fastq1_stem + ".reads_in.txt")
         n_reads_out_path = out_dir / (fastq1_stem + ".reads_out.txt")
-        n_reads_in = util.parse_count_file(n_reads_in_path)
-        n_reads_out = util.parse_count_file(n_reads_out_path)
+        n_reads_in = util.pop_count_files(n_reads_in_path, shards)
+        n_reads_out = util.pop_count_files(n_reads_out_path, shards)
         n_reads_removed = n_reads_in - n_reads_out
-        n_reads_in_path.unlink()
-        n_reads_out_path.unlink()
         try:
             proportion_removed = round(n_reads_removed / n_reads_in, 5)
         except ArithmeticError:  # ZeroDivisionError
@@ -171,43 +373,131 @@ def gather_stats_paired(
             else Path(ALIGNER[aligner].value.data_dir)
             / Path(ALIGNER[aligner].value.idx_name)
         )
-        stats.append(
-            SampleReport(
-                aligner=aligner,
-                index=str(index_fmt),
-                rename=rename,
-                fastq1_in_name=fastq1.name,
-                fastq2_in_name=fastq2.name,
-                fastq1_in_path=str(fastq1),
-                fastq2_in_path=str(fastq2),
-                fastq1_out_name=fastq1_out_path.name,
-                fastq2_out_name=fastq2_out_path.name,
-                fastq1_out_path=str(fastq1_out_path),
-                fastq2_out_path=str(fastq2_out_path),
-                reads_in=n_reads_in,
-                reads_out=n_reads_out,
-                reads_removed=n_reads_removed,
-                reads_removed_proportion=proportion_removed,
-            ).__dict__
-        )
+        report = SampleReport(
+            aligner=aligner,
+            index=str(index_fmt),
+            rename=rename,
+            fastq1_in_name=fastq1.name,
+            fastq2_in_name=fastq2.name if fastq2 else None,
+            fastq1_in_path=str(fastq1),
+            fastq2_in_path=str(fastq2) if fastq2 else None,
+            fastq1_out_name=fastq1_out_path.name,
+            fastq2_out_name=fastq2_out_path.name if fastq2_out_path else None,
+            fastq1_out_path=str(fastq1_out_path),
+            fastq2_out_path=str(fastq2_out_path) if fastq2_out_path else None,
+            reads_in=n_reads_in,
+            reads_out=n_reads_out,
+            reads_removed=n_reads_removed,
+            reads_removed_proportion=proportion_removed,
+            preset=(
+                ALIGNER.minimap2.value.paired_preset
+                if aligner == ALIGNER.minimap2.name
+                else None
+            ),
+            timings=gather_timings(out_dir, fastq1_stem) if timings else None,
+        ).__dict__
+        stats.append({k: v for k, v in report.items() if v is not None})
     return stats
 
 
-def choose_aligner(preferred_aligner: ALIGNER, using_custom_index: bool) -> ALIGNER:
+def check_modes(
+    fastqs: list[Path], batch: bool, shards: int, output_format: str, stdout: bool
+) -> None:
+    """Reject BAM/CRAM with modes that pass reads between samples or shards as fastq,
+    and streaming from stdin or to stdout with more than one sample or output"""
+    streaming = stdout or any(compress.is_stdio(fastq) for fastq in fastqs)
+    if streaming and (batch or len(fastqs) > 1):
+        raise ValueError("Streaming via stdin or stdout supports one sample only")
+    if stdout and shards > 1:
+        raise ValueError("Sharding is not supported with output to stdout")
+    if batch and (
+        output_format != "fastq"
+        or any(bam.detect_format(fastq) != "fastq" for fastq in fastqs)
+    ):
+        raise ValueError("BAM and CRAM are not supported in batch mode")
+    if shards > 1 and output_format != "fastq":
+        raise ValueError("Sharding is not supported with BAM or CRAM output")
+
+
+def choose_aligner(
+    preferred_aligner: ALIGNER,
+    using_custom_index: bool,
+    paired: bool = False,
+    preset: str = "",
+) -> ALIGNER:
     """Fallback to Minimap2 from Bowtie2 if Bowtie2 isn't installed etc"""
     aligner = preferred_aligner
     try:
-        aligner.value.check(using_custom_index=using_custom_index)
+        aligner.value.check(
+            using_custom_index=using_custom_index, paired=paired, preset=preset
+        )
     except Exception as e:
         if aligner == ALIGNER.bowtie2:
             aligner = ALIGNER.minimap2
             logging.warning(f"Using Minimap2 instead of Bowtie2")
-            aligner.value.check(using_custom_index=using_custom_index)
+            aligner.value.check(
+                using_custom_index=using_custom_index, paired=paired, preset=preset
+            )
         else:
             raise e
     return aligner
 
 
+def route_reads(
+    path: Path,
+    index: Path | None = None,
+    aligner: str = "auto",
+    n_sample: int = ROUTING_SAMPLE_READS,
+) -> dict[str, str | int | float | None]:
+    """Choose Bowtie2 or Minimap2 and a Minimap2 preset for unpaired reads from the
+    median length, mean base quality and names of the first n_sample reads.
+    Short, accurate reads go to Bowtie2, or to Minimap2's sr preset if a custom
+    index is a file (fasta or .mmi) rather than a Bowtie2 index prefix. Other reads
+    go to map-ont unless named like PacBio reads, which go to map-hifi or map-pb by
+    quality. Short low quality reads, such as ONT amplicons, are long read platform
+    reads for this purpose. Aligner minimap2 rather than auto keeps the map-ont
+    default for short reads"""
+    lengths, n_pacbio, n_ccs, qual_sum, n_qual = [], 0, 0, 0, 0
+    reads = stream.read_input([Path(path)])
+    for name, [(seq, qual), *_] in itertools.islice(reads, n_sample):
+        lengths.append(len(seq))
+        if PACBIO_NAME.match(name):
+            n_pacbio += 1
+            n_ccs += name.endswith(b"/ccs")
+        if qual != b"*":
+            qual = qual[:ROUTING_QUALITY_BASES]
+            qual_sum += sum(qual) - 33 * len(qual)
+            n_qual += len(qual)
+    reads.close()
+    median_length = sorted(lengths)[len(lengths) // 2] if lengths else 0
+    mean_quality = round(qual_sum / n_qual, 1) if n_qual else None
+    short_reads = median_length <= SHORT_READ_MAX_LENGTH and (
+        mean_quality is None or mean_quality >= SHORT_READ_MIN_QUALITY
+    )
+    if short_reads and aligner == "auto":
+        bowtie2 = not (index and Path(index).is_file())
+        aligner = ALIGNER.bowtie2.name if bowtie2 else ALIGNER.minimap2.name
+        preset = "sr"
+    elif short_reads:
+        aligner, preset = ALIGNER.minimap2.name, "map-ont"
+    elif n_pacbio > len(lengths) / 2:
+        hifi = n_ccs > len(lengths) / 2 or (mean_quality or 0) >= HIFI_MIN_QUALITY
+        aligner, preset = ALIGNER.minimap2.name, "map-hifi" if hifi else "map-pb"
+    else:
+        aligner, preset = ALIGNER.minimap2.name, "map-ont"
+    logging.info(
+        f"Sampled {len(lengths)} reads (median length {median_length},"
+        f" mean quality {mean_quality}), choosing {aligner} ({preset})"
+    )
+    return {
+        "aligner": aligner,
+        "preset": preset,
+        "reads_sampled": len(lengths),
+        "median_length": median_length,
+        "mean_quality": mean_quality,
+    }
+
+
 def clean_fastqs(
     fastqs: list[Path],
     index: Path | None = None,
@@ -218,42 +508,138 @@ def clean_fastqs(
     aligner_args: str = "",
     threads: int = THREADS,
     force: bool = False,
+    batch: bool = False,
+    concurrency: int = 1,
+    max_memory: int | None = None,
+    compression: COMPRESSION = "gzip",
+    compression_level: int = 6,
+    compression_threads: int = 0,
+    prefilter: bool = False,
+    timings: bool = False,
+    progress: Callable[[Progress], None] | None = None,
+    shards: int = 1,
+    decompression_threads: int = 0,
+    output_format: OUTPUT_FORMAT = "fastq",
+    stdout: bool = False,
+    preset: str = "",
+    routing: dict | None = None,
 ):
     logging.debug(f"clean_fastqs() {threads=}")
     if aligner == ALIGNER.bowtie2:
         logging.info("Using Bowtie2")
     elif aligner == ALIGNER.minimap2:
-        logging.info("Using Minimap2's long read preset")
-    fastqs = [Path(path).resolve() for path in fastqs]
-    if not all(fastq.is_file() for fastq in fastqs):
+        logging.info(f"Using Minimap2's {preset or aligner.value.preset} preset")
+    fastqs = [util.resolve_input(path) for path in fastqs]
+    if not all(util.input_exists(fastq) for fastq in fastqs):
         raise FileNotFoundError("One or more fastq files do not exist")
     Path(out_dir).mkdir(exist_ok=True, parents=True)
-    aligner = choose_aligner(aligner, using_custom_index=bool(index))
-    backend_cmds = [
-        aligner.value.gen_clean_cmd(
-            fastq=fastq,
-            out_dir=out_dir,
-            index=index,
-            rename=rename,
-            reorder=reorder,
-            aligner_args=aligner_args,
-            threads=threads,
-            force=force,
+    if batch and (prefilter or timings):
+        raise ValueError("Prefiltering and timings are not supported in batch mode")
+    if shards > 1 and (batch or reorder or prefilter or timings):
+        raise ValueError(
+            "Sharding is not supported with batch mode, reordering, prefiltering"
+            " or timings"
         )
-        for fastq in fastqs
-    ]
+    check_modes(fastqs, batch, shards, output_format, stdout)
+    aligner = choose_aligner(aligner, using_custom_index=bool(index), preset=preset)
+    prefilter_path = aligner.value.build_prefilter(index) if prefilter else None
+    plan = plan_resources(
+        n_samples=len(fastqs),
+        concurrency=1 if batch else concurrency,
+        threads=threads,
+        cpu_count=util.get_cpu_count(),
+        memory=max_memory or util.get_memory_bytes(),
+        index_memory=aligner.value.estimate_index_memory(
+            index, paired=False, preset=preset
+        ),
+        shared_index=aligner == ALIGNER.bowtie2,
+        compression_threads=compression_threads,
+        decompression_threads=decompression_threads,
+        prefilter=prefilter,
+    )
+    logging.debug(f"{plan=}")
+    if prefilter:
+        check_prefilter_plan(plan)
+    if batch:
+        manifest_path = util.make_manifest_path(out_dir)
+        backend_cmds = [
+            aligner.value.gen_batch_clean_cmd(
+                fastqs=fastqs,
+                manifest_path=manifest_path,
+                out_dir=out_dir,
+                index=index,
+                rename=rename,
+                reorder=reorder,
+                aligner_args=aligner_args,
+                threads=plan.aligner_threads,
+                force=force,
+                paired=False,
+                compression=compression,
+                compression_level=compression_level,
+                compression_threads=plan.compression_threads,
+                preset=preset,
+            )
+        ]
+    else:
+        backend_cmds = [
+            aligner.value.gen_clean_cmd(
+                fastq=fastq,
+                out_dir=out_dir,
+                index=index,
+                rename=rename,
+                reorder=reorder,
+                aligner_args=aligner_args,
+                threads=max(1, plan.aligner_threads // shards),
+                force=force,
+                compression=compression,
+                compression_level=compression_level,
+                compression_threads=max(1, plan.compression_threads // shards),
+                prefilter_path=prefilter_path,
+                timings=timings,
+                shards=shards,
+                decompression_threads=plan.decompression_threads,
+                screen_processes=plan.screen_processes,
+                output_format=output_format,
+                stdout=stdout,
+                preset=preset,
+            )
+            for fastq in fastqs
+        ]
     logging.debug(f"{backend_cmds=}")
     logging.info("Cleaning…")
-    util.run_bash_parallel(backend_cmds, description="Cleaning")
+    try:
+        util.run_bash_parallel(
+            backend_cmds,
+            description="Cleaning",
+            max_workers=plan.concurrency,
+            stdout=stdout,
+            on_progress=track_progress(progress, fastqs, paired=False)
+            if progress
+            else None,
+        )
+    finally:
+        if batch:
+            manifest_path.unlink(missing_ok=True)
     stats = gather_stats(
-        rename=rename, fastqs=fastqs, out_dir=out_dir, aligner=aligner.name, index=index
+        rename=rename,
+        fastqs=fastqs,
+        out_dir=out_dir,
+        aligner=aligner.name,
+        index=index,
+        compression=compression,
+        timings=timings,
+        shards=shards,
+        output_format=output_format,
+        stdout=stdout,
+        preset=preset,
+        routing=routing,
     )
     logging.info("Finished cleaning")
     return stats
 
 
 def clean_paired_fastqs(
-    fastqs: list[tuple[Path, Path]],
+    fastqs: list[tuple[Path, Path | None]],
     index: Path | None = None,
     rename: bool = False,
     reorder: bool = False,
@@ -262,41 +648,165 @@ def clean_paired_fastqs(
     aligner_args: str = "",
     threads: int = THREADS,
     force: bool = False,
+    batch: bool = False,
+    concurrency: int = 1,
+    max_memory: int | None = None,
+    compression: COMPRESSION = "gzip",
+    compression_level: int = 6,
+    compression_threads: int = 0,
+    prefilter: bool = False,
+    timings: bool = False,
+    progress: Callable[[Progress], None] | None = None,
+    shards: int = 1,
+    decompression_threads: int = 0,
+    output_format: OUTPUT_FORMAT = "fastq",
+    stdout: bool = False,
+    interleave_output: bool = False,
 ):
     logging.debug(f"clean_paired_fastqs() {threads=}")
     if aligner == ALIGNER.bowtie2:
         logging.info("Using Bowtie2 (paired reads)")
     elif aligner == ALIGNER.minimap2:
         logging.info("Using Minimap2's short read preset (paired reads)")
-    fastqs = [(Path(path1).resolve(), Path(path2).resolve()) for path1, path2 in fastqs]
-    if not all(path.is_file() for fastq_pair in fastqs for path in fastq_pair):
+    fastqs = [
+        (util.resolve_input(path1), util.resolve_input(path2) if path2 else None)
+        for path1, path2 in fastqs
+    ]
+    if not all(util.input_exists(p) for fastq_pair in fastqs for p in fastq_pair if p):
         raise FileNotFoundError("One or more fastq files do not exist")
     Path(out_dir).mkdir(exist_ok=True, parents=True)
-    aligner = choose_aligner(aligner, using_custom_index=bool(index))
-    backend_cmds = [
-        aligner.value.gen_paired_clean_cmd(
-            fastq1=pair[0],
-            fastq2=pair[1],
-            out_dir=out_dir,
-            index=index,
-            rename=rename,
-            reorder=reorder,
-            aligner_args=aligner_args,
-            threads=threads,
-            force=force,
+    if batch and (prefilter or timings):
+        raise ValueError("Prefiltering and timings are not supported in batch mode")
+    if shards > 1 and (batch or reorder or prefilter or timings):
+        raise ValueError(
+            "Sharding is not supported with batch mode, reordering, prefiltering"
+            " or timings"
         )
-        for pair in fastqs
-    ]
+    check_modes([fastq1 for fastq1, _ in fastqs], batch, shards, output_format, stdout)
+    aligner = choose_aligner(aligner, using_custom_index=bool(index), paired=True)
+    prefilter_path = aligner.value.build_prefilter(index) if prefilter else None
+    plan = plan_resources(
+        n_samples=len(fastqs),
+        concurrency=1 if batch else concurrency,
+        threads=threads,
+        cpu_count=util.get_cpu_count(),
+        memory=max_memory or util.get_memory_bytes(),
+        index_memory=aligner.value.estimate_index_memory(index, paired=True),
+        shared_index=aligner == ALIGNER.bowtie2,
+        compression_threads=compression_threads,
+        decompression_threads=decompression_threads,
+        prefilter=prefilter,
+    )
+    logging.debug(f"{plan=}")
+    if prefilter:
+        check_prefilter_plan(plan)
+    if batch:
+        manifest_path = util.make_manifest_path(out_dir)
+        backend_cmds = [
+            aligner.value.gen_batch_clean_cmd(
+                fastqs=fastqs,
+                manifest_path=manifest_path,
+                out_dir=out_dir,
+                index=index,
+                rename=rename,
+                reorder=reorder,
+                aligner_args=aligner_args,
+                threads=plan.aligner_threads,
+                force=force,
+                paired=True,
+                compression=compression,
+                compression_level=compression_level,
+                compression_threads=plan.compression_threads,
+                interleave_output=interleave_output,
+            )
+        ]
+    else:
+        backend_cmds = [
+            aligner.value.gen_paired_clean_cmd(
+                fastq1=pair[0],
+                fastq2=pair[1],
+                out_dir=out_dir,
+                index=index,
+                rename=rename,
+                reorder=reorder,
+                aligner_args=aligner_args,
+                threads=max(1, plan.aligner_threads // shards),
+                force=force,
+                compression=compression,
+                compression_level=compression_level,
+                compression_threads=max(1, plan.compression_threads // shards),
+                prefilter_path=prefilter_path,
+                timings=timings,
+                shards=shards,
+                decompression_threads=plan.decompression_threads,
+                screen_processes=plan.screen_processes,
+                output_format=output_format,
+                stdout=stdout,
+                interleave_output=interleave_output,
+            )
+            for pair in fastqs
+        ]
     logging.debug(f"{backend_cmds=}")
     logging.info("Cleaning…")
-    util.run_bash_parallel(backend_cmds, description="Cleaning")
+    try:
+        util.run_bash_parallel(
+            backend_cmds,
+            description="Cleaning",
+            max_workers=plan.concurrency,
+            stdout=stdout,
+            on_progress=track_progress(
+                progress,
+                [fastq1 for fastq1, _ in fastqs],
+                paired=True,
+                interleaved=[  # BAM and CRAM estimates count first mates only
+                    not fastq2 and bam.detect_format(fastq1) == "fastq"
+                    for fastq1, fastq2 in fastqs
+                ],
+            )
+            if progress
+            else None,
+        )
+    finally:
+        if batch:
+            manifest_path.unlink(missing_ok=True)
     stats = gather_stats_paired(
-        rename=rename, fastqs=fastqs, out_dir=out_dir, aligner=aligner.name, index=index
+        rename=rename,
+        fastqs=fastqs,
+        out_dir=out_dir,
+        aligner=aligner.name,
+        index=index,
+        compression=compression,
+        timings=timings,
+        shards=shards,
+        output_format=output_format,
+        stdout=stdout,
+        interleave_output=interleave_output,
     )
     logging.info("Finished cleaning")
     return stats
 
 
+def parse_samplesheet(
+    path: Path,
+) -> tuple[list[Path], list[tuple[Path, Path | None]]]:
+    """Parse a CSV samplesheet with fastq1 and optional fastq2 and interleaved
+    columns. Paired samples with interleaved mates have no fastq2"""
+    path = Path(path)
+    fastqs, paired_fastqs = [], []
+    with open(path, newline="") as fh:
+        for row in csv.DictReader(fh):
+            fastq1 = path.parent / row["fastq1"].strip()
+            fastq2 = (row.get("fastq2") or "").strip()
+            interleaved = (row.get("interleaved") or "").strip().lower()
+            if fastq2:
+                paired_fastqs.append((fastq1, path.parent / fastq2))
+            elif interleaved in ("1", "true", "yes"):
+                paired_fastqs.append((fastq1, None))
+            else:
+                fastqs.append(fastq1)
+    return fastqs, paired_fastqs
+
+
 def mask(
     reference: Path, target: Path, out_dir=Path("masked"), threads: int = 1
 ) -> Path:
@@ -315,10 +825,11 @@ def mask(
         reference_path = new_reference_path
 
     make_cmd = (
-        f"minimap2 -x asm10 -t {threads} '{reference_path}' '{target}'"
+        f"minimap2 -x asm10 -t {threads}"
+        f" {util.quote(reference_path)} {util.quote(target)}"
         f" | awk -v OFS='\t' '{{print $6, $8, $9}}'"
         f" | sort -k1,1 -k2,2n"
-        f" | bedtools merge -i stdin > '{bed_path}'"
+        f" | bedtools merge -i stdin > {util.quote(bed_path)}"
     )
     logging.info(f"Making mask ({make_cmd=})")
     make_cmd_run = util.run(make_cmd)
@@ -326,7 +837,8 @@ def mask(
 
     apply_cmd = (
         f"bedtools maskfasta"
-        f" -fi '{reference_path}' -bed '{bed_path}' -fo '{masked_reference_path}'"
+        f" -fi {util.quote(reference_path)} -bed {util.quote(bed_path)}"
+        f" -fo {util.quote(masked_reference_path)}"
     )
     logging.info(f"Applying mask ({apply_cmd=})")
     apply_cmd_run = util.run(apply_cmd)
@@ -343,13 +855,64 @@ def get_default_reference_filenames() -> list[Path]:
     return [ALIGNER.minimap2.value.ref_archive_fn, ALIGNER.bowtie2.value.idx_archive_fn]
 
 
-def fetch_reference(filename: str) -> None:
-    util.download(
-        url=f"{ALIGNER.minimap2.value.cdn_base_url}/{filename}", path=Path(filename)
+def find_index_paths(
+    aligner: Literal["minimap2", "bowtie2", "both"] = "both", index: Path | None = None
+) -> dict[str, list[Path]]:
+    """Index files of each aligner, skipping aligners that cannot be run for both"""
+    aligners = (
+        [ALIGNER.minimap2, ALIGNER.bowtie2] if aligner == "both" else [ALIGNER[aligner]]
     )
+    paths = {}
+    for aligner in aligners:
+        try:
+            paths[aligner.name] = aligner.value.index_paths(index)
+        except Exception as e:
+            if len(aligners) == 1:
+                raise e
+            logging.warning(f"Skipping {aligner.value.name} ({e})")
+    return paths
+
+
+def pin_index(
+    aligner: Literal["minimap2", "bowtie2", "both"] = "both", index: Path | None = None
+) -> dict:
+    """Hold index files in memory in a background process until unpinned"""
+    paths = find_index_paths(aligner, index)
+    return pin.pin([path for paths in paths.values() for path in paths], XDG_DATA_DIR)
+
+
+def unpin_index() -> dict | None:
+    return pin.unpin(XDG_DATA_DIR)
+
+
+def index_status(
+    aligner: Literal["minimap2", "bowtie2", "both"] = "both", index: Path | None = None
+) -> list[dict[str, str | int | float | bool]]:
+    """Report each aligner's index size, page cache residency and pinning"""
+    pinned_paths = (pin.read_state(XDG_DATA_DIR) or {}).get("paths", [])
+    return [
+        {
+            "aligner": name,
+            "paths": [str(path) for path in paths],
+            "size": sum(path.stat().st_size for path in paths),
+            "resident": round(pin.resident_fraction(paths), 5),
+            "pinned": bool(paths)
+            and all(str(path.resolve()) in pinned_paths for path in paths),
+        }
+        for name, paths in find_index_paths(aligner, index).items()
+    ]
+
+
+def fetch_reference(filename: str) -> None:
+    cdn_base_url = ALIGNER.minimap2.value.cdn_base_url
+    sha256 = util.fetch_checksum(cdn_base_url, filename)
     if filename.endswith(".tar"):
-        logging.info("Extracting…")
-        util.untar_file(input_path=Path(filename), output_path=Path("."))
+        util.download_and_untar(
+            url=f"{cdn_base_url}/{filename}", out_dir=Path("."), sha256=sha256
+        )
         logging.info(f"Downloaded and extracted {filename}")
     else:
+        util.download(
+            url=f"{cdn_base_url}/{filename}", path=Path(filename), sha256=sha256
+        )
         logging.info(f"Downloaded {filename}")
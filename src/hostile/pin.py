@@ -0,0 +1,160 @@
+"""Keep aligner index files resident in page cache between runs, by holding them
+memory mapped and locked in a background process"""
+import ctypes
+import ctypes.util
+import json
+import logging
+import mmap
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+
+
+PROT_READ, MAP_SHARED, MADV_WILLNEED = 1, 1, 3
+MAP_FAILED = ctypes.c_void_p(-1).value
+REFRESH_INTERVAL = 300  # Seconds between rereading files that could not be locked
+STATE_FILENAME = "pinned.json"
+
+LIBC = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+LIBC.mmap.restype = ctypes.c_void_p
+LIBC.mmap.argtypes = [
+    ctypes.c_void_p,
+    ctypes.c_size_t,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_long,
+]
+LIBC.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+LIBC.mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+LIBC.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+LIBC.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+
+
+def map_file(path: Path) -> tuple[int, int]:
+    """Map a file read-only, returning its address and size"""
+    size = os.path.getsize(path)
+    with open(path, "rb") as fh:
+        address = LIBC.mmap(None, size, PROT_READ, MAP_SHARED, fh.fileno(), 0)
+    if address == MAP_FAILED:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"Failed to map {path}: {os.strerror(errno)}")
+    return address, size
+
+
+def resident_fraction(paths: list[Path]) -> float:
+    """Fraction of the pages of files currently in page cache, using mincore"""
+    n_pages = n_resident = 0
+    for path in paths:
+        if not os.path.getsize(path):
+            continue
+        address, size = map_file(path)
+        try:
+            vec = ctypes.create_string_buffer(-(-size // mmap.PAGESIZE))
+            if LIBC.mincore(address, size, vec):
+                raise OSError(ctypes.get_errno(), f"mincore failed for {path}")
+            n_pages += len(vec)
+            n_resident += sum(byte & 1 for byte in vec.raw)
+        finally:
+            LIBC.munmap(address, size)
+    return n_resident / n_pages if n_pages else 0.0
+
+
+def read_files(paths: list[Path]) -> None:
+    """Read files through page cache, faulting in evicted pages"""
+    buffer = bytearray(2**24)
+    for path in paths:
+        with open(path, "rb", buffering=0) as fh:
+            while fh.readinto(buffer):
+                pass
+
+
+def hold(paths: list[Path]) -> None:
+    """Map and lock files in memory until terminated, reporting whether locking
+    succeeded on stdout. Without a sufficient RLIMIT_MEMLOCK, files are instead
+    reread periodically to keep them recently used"""
+    mappings = [map_file(path) for path in paths if os.path.getsize(path)]
+    locked = True
+    for address, size in mappings:
+        LIBC.madvise(address, size, MADV_WILLNEED)
+        if locked and LIBC.mlock(address, size):
+            locked = False
+            error = os.strerror(ctypes.get_errno())
+            print(f"Could not lock index in memory ({error})", file=sys.stderr)
+    if not locked:
+        read_files(paths)
+    print(json.dumps({"locked": locked}), flush=True)
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        if not locked:
+            read_files(paths)
+
+
+def is_pin_process(pid: int) -> bool:
+    """True if pid is still a pin process, rather than exited or reused by another"""
+    try:
+        os.kill(pid, 0)
+    except (ProcessLookupError, PermissionError):  # Ours would be signallable
+        return False
+    try:
+        return b"hostile.pin" in Path(f"/proc/{pid}/cmdline").read_bytes()
+    except OSError:  # Exited, or no procfs to check, e.g. on macOS
+        return not Path("/proc/self").exists()
+
+
+def read_state(data_dir: Path) -> dict | None:
+    """State of the running pin process, if any"""
+    state_path = Path(data_dir) / STATE_FILENAME
+    if not state_path.exists():
+        return None
+    state = json.loads(state_path.read_text())
+    if not is_pin_process(state["pid"]):
+        state_path.unlink(missing_ok=True)
+        return None
+    return state
+
+
+def pin(paths: list[Path], data_dir: Path) -> dict:
+    """Start a background process holding files in memory, replacing any other"""
+    unpin(data_dir)
+    paths = [Path(path).resolve() for path in paths]
+    if not paths:
+        raise FileNotFoundError("No index files found to pin")
+    logging.info(f"Pinning {sum(p.stat().st_size for p in paths) / 1e6:.0f}MB")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "hostile.pin", *map(str, paths)],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        start_new_session=True,  # Outlive this process
+        text=True,
+    )
+    line = process.stdout.readline()
+    process.stdout.close()
+    if not line:
+        raise RuntimeError(f"Failed to pin index (exit code {process.wait()})")
+    state = {"pid": process.pid, "paths": list(map(str, paths)), **json.loads(line)}
+    Path(data_dir).mkdir(exist_ok=True, parents=True)
+    (Path(data_dir) / STATE_FILENAME).write_text(json.dumps(state))
+    return state
+
+
+def unpin(data_dir: Path) -> dict | None:
+    """Stop the background process holding files in memory, if running"""
+    state = read_state(data_dir)
+    if state:
+        try:
+            os.kill(state["pid"], signal.SIGTERM)
+        except ProcessLookupError:  # Exited since read_state
+            pass
+        (Path(data_dir) / STATE_FILENAME).unlink(missing_ok=True)
+    return state
+
+
+if __name__ == "__main__":
+    hold([Path(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,139 @@
+"""Bloom filter of sampled host k-mers for screening reads ahead of alignment"""
+import gzip
+import hashlib
+import json
+import mmap
+import zlib
+
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+
+K = 31
+SAMPLING = 8  # Keep one in every SAMPLING k-mers, chosen by hash
+SIZE_BITS = 32  # log2 of the filter size in bits
+N_HASHES = 3
+MIN_SAMPLED = 2  # Never bypass reads too short to have been screened meaningfully
+NON_ACGT = bytes(sorted(set(range(256)) - set(b"ACGT")))
+MASK_NON_ACGT = bytes.maketrans(NON_ACGT, b"N" * len(NON_ACGT))
+REVCOMP = bytes.maketrans(b"ACGT", b"TGCA")
+
+
+def canonical_kmers(seq: bytes, k: int = K) -> Iterator[bytes]:
+    """Yield the lesser of each k-mer and its reverse complement, skipping Ns"""
+    for part in seq.upper().translate(MASK_NON_ACGT).split(b"N"):
+        n = len(part)
+        rc = part.translate(REVCOMP)[::-1]
+        for i in range(n - k + 1):
+            kmer, rc_kmer = part[i : i + k], rc[n - k - i : n - i]
+            yield kmer if kmer < rc_kmer else rc_kmer
+
+
+class KmerFilter:
+    """Bloom filter over canonical k-mers whose crc32 is divisible by sampling.
+    Reads and reference are sampled identically, so shared k-mers are seen by both"""
+
+    def __init__(
+        self,
+        bits: bytearray | mmap.mmap,
+        k: int = K,
+        sampling: int = SAMPLING,
+        size_bits: int = SIZE_BITS,
+        offset: int = 0,
+    ):
+        self.bits, self.offset = bits, offset
+        self.k, self.sampling, self.size_bits = k, sampling, size_bits
+        self.mask = (1 << size_bits) - 1
+
+    @classmethod
+    def empty(cls, k: int = K, sampling: int = SAMPLING, size_bits: int = SIZE_BITS):
+        return cls(bytearray(max(1, (1 << size_bits) // 8)), k, sampling, size_bits)
+
+    @classmethod
+    def load(cls, path: Path) -> "KmerFilter":
+        with open(path, "rb") as fh:
+            header = json.loads(fh.readline())
+            offset = fh.tell()
+            bits = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(bits, header["k"], header["sampling"], header["size_bits"], offset)
+
+    def save(self, path: Path) -> None:
+        header = {"k": self.k, "sampling": self.sampling, "size_bits": self.size_bits}
+        with open(path, "wb") as fh:
+            fh.write(json.dumps(header).encode() + b"\n")
+            fh.write(self.bits)
+
+    def sampled(self, seq: bytes) -> Iterator[list[int]]:
+        """Yield bit positions of each sampled k-mer"""
+        for kmer in canonical_kmers(seq, self.k):
+            if zlib.crc32(kmer) % self.sampling:
+                continue
+            digest = hashlib.blake2b(kmer, digest_size=8).digest()
+            h1 = int.from_bytes(digest[:4], "little")
+            h2 = int.from_bytes(digest[4:], "little") | 1
+            yield [(h1 + i * h2) & self.mask for i in range(N_HASHES)]
+
+    def add(self, seq: bytes) -> None:
+        for positions in self.sampled(seq):
+            for pos in positions:
+                self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def screen(self, seq: bytes) -> tuple[int, bool]:
+        """Return the number of sampled k-mers checked and whether any were found,
+        stopping at the first hit"""
+        bits, offset, n_sampled = self.bits, self.offset, 0
+        for positions in self.sampled(seq):
+            n_sampled += 1
+            if all(bits[offset + (pos >> 3)] >> (pos & 7) & 1 for pos in positions):
+                return n_sampled, True
+        return n_sampled, False
+
+    def is_host_free(self, *seqs: bytes) -> bool:
+        """True if enough sampled k-mers were checked and none were found"""
+        n_sampled = 0
+        for seq in seqs:
+            n, hit = self.screen(seq)
+            if hit:
+                return False
+            n_sampled += n
+        return n_sampled >= MIN_SAMPLED
+
+
+def read_fasta(fh: BinaryIO, chunk_size: int = 2**20, overlap: int = K - 1):
+    """Yield overlapping chunks of each fasta record's sequence"""
+    buffer = bytearray()
+    for line in fh:
+        if line.startswith(b">"):
+            if len(buffer) > overlap:
+                yield bytes(buffer)
+            buffer.clear()
+            continue
+        buffer += line.rstrip()
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            del buffer[:-overlap]
+    if len(buffer) > overlap:
+        yield bytes(buffer)
+
+
+def build(
+    fasta: BinaryIO,
+    path: Path,
+    k: int = K,
+    sampling: int = SAMPLING,
+    size_bits: int = SIZE_BITS,
+) -> None:
+    """Build a filter from a fasta stream and save it atomically"""
+    kmer_filter = KmerFilter.empty(k, sampling, size_bits)
+    for chunk in read_fasta(fasta, overlap=k - 1):
+        kmer_filter.add(chunk)
+    tmp_path = Path(path).with_suffix(".tmp")
+    kmer_filter.save(tmp_path)
+    tmp_path.replace(path)
+
+
+def open_fasta(path: Path) -> BinaryIO:
+    fh = open(path, "rb")
+    if fh.peek(2)[:2] == b"\x1f\x8b":
+        return gzip.GzipFile(fileobj=fh)
+    return fh
@@ -0,0 +1,238 @@
+"""Long-running server accepting clean jobs as JSON over a Unix socket or localhost
+HTTP, so that imports and the index's page cache stay warm between samples"""
+import concurrent.futures
+import http.server
+import json
+import logging
+import os
+import signal
+import socketserver
+import tempfile
+import threading
+
+from pathlib import Path
+from typing import get_args
+
+from hostile import bam, compress, lib, util
+
+
+PORT = 8737
+SOCKET_PATH = Path(os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()) / (
+    f"hostile-{os.getuid()}.sock"
+)
+LOCAL_HOSTS = ("localhost", "127.0.0.1")
+SHELL_CHARACTERS = "'\"$`\n"  # Pipelines quote paths, but refuse these regardless
+CLIENT_ERRORS = (FileExistsError, FileNotFoundError, KeyError, TypeError, ValueError)
+JOB_OPTIONS = {  # Jobs may set only these, so no free-form value reaches the shell
+    "fastq1": str,
+    "fastq2": str,
+    "interleaved": bool,
+    "aligner": str,
+    "index": str,
+    "out_dir": str,
+    "rename": bool,
+    "reorder": bool,
+    "force": bool,
+    "threads": int,
+    "max_memory": int,
+    "compression": str,
+    "compression_level": int,
+    "compression_threads": int,
+    "decompression_threads": int,
+    "prefilter": bool,
+    "timings": bool,
+    "shards": int,
+    "output_format": str,
+    "interleave_output": bool,
+}
+JOB_CHOICES = {
+    "aligner": ("auto", *(aligner.name for aligner in lib.ALIGNER)),
+    "compression": get_args(lib.COMPRESSION),
+    "output_format": get_args(lib.OUTPUT_FORMAT),
+}
+
+
+def validate_job(job: dict) -> None:
+    """Reject unknown options, mistyped values, and strings holding characters
+    with meaning to the shell"""
+    if not isinstance(job, dict):
+        raise TypeError("Job must be a JSON object")
+    if unknown := set(job) - set(JOB_OPTIONS):
+        raise ValueError(f"Unsupported job options: {', '.join(sorted(unknown))}")
+    for key, value in job.items():
+        if value is None and key != "fastq1":
+            continue
+        if not isinstance(value, JOB_OPTIONS[key]):
+            raise TypeError(f"{key} must be {JOB_OPTIONS[key].__name__}")
+        if key in JOB_CHOICES and value not in JOB_CHOICES[key]:
+            raise ValueError(f"{key} must be one of {', '.join(JOB_CHOICES[key])}")
+        if isinstance(value, str) and any(c in value for c in SHELL_CHARACTERS):
+            raise ValueError(f"{key} must not contain quotes, $, ` or newlines")
+
+
+def run_job(job: dict, threads: int = lib.THREADS) -> list[dict]:
+    """Clean one sample like hostile clean, taking its arguments as JSON fields"""
+    options = dict(job)
+    fastq1 = Path(options.pop("fastq1"))
+    fastq2 = options.pop("fastq2", None)
+    interleaved = options.pop("interleaved", False)
+    aligner = options.pop("aligner", "auto")
+    if compress.is_stdio(fastq1) or options.get("stdout"):
+        raise ValueError("Jobs cannot stream via stdin or stdout")
+    for key in ("index", "out_dir"):
+        if options.get(key):
+            options[key] = Path(options[key])
+    options.setdefault("threads", threads)
+    paired = (
+        fastq2
+        or interleaved
+        or (bam.detect_format(fastq1) != "fastq" and bam.is_paired(fastq1))
+    )
+    if paired:
+        return lib.clean_paired_fastqs(
+            [(fastq1, Path(fastq2) if fastq2 else None)],
+            aligner=lib.ALIGNER.bowtie2 if aligner == "auto" else lib.ALIGNER[aligner],
+            **options,
+        )
+    routing = (
+        lib.route_reads(fastq1, options.get("index"), aligner)
+        if aligner != "bowtie2"
+        else None
+    )
+    if routing and aligner == "auto":
+        aligner = routing["aligner"]
+    return lib.clean_fastqs(
+        [fastq1],
+        aligner=lib.ALIGNER[aligner],
+        preset=routing["preset"] if routing else "",
+        routing=routing,
+        **options,
+    )
+
+
+class JobQueue:
+    """Run jobs on a bounded number of workers, dividing cores between them"""
+
+    def __init__(self, concurrency: int = 1, threads: int = lib.THREADS):
+        self.concurrency = concurrency
+        self.threads = threads or max(1, util.get_cpu_count() // concurrency)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.lock = threading.Lock()
+        self.counts = {"queued": 0, "running": 0, "finished": 0, "failed": 0}
+
+    def submit(self, job: dict) -> concurrent.futures.Future:
+        with self.lock:
+            self.counts["queued"] += 1
+        return self.executor.submit(self.run, job)
+
+    def run(self, job: dict) -> list[dict]:
+        with self.lock:
+            self.counts["queued"] -= 1
+            self.counts["running"] += 1
+        outcome = "failed"
+        try:
+            stats = run_job(job, self.threads)
+            outcome = "finished"
+            return stats
+        finally:
+            with self.lock:
+                self.counts["running"] -= 1
+                self.counts[outcome] += 1
+
+    def status(self) -> dict[str, int]:
+        with self.lock:
+            return {"concurrency": self.concurrency, **self.counts}
+
+
+class JobHandler(http.server.BaseHTTPRequestHandler):
+    """POST /clean runs a job and replies with its report once finished.
+    GET /status reports queue counts"""
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.reply(200, self.server.queue.status())
+        else:
+            self.reply(404, {"error": f"Not found: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/clean":
+            self.reply(404, {"error": f"Not found: {self.path}"})
+            return
+        if self.headers.get_content_type() != "application/json":
+            # Browsers cannot send JSON cross-origin without a CORS preflight
+            self.reply(415, {"error": "Content-Type must be application/json"})
+            return
+        if self.headers.get("Host", "").rsplit(":", 1)[0] not in LOCAL_HOSTS:
+            # Guards against DNS rebinding
+            self.reply(403, {"error": "Host must be localhost"})
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers["Content-Length"] or 0)))
+            validate_job(job)
+            stats = self.server.queue.submit(job).result()
+        except CLIENT_ERRORS as e:
+            self.reply(400, {"error": f"{type(e).__name__}: {e}"})
+        except Exception as e:
+            logging.exception("Job failed")
+            self.reply(500, {"error": f"{type(e).__name__}: {e}"})
+        else:
+            self.reply(200, stats)
+
+    def reply(self, status: int, body: dict | list) -> None:
+        data = json.dumps(body, indent=4).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        return self.client_address[0] if self.client_address else "unix socket"
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(
+    port: int = PORT,
+    socket_path: Path | None = None,
+    concurrency: int = 1,
+    threads: int = lib.THREADS,
+) -> socketserver.BaseServer:
+    if socket_path:
+        Path(socket_path).unlink(missing_ok=True)
+        server = UnixHTTPServer(str(socket_path), JobHandler)
+        os.chmod(socket_path, 0o600)  # Jobs run as this user, so only they may submit
+    else:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), JobHandler)
+    server.queue = JobQueue(concurrency, threads)
+    return server
+
+
+def serve(
+    port: int | None = None,
+    socket_path: Path | None = None,
+    concurrency: int = 1,
+    threads: int = lib.THREADS,
+) -> None:
+    """Serve jobs until interrupted or terminated, on a Unix socket unless given a
+    port"""
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if port is None and not socket_path:
+        socket_path = SOCKET_PATH
+    server = make_server(port, socket_path, concurrency, threads)
+    address = socket_path or f"http://127.0.0.1:{server.server_address[1]}"
+    logging.info(f"Listening on {address} ({concurrency=})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.queue.executor.shutdown(cancel_futures=True)
+        if socket_path:
+            Path(socket_path).unlink(missing_ok=True)
@@ -0,0 +1,892 @@
+"""Streaming stages run inside hostile's alignment pipelines"""
+import argparse
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import select
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+from hostile import bam, compress, prefilter
+
+
+REVCOMP = bytes.maketrans(b"ACGTNacgtn", b"TGCANtgcan")
+TAG_SEP = b"|"
+MAX_OPEN_WRITERS = 64
+REORDER_WINDOW = 2**18
+PROGRESS_PREFIX = "hostile-progress: "
+PROGRESS_INTERVAL = 1.0
+PROGRESS_CHECK_MASK = 2**14 - 1  # Check the clock every 16384 records
+SHARD_CHUNK_SIZE = 2**20
+SCREEN_BATCH_READS = 2**10  # Reads sent to a screening process at a time
+
+
+def files_size(paths: list) -> int:
+    """Total size of files, counting stdin and stdout as empty"""
+    return sum(os.path.getsize(p) for p in paths if not compress.is_stdio(p))
+
+
+def open_input(path: Path, threads: int = 1) -> BinaryIO:
+    """Open a fastq[.gz] file, detecting gzip compression from its magic bytes"""
+    return compress.open_reader(path, threads)
+
+
+def read_fastq(fh: BinaryIO) -> Iterator[tuple[bytes, bytes, bytes]]:
+    """Yield (name, seq, qual) tuples, dropping comments and /1 /2 mate suffixes"""
+    while header := fh.readline():
+        seq = fh.readline().rstrip()
+        fh.readline()
+        qual = fh.readline().rstrip()
+        name = header[1:].split(maxsplit=1)[0]
+        if name.endswith((b"/1", b"/2")):
+            name = name[:-2]
+        yield name, seq, qual
+
+
+def is_unaligned(flag: int, paired: bool) -> bool:
+    """Unpaired reads must be unmapped; paired reads also need an unmapped mate"""
+    return flag & 12 == 12 if paired else bool(flag & 4)
+
+
+def write_counts(reads_in: int, reads_out: int, paths: tuple[str, str]) -> None:
+    Path(paths[0]).write_text(f"{reads_in}\n")
+    Path(paths[1]).write_text(f"{reads_out}\n")
+
+
+class ProgressReporter:
+    """Report records processed on stderr at intervals, for hostile to parse"""
+
+    def __init__(self, interval: float = PROGRESS_INTERVAL):
+        self.interval = interval
+        self.last = time.monotonic()
+
+    def update(self, records: int, force: bool = False) -> None:
+        now = time.monotonic()
+        if force or now - self.last >= self.interval:
+            print(f"{PROGRESS_PREFIX}{records}", file=sys.stderr, flush=True)
+            self.last = now
+
+
+def write_timing(path: Path | str | None, **fields) -> None:
+    """Append a stage's measurements to a sample's timings file"""
+    if path:
+        with open(path, "a") as fh:
+            fh.write(json.dumps(fields) + "\n")
+
+
+def time_stage(label: str, timings_path: Path, argv: list[str]) -> int:
+    """Run a pipeline stage sharing our stdin and stdout, recording wall time,
+    CPU time and peak RSS"""
+    start = time.perf_counter()
+    process = subprocess.Popen(argv)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    write_timing(
+        timings_path,
+        stage=label,
+        wall_s=round(time.perf_counter() - start, 3),
+        cpu_s=round(usage.ru_utime + usage.ru_stime, 3),
+        peak_rss_mb=round(peak_rss / 2**20, 1),
+    )
+    return process.returncode
+
+
+def format_fastq(name: bytes, flag: int, seq: bytes, qual: bytes, paired: bool):
+    """Format a SAM record as fastq like samtools fastq -N"""
+    if flag & 16:
+        seq, qual = seq.translate(REVCOMP)[::-1], qual[::-1]
+    if qual == b"*":
+        qual = b'"' * len(seq)
+    if paired:
+        name += b"/1" if flag & 64 else b"/2"
+    return b"@%b\n%b\n+\n%b\n" % (name, seq, qual)
+
+
+class Renamer:
+    """Replace read names with incrementing integers. Mates share a number, which
+    advances whenever the (adjacent) read name changes. Shards count from their own
+    start in steps of the shard count, keeping names unique across shards"""
+
+    def __init__(self, paired: bool, start: int = 1, step: int = 1):
+        self.paired, self.step = paired, step
+        self.count = start - step
+        self.last_name = None
+
+    def __call__(self, name: bytes) -> bytes:
+        if not self.paired:
+            self.count += self.step
+            return b"%d" % self.count
+        if name != self.last_name:
+            self.count += self.step
+            self.last_name = name
+        return b"%d " % self.count
+
+
+class FastqOutput:
+    """Write SAM records as compressed fastq, routing mates to separate files"""
+
+    def __init__(
+        self,
+        paths: list[str],
+        paired: bool,
+        compression: str = "gzip",
+        level: int = 6,
+        threads: int = 1,
+        rename: bool = False,
+        rename_start: int = 1,
+        rename_step: int = 1,
+    ):
+        self.paths, self.paired = paths, paired
+        self.rename = Renamer(paired, rename_start, rename_step) if rename else None
+        self.writers = [
+            compress.open_writer(path, compression, level, threads) for path in paths
+        ]
+
+    def write(self, name: bytes, flag: int, seq: bytes, qual: bytes) -> None:
+        if self.rename:
+            name = self.rename(name)
+        writer = self.writers[-1] if flag & 128 else self.writers[0]
+        writer.write(format_fastq(name, flag, seq, qual, self.paired))
+
+    def write_sam(self, line: bytes) -> None:
+        fields = line.rstrip(b"\r\n").split(b"\t", 11)
+        self.write(fields[0], int(fields[1]), fields[9], fields[10])
+
+    def close(self) -> None:
+        for writer in self.writers:
+            writer.close()
+
+
+class BamOutput:
+    """Write SAM records as unaligned BAM with parallel BGZF compression, or as CRAM
+    by piping SAM through samtools. Mates share one file"""
+
+    def __init__(
+        self,
+        path: str,
+        paired: bool,
+        level: int = 6,
+        threads: int = 1,
+        rename: bool = False,
+        rename_start: int = 1,
+        rename_step: int = 1,
+        cram: bool = False,
+    ):
+        self.paths, self.paired, self.process = [path], paired, None
+        self.rename = Renamer(paired, rename_start, rename_step) if rename else None
+        if cram:
+            self.process = subprocess.Popen(
+                ["samtools", "view", "-C", "--no-PG", "-@", str(threads)]
+                + ["-o", str(path), "-"],
+                stdin=subprocess.PIPE,
+            )
+            self.writer = self.process.stdin
+            self.writer.write(bam.SAM_HEADER)
+        else:
+            self.writer = compress.open_writer(path, "bgzf", level, threads)
+            self.writer.write(bam.encode_header())
+
+    def write(self, name: bytes, flag: int, seq: bytes, qual: bytes) -> None:
+        if self.rename:
+            name = self.rename(name).rstrip()
+        if flag & 16:
+            seq, qual = seq.translate(REVCOMP)[::-1], qual[::-1]
+        if self.paired:
+            flag = 77 if flag & 64 else 141
+        else:
+            flag = 4
+        if self.process:
+            self.writer.write(
+                b"%b\t%d\t*\t0\t0\t*\t*\t0\t0\t%b\t%b\n" % (name, flag, seq, qual)
+            )
+        else:
+            self.writer.write(bam.encode_record(name, flag, seq, qual))
+
+    def write_sam(self, line: bytes) -> None:
+        fields = line.rstrip(b"\r\n").split(b"\t", 11)
+        self.write(fields[0], int(fields[1]), fields[9], fields[10])
+
+    def close(self) -> None:
+        self.writer.close()
+        if self.process and self.process.wait():
+            raise subprocess.CalledProcessError(self.process.returncode, "samtools")
+
+
+def open_output(
+    paths: list[str], paired: bool, output_format: str = "fastq", **kwargs
+) -> FastqOutput | BamOutput:
+    """Open fastq output, or a single BAM or CRAM file ignoring compression"""
+    if output_format == "fastq":
+        return FastqOutput(paths, paired, **kwargs)
+    kwargs.pop("compression", None)
+    return BamOutput(paths[0], paired, cram=output_format == "cram", **kwargs)
+
+
+class ReorderBuffer:
+    """Restore input order of records named by ordinal, holding at most window
+    reads. Reads are complete once all of their records have been seen, whether
+    or not any were kept. When the window fills, the earliest pending read is
+    released regardless, bounding memory should a read never arrive"""
+
+    def __init__(self, emit, records_per_read: int = 1, window: int = REORDER_WINDOW):
+        self.emit = emit
+        self.records_per_read = records_per_read
+        self.window = window
+        self.next = 0
+        self.pending = {}  # Ordinal: [records seen, records kept]
+        self.overflows = 0
+
+    def add(self, ordinal: int, record: bytes | None = None) -> None:
+        if ordinal == self.next and self.records_per_read == 1:  # Fast path
+            if record is not None:
+                self.emit(record)
+            self.next += 1
+            if self.pending:
+                self.release()
+            return
+        entry = self.pending.get(ordinal)
+        if entry is None:
+            entry = self.pending[ordinal] = [0, []]
+        entry[0] += 1
+        if record is not None:
+            entry[1].append(record)
+        if ordinal == self.next:
+            self.release()
+        if len(self.pending) > self.window:
+            self.overflows += 1
+            self.next = min(self.pending)
+            self.release(force=True)
+
+    def release(self, force: bool = False) -> None:
+        while (entry := self.pending.get(self.next)) and (
+            force or entry[0] == self.records_per_read
+        ):
+            del self.pending[self.next]
+            for record in entry[1]:
+                self.emit(record)
+            self.next += 1
+            force = False
+
+    def close(self) -> None:
+        for ordinal in sorted(self.pending):
+            for record in self.pending[ordinal][1]:
+                self.emit(record)
+        self.pending.clear()
+        if self.overflows:
+            print(
+                f"Reorder window of {self.window} reads exceeded {self.overflows}"
+                " times, output order may differ from input order",
+                file=sys.stderr,
+            )
+
+
+def bypass_to_sam(fh: BinaryIO, paired: bool) -> Iterator[bytes]:
+    """Yield unaligned SAM records for fastq reads diverted around the aligner"""
+    flags = (77, 141) if paired else (4,)
+    for i, (name, seq, qual) in enumerate(read_fastq(fh)):
+        flag = flags[i % len(flags)]
+        yield b"%b\t%d\t*\t0\t0\t*\t*\t0\t0\t%b\t%b\n" % (name, flag, seq, qual)
+
+
+def filter_sam(
+    sam: BinaryIO,
+    paired: bool,
+    count_paths: tuple[str, str],
+    sam_out: BinaryIO | None = None,
+    fastq_out: FastqOutput | None = None,
+    reorder_window: int = 0,
+    bypass_path: Path | None = None,
+    timings_path: Path | None = None,
+    progress: ProgressReporter | None = None,
+) -> None:
+    """Count primary records, drop aligned reads and count remaining records,
+    writing them either as SAM for further processing or directly as fastq.
+    With reorder_window, read names carry input ordinals added by number(),
+    which are removed while restoring input order. Reads diverted around the
+    aligner by screen() are read from bypass_path and treated as unaligned.
+    Input without a SAM header means the aligner failed, so is an error"""
+    counts, bytes_in, header = [0, 0], 0, False
+    emit = fastq_out.write_sam if fastq_out else sam_out.write
+    reorder = (
+        ReorderBuffer(emit, 2 if paired else 1, reorder_window)
+        if reorder_window
+        else None
+    )
+    lock, n_mates = threading.Lock(), 2 if paired else 1
+
+    def process(line: bytes) -> None:
+        flag = int(line.split(b"\t", 2)[1])
+        if flag & 2304:  # Secondary or supplementary
+            return
+        counts[0] += 1
+        if reorder:
+            sep = line.index(TAG_SEP)
+            ordinal, line = int(line[:sep]), line[sep + 1 :]
+        if is_unaligned(flag, paired):
+            counts[1] += 1
+            if reorder:
+                reorder.add(ordinal, line)
+            else:
+                emit(line)
+        elif reorder:
+            reorder.add(ordinal)
+
+    def process_mates(mates: list[bytes]) -> None:
+        with lock:  # Keep mates adjacent, as output and renaming expect
+            for line in mates:
+                process(line)
+
+    def process_bypass() -> None:
+        with open(bypass_path, "rb") as fh:
+            lines = bypass_to_sam(fh, paired)
+            for mates in zip(*[lines] * n_mates):
+                process_mates(mates)
+
+    if bypass_path:  # Merge whole reads or pairs from either source
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            bypassed = executor.submit(process_bypass)
+            mates = []
+            for line in sam:
+                bytes_in += len(line)
+                if line.startswith(b"@"):
+                    header = True
+                elif not int(line.split(b"\t", 2)[1]) & 2304:  # Primary only
+                    mates.append(line)
+                    if len(mates) == n_mates:
+                        process_mates(mates)
+                        mates.clear()
+                        if progress and not counts[0] & PROGRESS_CHECK_MASK:
+                            progress.update(counts[0])
+            process_mates(mates)
+            bypassed.result()
+    else:  # Skip locking
+        for line in sam:
+            bytes_in += len(line)
+            if not line.startswith(b"@"):
+                process(line)
+                if progress and not counts[0] & PROGRESS_CHECK_MASK:
+                    progress.update(counts[0])
+            else:
+                header = True
+    if not header:
+        raise ValueError("No SAM header received, so the aligner failed")
+    if progress:
+        progress.update(counts[0], force=True)
+    if reorder:
+        reorder.close()
+    if fastq_out:
+        fastq_out.close()
+    else:
+        sam_out.flush()
+    write_counts(*counts, count_paths)
+    if timings_path:
+        bytes_out = files_size(fastq_out.paths) if fastq_out else None
+        write_timing(
+            timings_path, stage="filter", bytes_in=bytes_in, bytes_out=bytes_out
+        )
+
+
+def sam_to_fastq(sam: BinaryIO, fastq_out: FastqOutput) -> None:
+    for line in sam:
+        if not line.startswith(b"@"):
+            fastq_out.write_sam(line)
+    fastq_out.close()
+
+
+def tag_name(name: bytes, sample: int) -> bytes:
+    return str(sample).encode() + TAG_SEP + name
+
+
+def untag_name(name: bytes) -> tuple[int, bytes]:
+    sample, _, name = name.partition(TAG_SEP)
+    return int(sample), name
+
+
+def read_input(
+    paths: list[Path], threads: int = 1, interleaved: bool = False
+) -> Iterator[tuple[bytes, list[tuple[bytes, bytes]]]]:
+    """Yield (name, [(seq, qual), ...]) for each read, or pair of mates, raising
+    ValueError if mates are missing or their names differ"""
+    if bam.detect_format(paths[0]) != "fastq":  # Mates are adjacent
+        with bam.open_alignments(paths[0], threads) as fh:
+            yield from bam.read_reads(fh)
+    elif interleaved:
+        with open_input(paths[0], threads) as fh:
+            records = read_fastq(fh)
+            for name, seq1, qual1 in records:
+                name2, seq2, qual2 = next(records, (None, None, None))
+                if name2 is None:
+                    raise ValueError(f"Mate of {name.decode()} is missing")
+                if name != name2:
+                    raise ValueError(f"Mates of {name.decode()} are not interleaved")
+                yield name, [(seq1, qual1), (seq2, qual2)]
+    elif len(paths) == 2:
+        with open_input(paths[0], threads) as fh1, open_input(paths[1], threads) as fh2:
+            for record1, record2 in itertools.zip_longest(
+                read_fastq(fh1), read_fastq(fh2)
+            ):
+                if not record1 or not record2:
+                    raise ValueError("fastq1 and fastq2 contain different read counts")
+                (name, seq1, qual1), (name2, seq2, qual2) = record1, record2
+                if name != name2:
+                    raise ValueError(
+                        f"Mate names {name.decode()} and {name2.decode()} differ"
+                    )
+                yield name, [(seq1, qual1), (seq2, qual2)]
+    else:
+        with open_input(paths[0], threads) as fh:
+            for name, seq, qual in read_fastq(fh):
+                yield name, [(seq, qual)]
+
+
+def write_read(out: BinaryIO, name: bytes, mates: list[tuple[bytes, bytes]]) -> int:
+    return sum(
+        out.write(b"@%b\n%b\n+\n%b\n" % (name, seq, qual)) for seq, qual in mates
+    )
+
+
+def number(
+    paths: list[Path],
+    out: BinaryIO,
+    timings_path: Path | None = None,
+    threads: int = 1,
+    interleaved: bool = False,
+) -> None:
+    """Stream fastq (interleaving mates) with read names prefixed by input ordinal"""
+    bytes_out = 0
+    for i, (name, mates) in enumerate(read_input(paths, threads, interleaved)):
+        bytes_out += write_read(out, tag_name(name, i), mates)
+    bytes_in = files_size(paths)
+    write_timing(timings_path, stage="input", bytes_in=bytes_in, bytes_out=bytes_out)
+
+
+screen_filter = None  # Loaded once by each screening process
+
+
+def load_screen_filter(path: Path) -> None:
+    global screen_filter
+    screen_filter = prefilter.KmerFilter.load(path)
+
+
+def screen_batch(batch: list[list[bytes]]) -> list[bool]:
+    """Whether each read's mates are host free, in a screening process"""
+    return [screen_filter.is_host_free(*seqs) for seqs in batch]
+
+
+def screen_reads(
+    reads: Iterator[tuple[bytes, list[tuple[bytes, bytes]]]],
+    filter_path: Path,
+    processes: int = 1,
+) -> Iterator[tuple[bytes, list[tuple[bytes, bytes]], bool]]:
+    """Yield (name, mates, host_free) in input order. Batches of reads are screened
+    on several processes, a bounded number of batches ahead of the output"""
+    if processes < 2:
+        kmer_filter = prefilter.KmerFilter.load(filter_path)
+        for name, mates in reads:
+            yield name, mates, kmer_filter.is_host_free(*(seq for seq, _ in mates))
+        return
+    pending = deque()
+    # Fork every worker before reads, and so any input threads, are started
+    with multiprocessing.get_context("fork").Pool(
+        processes, load_screen_filter, (filter_path,)
+    ) as pool:
+        while batch := list(itertools.islice(reads, SCREEN_BATCH_READS)):
+            seqs = [[seq for seq, _ in mates] for _, mates in batch]
+            pending.append((batch, pool.apply_async(screen_batch, (seqs,))))
+            if len(pending) > 2 * processes:
+                batch, result = pending.popleft()
+                for (name, mates), host_free in zip(batch, result.get()):
+                    yield name, mates, host_free
+        for batch, result in pending:
+            for (name, mates), host_free in zip(batch, result.get()):
+                yield name, mates, host_free
+
+
+def screen(
+    paths: list[Path],
+    out: BinaryIO,
+    filter_path: Path,
+    bypass_path: Path,
+    numbered: bool = False,
+    timings_path: Path | None = None,
+    threads: int = 1,
+    interleaved: bool = False,
+    processes: int = 1,
+) -> None:
+    """Stream fastq (interleaving mates) to the aligner, diverting reads without
+    sampled host k-mers to bypass_path. Optionally number reads like number()"""
+    bytes_out = bytes_bypassed = 0
+    reads = read_input(paths, threads, interleaved)
+    with open(bypass_path, "wb") as bypass:
+        for i, (name, mates, host_free) in enumerate(
+            screen_reads(reads, filter_path, processes)
+        ):
+            if numbered:
+                name = tag_name(name, i)
+            if host_free:
+                bytes_bypassed += write_read(bypass, name, mates)
+            else:
+                bytes_out += write_read(out, name, mates)
+    write_timing(
+        timings_path,
+        stage="input",
+        bytes_in=files_size(paths),
+        bytes_out=bytes_out,
+        bytes_bypassed=bytes_bypassed,
+    )
+
+
+def shard(
+    paths: list[Path],
+    outs: list[Path],
+    progress: ProgressReporter | None = None,
+    threads: int = 1,
+    interleaved: bool = False,
+    chunk_size: int = SHARD_CHUNK_SIZE,
+) -> None:
+    """Deal chunks of whole reads (interleaving mates) to whichever output pipe is
+    ready for more, so that faster shard pipelines take a larger share. Writes are
+    non-blocking, so a chunk part-written to a slow shard holds up no other shard"""
+    fds = [os.open(path, os.O_WRONLY) for path in outs]
+    for fd in fds:
+        os.set_blocking(fd, False)
+    pending = {fd: memoryview(b"") for fd in fds}  # Unwritten rest of each chunk
+    dealt = dict.fromkeys(fds, 0)
+
+    def write_ready(waiting: list[int]) -> list[int]:
+        """Wait for waiting pipes with room, write what they take, and return those
+        with no chunk left to write"""
+        _, writable, _ = select.select([], waiting, [])
+        for fd in writable:
+            if pending[fd]:
+                try:
+                    pending[fd] = pending[fd][os.write(fd, pending[fd]) :]
+                except BlockingIOError:
+                    pass
+        return [fd for fd in writable if not pending[fd]]
+
+    def deal(data: bytes) -> None:
+        while not (ready := write_ready(fds)):
+            pass
+        fd = min(ready, key=dealt.__getitem__)  # Share between equally ready pipes
+        pending[fd], dealt[fd] = memoryview(data), dealt[fd] + len(data)
+
+    try:
+        chunk, size, n_records = [], 0, 0
+        for name, mates in read_input(paths, threads, interleaved):
+            record = b"".join(b"@%b\n%b\n+\n%b\n" % (name, *mate) for mate in mates)
+            chunk.append(record)
+            size += len(record)
+            n_records += len(mates)
+            if size >= chunk_size:
+                deal(b"".join(chunk))
+                chunk, size = [], 0
+                if progress:
+                    progress.update(n_records)
+        if chunk:
+            deal(b"".join(chunk))
+        while busy := [fd for fd in fds if pending[fd]]:
+            write_ready(busy)  # Only these, as drained pipes stay writable
+        if progress:
+            progress.update(n_records, force=True)
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def cat(
+    paths: list[Path], out: BinaryIO, threads: int = 1, interleaved: bool = False
+) -> None:
+    """Stream reads from fastq, BAM or CRAM as fastq, interleaving mates"""
+    for name, mates in read_input(paths, threads, interleaved):
+        write_read(out, name, mates)
+
+
+def decompress(path: Path, out: BinaryIO, threads: int = 1) -> None:
+    """Stream a fastq[.gz] file's contents, decompressing on threads"""
+    with open_input(path, threads) as fh:
+        shutil.copyfileobj(fh, out, compress.BLOCK_SIZE)
+
+
+def concat(paths: list[Path], out_path: Path) -> None:
+    """Join shard outputs in order into out_path, removing them. Gzip and zstd members
+    and BGZF blocks concatenate as they are, apart from interior BGZF EOF markers"""
+    eof = compress.BGZF_EOF
+    os.replace(paths[0], out_path)
+    with open(out_path, "r+b") as out:
+        for path in paths[1:]:
+            size = out.seek(0, os.SEEK_END)
+            if size >= len(eof):
+                out.seek(size - len(eof))
+                if out.read() == eof:
+                    out.truncate(size - len(eof))
+                    out.seek(size - len(eof))
+            with open(path, "rb") as fh:
+                shutil.copyfileobj(fh, out, 2**20)
+            os.unlink(path)
+
+
+def tag(manifest: dict, out: BinaryIO) -> None:
+    """Concatenate samples into one fastq stream, tagging names with sample index"""
+    for i, sample in enumerate(manifest["samples"]):
+        paths = [sample[key] for key in ("fastq1", "fastq2") if key in sample]
+        interleaved = manifest["paired"] and len(paths) == 1
+        for name, mates in read_input(paths, interleaved=interleaved):
+            write_read(out, tag_name(name, i), mates)
+
+
+class WriterPool:
+    """Bounded pool of writers sharing compression threads, reopening evicted
+    files in append mode"""
+
+    def __init__(
+        self,
+        compression: str = "gzip",
+        level: int = 6,
+        threads: int = 1,
+        max_open: int = MAX_OPEN_WRITERS,
+    ):
+        self.compression, self.level, self.threads = compression, level, threads
+        self.max_open = max_open
+        self.open_writers = OrderedDict()
+        self.seen = set()
+        self.executor = (
+            concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+            if threads > 1
+            else None
+        )
+
+    def get(self, path: str) -> BinaryIO:
+        if path in self.open_writers:
+            self.open_writers.move_to_end(path)
+            return self.open_writers[path]
+        if len(self.open_writers) >= self.max_open:
+            _, writer = self.open_writers.popitem(last=False)
+            writer.close()
+        mode = "ab" if path in self.seen else "wb"
+        self.seen.add(path)
+        writer = compress.open_writer(
+            path, self.compression, self.level, self.threads, mode, self.executor
+        )
+        self.open_writers[path] = writer
+        return writer
+
+    def close(self) -> None:
+        for writer in self.open_writers.values():
+            writer.close()
+        self.open_writers.clear()
+        if self.executor:
+            self.executor.shutdown()
+
+
+def demux(
+    manifest: dict, sam: BinaryIO, progress: ProgressReporter | None = None
+) -> None:
+    """Count, filter and write fastq records per sample from tagged SAM, failing
+    without a SAM header as filter_sam does"""
+    samples = manifest["samples"]
+    paired, rename = manifest["paired"], manifest["rename"]
+    reads_in = [0] * len(samples)
+    reads_out = [0] * len(samples)
+    renamers = [Renamer(paired) for _ in samples]
+    n_reads = 0
+    pool = WriterPool(
+        manifest["compression"],
+        manifest["compression_level"],
+        manifest["compression_threads"],
+    )
+    for sample in samples:  # Create outputs even for samples with no reads left
+        for key in ("fastq1_out_path", "fastq2_out_path"):
+            if sample.get(key):
+                pool.get(sample[key])
+    header = False
+    for line in sam:
+        if line.startswith(b"@"):
+            header = True
+            continue
+        fields = line.rstrip(b"\r\n").split(b"\t", 11)
+        flag = int(fields[1])
+        if flag & 2304:  # Secondary or supplementary
+            continue
+        i, name = untag_name(fields[0])
+        reads_in[i] += 1
+        n_reads += 1
+        if progress and not n_reads & PROGRESS_CHECK_MASK:
+            progress.update(n_reads)
+        if not is_unaligned(flag, paired):
+            continue
+        reads_out[i] += 1
+        if rename:
+            name = renamers[i](name)
+        sample = samples[i]
+        if flag & 128 and "fastq2_out_path" in sample:
+            writer = pool.get(sample["fastq2_out_path"])
+        else:  # Single reads, first mates, or both mates if interleaving output
+            writer = pool.get(sample["fastq1_out_path"])
+        writer.write(format_fastq(name, flag, fields[9], fields[10], paired))
+    if not header:
+        raise ValueError("No SAM header received, so the aligner failed")
+    if progress:
+        progress.update(n_reads, force=True)
+    pool.close()
+    for sample, n_in, n_out in zip(samples, reads_in, reads_out):
+        write_counts(
+            n_in, n_out, (sample["count_before_path"], sample["count_after_path"])
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m hostile.stream")
+    stages = parser.add_subparsers(dest="stage", required=True)
+    filter_parser = stages.add_parser("filter")
+    filter_parser.add_argument("--reads-in", required=True)
+    filter_parser.add_argument("--reads-out", required=True)
+    filter_parser.add_argument("--reorder-window", type=int, default=0)
+    filter_parser.add_argument("--bypass", type=Path)
+    filter_parser.add_argument("--timings", type=Path)
+    filter_parser.add_argument("--progress", action="store_true")
+    fastq_parser = stages.add_parser("fastq")
+    for stage_parser in (filter_parser, fastq_parser):
+        stage_parser.add_argument("--paired", action="store_true")
+        stage_parser.add_argument("--out1")
+        stage_parser.add_argument("--out2")
+        stage_parser.add_argument("--compression", default="gzip")
+        stage_parser.add_argument("--compression-level", type=int, default=6)
+        stage_parser.add_argument("--compression-threads", type=int, default=1)
+        stage_parser.add_argument("--rename", action="store_true")
+        stage_parser.add_argument("--rename-start", type=int, default=1)
+        stage_parser.add_argument("--rename-step", type=int, default=1)
+        stage_parser.add_argument(
+            "--output-format", choices=bam.FORMATS, default="fastq"
+        )
+    number_parser = stages.add_parser("number")
+    number_parser.add_argument("fastqs", type=Path, nargs="+")
+    number_parser.add_argument("--timings", type=Path)
+    number_parser.add_argument("--threads", type=int, default=1)
+    screen_parser = stages.add_parser("screen")
+    screen_parser.add_argument("fastqs", type=Path, nargs="+")
+    screen_parser.add_argument("--filter", type=Path, required=True)
+    screen_parser.add_argument("--bypass", type=Path, required=True)
+    screen_parser.add_argument("--number", action="store_true")
+    screen_parser.add_argument("--timings", type=Path)
+    screen_parser.add_argument("--threads", type=int, default=1)
+    screen_parser.add_argument("--processes", type=int, default=1)
+    shard_parser = stages.add_parser("shard")
+    shard_parser.add_argument("fastqs", type=Path, nargs="+")
+    shard_parser.add_argument("--out", type=Path, action="append", required=True)
+    shard_parser.add_argument("--progress", action="store_true")
+    shard_parser.add_argument("--threads", type=int, default=1)
+    shard_parser.add_argument("--chunk-size", type=int, default=SHARD_CHUNK_SIZE)
+    cat_parser = stages.add_parser("cat")
+    cat_parser.add_argument("fastqs", type=Path, nargs="+")
+    cat_parser.add_argument("--threads", type=int, default=1)
+    for stage_parser in (number_parser, screen_parser, shard_parser, cat_parser):
+        stage_parser.add_argument("--interleaved", action="store_true")
+    decompress_parser = stages.add_parser("decompress")
+    decompress_parser.add_argument("fastq", type=Path)
+    decompress_parser.add_argument("--threads", type=int, default=1)
+    concat_parser = stages.add_parser("concat")
+    concat_parser.add_argument("parts", type=Path, nargs="+")
+    concat_parser.add_argument("--out", type=Path, required=True)
+    time_parser = stages.add_parser("time")
+    time_parser.add_argument("--label", required=True)
+    time_parser.add_argument("--out", type=Path, required=True)
+    time_parser.add_argument("argv", nargs=argparse.REMAINDER)
+    stages.add_parser("tag").add_argument("manifest", type=Path)
+    demux_parser = stages.add_parser("demux")
+    demux_parser.add_argument("manifest", type=Path)
+    demux_parser.add_argument("--progress", action="store_true")
+    args = parser.parse_args()
+    if args.stage in ("filter", "fastq") and args.out1:
+        fastq_out = open_output(
+            [path for path in (args.out1, args.out2) if path],
+            paired=args.paired,
+            output_format=args.output_format,
+            compression=args.compression,
+            level=args.compression_level,
+            threads=args.compression_threads,
+            rename=args.rename,
+            rename_start=args.rename_start,
+            rename_step=args.rename_step,
+        )
+    else:
+        fastq_out = None
+    if args.stage == "filter":
+        filter_sam(
+            sys.stdin.buffer,
+            paired=args.paired,
+            count_paths=(args.reads_in, args.reads_out),
+            sam_out=sys.stdout.buffer,
+            fastq_out=fastq_out,
+            reorder_window=args.reorder_window,
+            bypass_path=args.bypass,
+            timings_path=args.timings,
+            progress=ProgressReporter() if args.progress else None,
+        )
+    elif args.stage == "fastq":
+        sam_to_fastq(sys.stdin.buffer, fastq_out)
+    elif args.stage == "number":
+        number(
+            args.fastqs,
+            sys.stdout.buffer,
+            args.timings,
+            args.threads,
+            args.interleaved,
+        )
+        sys.stdout.buffer.flush()
+    elif args.stage == "screen":
+        screen(
+            args.fastqs,
+            sys.stdout.buffer,
+            args.filter,
+            args.bypass,
+            args.number,
+            args.timings,
+            args.threads,
+            args.interleaved,
+            args.processes,
+        )
+        sys.stdout.buffer.flush()
+    elif args.stage == "shard":
+        shard(
+            args.fastqs,
+            args.out,
+            progress=ProgressReporter() if args.progress else None,
+            threads=args.threads,
+            interleaved=args.interleaved,
+            chunk_size=args.chunk_size,
+        )
+    elif args.stage == "cat":
+        cat(args.fastqs, sys.stdout.buffer, args.threads, args.interleaved)
+        sys.stdout.buffer.flush()
+    elif args.stage == "decompress":
+        decompress(args.fastq, sys.stdout.buffer, args.threads)
+        sys.stdout.buffer.flush()
+    elif args.stage == "concat":
+        concat(args.parts, args.out)
+    elif args.stage == "tag":
+        tag(json.loads(args.manifest.read_text()), sys.stdout.buffer)
+        sys.stdout.buffer.flush()
+    elif args.stage == "demux":
+        demux(
+            json.loads(args.manifest.read_text()),
+            sys.stdin.buffer,
+            progress=ProgressReporter() if args.progress else None,
+        )
+    elif args.stage == "time":
+        argv = args.argv[1:] if args.argv[:1] == ["--"] else args.argv
+        sys.exit(time_stage(args.label, args.out, argv))
+
+
+if __name__ == "__main__":
+    main()
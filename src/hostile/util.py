@@ -1,14 +1,35 @@
+import collections
 import concurrent.futures
+import functools
+import gzip
+import hashlib
+import io
+import json
 import logging
+import os
 import platform
+import shlex
+import shutil
 import subprocess
 import tarfile
+import tempfile
+import threading
+import time
 
 from pathlib import Path
+from typing import Callable, Iterator
 
-import httpx
+from hostile import bam, compress, stream
 
-from tqdm import tqdm
+
+CHECKSUMS_FN = "SHA256SUMS"
+DOWNLOAD_CHUNK_SIZE = 2**26
+DOWNLOAD_WORKERS = 8
+STDERR_TAIL_LINES = 200
+STDERR_MARKERS = (
+    "overall alignment rate",  # Bowtie2
+    "Peak RSS",  # Minimap2
+)
 
 
 def run(cmd: str, cwd: Path | None = None) -> subprocess.CompletedProcess:
@@ -17,37 +38,76 @@ def run(cmd: str, cwd: Path | None = None) -> subprocess.CompletedProcess:
     )
 
 
-def run_bash(cmd: str, cwd: Path | None = None) -> subprocess.CompletedProcess:
-    """Needed because /bin/sh does not support process substitution used for tee"""
-    return subprocess.run(
-        ["/bin/bash", "-c", cmd], cwd=cwd, check=True, text=True, capture_output=True
+def run_bash(
+    cmd: str,
+    cwd: Path | None = None,
+    tail_lines: int = STDERR_TAIL_LINES,
+    on_progress: Callable[[int], None] | None = None,
+    stdout: bool = False,
+) -> subprocess.CompletedProcess:
+    """Run pipelines with bash rather than /bin/sh for consistent behaviour.
+    Stderr is logged line by line as it arrives. Only its tail and the last line
+    containing each of STDERR_MARKERS are kept, so memory use stays constant.
+    Progress lines from hostile's stages are passed to on_progress instead.
+    Stdin is inherited, as is stdout if requested, for streaming pipelines"""
+    tail = collections.deque(maxlen=tail_lines)
+    markers = {}
+    with subprocess.Popen(
+        ["/bin/bash", "-c", cmd],
+        cwd=cwd,
+        stdout=None if stdout else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace",
+    ) as process:
+        for line in process.stderr:
+            if line.startswith(stream.PROGRESS_PREFIX):
+                if on_progress:
+                    on_progress(int(line.removeprefix(stream.PROGRESS_PREFIX)))
+                continue
+            logging.debug(line.rstrip())
+            tail.append(line)
+            for marker in STDERR_MARKERS:
+                if marker in line:
+                    markers[marker] = line
+    stderr = "".join(
+        [line for line in markers.values() if line not in tail] + list(tail)
     )
+    if process.returncode:
+        raise subprocess.CalledProcessError(
+            process.returncode, process.args, output="", stderr=stderr
+        )
+    return subprocess.CompletedProcess(process.args, 0, stdout="", stderr=stderr)
 
 
 def handle_alignment_exceptions(exception: subprocess.CalledProcessError) -> None:
-    """Catch samtools view's non-zero exit if all input reads are contaminated"""
-    alignment_successful = False
-    stream_empty = False
-    if 'Failed to read header for "-"' in exception.stderr:
-        stream_empty = True
-    if "overall alignment rate" in exception.stderr:  # Bowtie2
-        alignment_successful = True
-    if "Peak RSS" in exception.stderr:  # Minimap2
-        alignment_successful = True
-    logging.debug(f"{stream_empty=} {alignment_successful=}")
-    if alignment_successful and stream_empty:  # Non zero exit but actually fine
-        pass
-    else:
-        print(f"Hostile encountered a problem. Stderr below")
-        print(f"{exception.stderr}")
-        raise exception
+    """Show the failed pipeline's stderr. Pipelines run with pipefail, so any
+    failing stage, including the aligner, fails the whole pipeline"""
+    logging.error(f"Hostile encountered a problem. Stderr below\n{exception.stderr}")
+    raise exception
 
 
 def run_bash_parallel(
-    cmds: list[str], description: str = "Processing"
+    cmds: list[str],
+    description: str = "Processing",
+    max_workers: int = 1,
+    on_progress: Callable[[int, int], None] | None = None,
+    stdout: bool = False,
 ) -> dict[int, subprocess.CompletedProcess]:
-    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as x:
-        futures = [x.submit(run_bash, cmd) for cmd in cmds]
+    """Run pipelines concurrently, passing (command index, records processed) to
+    on_progress as stages report them"""
+    from tqdm import tqdm
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as x:
+        futures = [
+            x.submit(
+                run_bash,
+                cmd,
+                on_progress=functools.partial(on_progress, i) if on_progress else None,
+                stdout=stdout,
+            )
+            for i, cmd in enumerate(cmds)
+        ]
         results = {}
         for future in tqdm(
             concurrent.futures.as_completed(futures),
@@ -63,14 +123,153 @@ def run_bash_parallel(
         return results
 
 
+def get_cpu_count() -> int:
+    """Cores available to this process, respecting CPU affinity where supported"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_memory_bytes() -> int:
+    """Total physical memory"""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def make_manifest_path(out_dir: Path) -> Path:
+    """Create a uniquely named manifest file for batch pipeline stages"""
+    fd, path = tempfile.mkstemp(prefix=".hostile-batch-", suffix=".json", dir=out_dir)
+    os.close(fd)
+    return Path(path)
+
+
+def quote(path: Path | str) -> str:
+    """Quote a path for bash, whatever characters it contains"""
+    return shlex.quote(str(path))
+
+
+def resolve_input(path: Path) -> Path:
+    """Absolute input path, leaving stdin as -"""
+    return Path(path) if compress.is_stdio(path) else Path(path).resolve()
+
+
+def input_exists(path: Path) -> bool:
+    return compress.is_stdio(path) or Path(path).is_file()
+
+
 def fastq_path_to_stem(fastq_path: Path) -> str:
+    if compress.is_stdio(fastq_path):  # Unique, so concurrent runs can share out_dir
+        return f"stdin-{os.getpid()}"
     fastq_path = Path(fastq_path)
     stem = fastq_path.name.removesuffix(".gz")
-    for suffix in (".fastq", ".fq"):
+    for suffix in (".fastq", ".fq", ".bam", ".cram"):
         stem = stem.removesuffix(suffix)
     return stem
 
 
+def fastq_out_path(
+    out_dir: Path,
+    stem: str,
+    label: str,
+    compression: str = "gzip",
+    output_format: str = "fastq",
+) -> Path:
+    """Output fastq path, e.g. reads.clean_1.fastq.gz, or BAM/CRAM path"""
+    if output_format != "fastq":
+        return Path(out_dir) / f"{stem}.{label}.{output_format}"
+    return Path(out_dir) / f"{stem}.{label}.fastq{compress.SUFFIXES[compression]}"
+
+
+def paired_out_paths(
+    out_dir: Path,
+    fastq1: Path,
+    fastq2: Path | None,
+    compression: str = "gzip",
+    output_format: str = "fastq",
+    stdout: bool = False,
+    interleave: bool = False,
+) -> tuple[Path, Path | None]:
+    """Output paths for paired reads. BAM, CRAM and stdout hold both mates in one
+    stream, as does interleaved fastq output"""
+    fastq1_stem = fastq_path_to_stem(fastq1)
+    if stdout:
+        return Path(compress.STDIO), None
+    if output_format != "fastq" or interleave:
+        return (
+            fastq_out_path(out_dir, fastq1_stem, "clean", compression, output_format),
+            None,
+        )
+    fastq2_stem = fastq_path_to_stem(fastq2) if fastq2 else fastq1_stem
+    return (
+        fastq_out_path(out_dir, fastq1_stem, "clean_1", compression),
+        fastq_out_path(out_dir, fastq2_stem, "clean_2", compression),
+    )
+
+
+def estimate_fastq_reads(path: Path, n_sample: int = 10_000) -> tuple[int, float]:
+    """Estimate the number of reads and their mean length from the first n_sample
+    reads and the size of the (compressed) file. Stdin cannot be estimated"""
+    if compress.is_stdio(path):
+        return 0, 0.0
+    size = Path(path).stat().st_size
+    n_reads = n_bases = 0
+    if bam.detect_format(path) != "fastq":
+        return estimate_bam_reads(path, n_sample)
+    with open(path, "rb") as raw:
+        fh = gzip.GzipFile(fileobj=raw) if raw.peek(2)[:2] == b"\x1f\x8b" else raw
+        for i, line in enumerate(fh):
+            if i % 4 == 1:
+                n_reads += 1
+                n_bases += len(line.rstrip())
+            elif i % 4 == 3 and n_reads >= n_sample:
+                break
+        else:  # Read the whole file
+            return n_reads, n_bases / max(1, n_reads)
+        consumed = raw.tell()
+    return round(n_reads * size / max(1, consumed)), n_bases / n_reads
+
+
+def estimate_bam_reads(path: Path, n_sample: int = 10_000) -> tuple[int, float]:
+    """Estimate reads and mean length in BAM like estimate_fastq_reads, counting
+    first mates only as it counts fastq1. CRAM is too compact to estimate from size"""
+    if bam.detect_format(path) == "cram":
+        return 0, 0.0
+    n_reads = n_bases = 0
+    with open(path, "rb") as raw, gzip.GzipFile(fileobj=raw) as fh:
+        for _, flag, seq, _ in bam.read_records(fh):
+            if flag & 128:
+                continue
+            n_reads += 1
+            n_bases += len(seq)
+            if n_reads >= n_sample:
+                break
+        else:
+            return n_reads, n_bases / max(1, n_reads)
+        consumed = raw.tell()
+    return round(n_reads * Path(path).stat().st_size / consumed), n_bases / n_reads
+
+
+def is_gzip(path: Path) -> bool:
+    if compress.is_stdio(path):  # Peeking would consume stdin
+        return False
+    with open(path, "rb") as fh:
+        return fh.read(2) == b"\x1f\x8b"
+
+
+def shard_path(path: Path, shard: int) -> Path:
+    """Hidden path alongside path for one shard's part of it"""
+    path = Path(path)
+    return path.with_name(f".{path.name}.shard{shard}")
+
+
+def pop_count_files(path: Path, shards: int = 1) -> int:
+    """Parse and remove a count file, or sum and remove those of its shards"""
+    paths = [shard_path(path, i) for i in range(shards)] if shards > 1 else [path]
+    count = sum(parse_count_file(path) for path in paths)
+    for path in paths:
+        path.unlink()
+    return count
+
+
 def parse_count_file(path: Path) -> int:
     try:
         with open(path, "r") as fh:
@@ -82,15 +281,27 @@ def parse_count_file(path: Path) -> int:
     return count
 
 
-def untar_file(input_path, output_path):
-    with tarfile.open(input_path) as fh:
-        fh.extractall(path=output_path)
+def parse_timings_file(path: Path) -> dict[str, dict[str, float | int]]:
+    """Merge per-stage measurements recorded by pipeline stages, keyed by stage"""
+    timings = {}
+    with open(path) as fh:
+        for line in fh:
+            fields = json.loads(line)
+            stage = fields.pop("stage")
+            timings.setdefault(stage, {}).update(
+                {k: v for k, v in fields.items() if v is not None}
+            )
+    return timings
+
 
+def download_stream(url: str, path: Path) -> None:
+    import httpx
+    from tqdm import tqdm
 
-def download(url: str, path: Path) -> None:
     with open(path, "wb") as fh:
-        with httpx.stream("GET", url) as response:
-            total = int(response.headers["Content-Length"])
+        with httpx.stream("GET", url, follow_redirects=True) as response:
+            response.raise_for_status()
+            total = int(response.headers.get("Content-Length", 0)) or None
             with tqdm(
                 total=total, unit_scale=True, unit_divisor=1024, unit="B"
             ) as progress:
@@ -103,7 +314,212 @@ def download(url: str, path: Path) -> None:
                     num_bytes_downloaded = response.num_bytes_downloaded
 
 
+def download_ranges(
+    url: str,
+    part_path: Path,
+    state_path: Path,
+    total: int,
+    etag: str,
+    chunk_size: int,
+    max_workers: int,
+) -> None:
+    """Fetch byte ranges concurrently into a preallocated file, recording finished
+    chunks in a state file so that an interrupted download can resume"""
+    import httpx
+    from tqdm import tqdm
+
+    chunks = [
+        (start, min(start + chunk_size, total) - 1)
+        for start in range(0, total, chunk_size)
+    ]
+    state = {"size": total, "etag": etag, "chunk_size": chunk_size, "done": []}
+    if part_path.exists() and state_path.exists():
+        saved_state = json.loads(state_path.read_text())
+        if all(saved_state.get(k) == state[k] for k in ("size", "etag", "chunk_size")):
+            state = saved_state
+            logging.info(f"Resuming download ({len(state['done'])}/{len(chunks)})")
+    if not state["done"]:
+        with open(part_path, "wb") as fh:
+            fh.truncate(total)
+    lock = threading.Lock()
+    done_bytes = sum(chunks[i][1] - chunks[i][0] + 1 for i in state["done"])
+    todo = [i for i in range(len(chunks)) if i not in state["done"]]
+    with tqdm(
+        total=total, initial=done_bytes, unit_scale=True, unit_divisor=1024, unit="B"
+    ) as progress, httpx.Client(follow_redirects=True, timeout=60) as client:
+
+        def fetch_chunk(i: int) -> None:
+            start, end = chunks[i]
+            headers = {"Range": f"bytes={start}-{end}"}
+            with client.stream("GET", url, headers=headers) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise RuntimeError(f"Server ignored range request for {url}")
+                with open(part_path, "r+b") as fh:
+                    fh.seek(start)
+                    for data in response.iter_bytes():
+                        fh.write(data)
+                        progress.update(len(data))
+            with lock:
+                state["done"].append(i)
+                state_path.write_text(json.dumps(state))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as x:
+            for future in concurrent.futures.as_completed(
+                [x.submit(fetch_chunk, i) for i in todo]
+            ):
+                future.result()
+
+
+def sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        while data := fh.read(2**20):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def download(
+    url: str,
+    path: Path,
+    sha256: str | None = None,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+    max_workers: int = DOWNLOAD_WORKERS,
+) -> None:
+    """Download in parallel byte ranges when the server supports them, resuming
+    from an existing .part file, and verify an optional SHA-256 checksum"""
+    import httpx
+
+    path = Path(path)
+    part_path = path.with_name(path.name + ".part")
+    state_path = path.with_name(path.name + ".part.json")
+    head = httpx.head(url, follow_redirects=True)
+    head.raise_for_status()
+    total = int(head.headers.get("Content-Length", 0))
+    start_time = time.perf_counter()
+    if head.headers.get("Accept-Ranges") == "bytes" and total > 0:
+        download_ranges(
+            url,
+            part_path,
+            state_path,
+            total=total,
+            etag=head.headers.get("ETag", ""),
+            chunk_size=chunk_size,
+            max_workers=max_workers,
+        )
+    else:
+        download_stream(url, part_path)
+    elapsed = time.perf_counter() - start_time
+    size_mb = part_path.stat().st_size / 1e6
+    logging.info(
+        f"Downloaded {size_mb:.1f}MB in {elapsed:.1f}s ({size_mb / elapsed:.1f}MB/s)"
+    )
+    if sha256:
+        if sha256_file(part_path) != sha256.lower():
+            part_path.unlink()
+            state_path.unlink(missing_ok=True)
+            raise RuntimeError(f"Checksum mismatch for {url}")
+        logging.info(f"Verified checksum ({sha256})")
+    os.replace(part_path, path)
+    state_path.unlink(missing_ok=True)
+
+
+class IterStream(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks"""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self.chunks = chunks
+        self.leftover = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.leftover:
+            try:
+                self.leftover = next(self.chunks)
+            except StopIteration:
+                return 0
+        n = min(len(buffer), len(self.leftover))
+        buffer[:n] = self.leftover[:n]
+        self.leftover = self.leftover[n:]
+        return n
+
+
+def download_and_untar(url: str, out_dir: Path, sha256: str | None = None) -> None:
+    """Extract a tar archive while it downloads, without storing the archive.
+    Members are written to temporary files and renamed into place only once the
+    whole archive has been received and its optional checksum verified"""
+    import httpx
+    from tqdm import tqdm
+
+    out_dir = Path(out_dir)
+    digest = hashlib.sha256()
+    tmp_paths = {}
+    start_time = time.perf_counter()
+    try:
+        with httpx.stream("GET", url, follow_redirects=True) as response:
+            response.raise_for_status()
+            total = int(response.headers.get("Content-Length", 0)) or None
+            with tqdm(
+                total=total, unit_scale=True, unit_divisor=1024, unit="B"
+            ) as progress:
+
+                def chunks() -> Iterator[bytes]:
+                    for chunk in response.iter_raw():
+                        digest.update(chunk)
+                        progress.update(len(chunk))
+                        yield chunk
+
+                stream = chunks()
+                fileobj = io.BufferedReader(IterStream(stream), 2**20)
+                with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+                    for member in tar:
+                        if not member.isfile():
+                            continue
+                        path = out_dir / Path(member.name).name  # No traversal
+                        tmp_paths[path] = path.with_name(path.name + ".part")
+                        with open(tmp_paths[path], "wb") as fh:
+                            shutil.copyfileobj(tar.extractfile(member), fh, 2**20)
+                for _ in stream:  # Hash any padding after the end of archive
+                    pass
+        size_mb = response.num_bytes_downloaded / 1e6
+        elapsed = time.perf_counter() - start_time
+        logging.info(
+            f"Downloaded and extracted {size_mb:.1f}MB in {elapsed:.1f}s"
+            f" ({size_mb / elapsed:.1f}MB/s)"
+        )
+        if sha256 and digest.hexdigest() != sha256.lower():
+            raise RuntimeError(f"Checksum mismatch for {url}")
+        for path, tmp_path in tmp_paths.items():
+            os.replace(tmp_path, path)
+    finally:
+        for tmp_path in tmp_paths.values():
+            tmp_path.unlink(missing_ok=True)
+
+
+def fetch_checksum(base_url: str, filename: str) -> str | None:
+    """Look up a file's SHA-256 in the sha256sum-format manifest published
+    alongside it, if any"""
+    import httpx
+
+    try:
+        response = httpx.get(f"{base_url}/{CHECKSUMS_FN}", follow_redirects=True)
+        response.raise_for_status()
+    except httpx.HTTPError:
+        logging.warning(f"No checksum manifest found, skipping verification")
+        return None
+    for line in response.text.splitlines():
+        checksum, _, name = line.strip().partition("  ")
+        if name.lstrip("*") == filename:
+            return checksum
+    logging.warning(f"No checksum published for {filename}, skipping verification")
+    return None
+
+
 def parse_bucket_objects(url: str) -> list[str]:
+    import httpx
+
     data = httpx.get(url).json()
     return [
         fn["name"] for fn in data["objects"] if fn["name"].endswith((".fa.gz", ".tar"))
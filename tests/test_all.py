@@ -1,11 +1,23 @@
+import concurrent.futures
+import functools
 import gzip
+import hashlib
+import http.server
+import io
+import json
+import os
 import shutil
 import subprocess
+import sys
+import tarfile
+import threading
+import urllib.error
+import urllib.request
 from pathlib import Path
 
 import pytest
 
-from hostile import lib
+from hostile import bam, compress, lib, pin, prefilter, server, stream, util
 
 data_dir = Path("tests/data")
 out_dir = Path("test_data")
@@ -540,3 +552,749 @@ def test_bowtie2_aligner_args():
     )
     assert stats[0]["reads_out"] == 8
     shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_minimap2_prebuilt_index():
+    shutil.rmtree(out_dir, ignore_errors=True)
+    out_dir.mkdir(parents=True)
+    shutil.copy(data_dir / "sars-cov-2/sars-cov-2.fasta.gz", out_dir)
+    aligner = lib.Aligner(
+        name="Minimap2",
+        short_name="mm2",
+        bin_path=Path("minimap2"),
+        cdn_base_url="",
+        data_dir=out_dir,
+        cmd=lib.ALIGNER.minimap2.value.cmd,
+        paired_cmd=lib.ALIGNER.minimap2.value.paired_cmd,
+        ref_archive_fn="sars-cov-2.fasta.gz",
+        idx_name="sars-cov-2.fasta.gz",
+        preset="map-ont",
+        paired_preset="sr",
+    )
+    aligner.check(using_custom_index=False)
+    mmi_path = aligner.mmi_path("map-ont")
+    assert mmi_path.exists() and not aligner.mmi_path("sr").exists()
+    cmd = aligner.gen_clean_cmd(
+        fastq=data_dir / "sars-cov-2_1_1.fastq",
+        out_dir=out_dir,
+        index=None,
+        rename=False,
+        reorder=False,
+        aligner_args="",
+        threads=1,
+        force=True,
+    )
+    assert f"'{mmi_path}'" in cmd and "-ax map-ont" in cmd
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_batch_fastqs_minimap2():
+    stats = lib.clean_fastqs(
+        fastqs=[
+            data_dir / "sars-cov-2_1_1.fastq",
+            data_dir / "human_1_1.fastq.gz",
+            data_dir / "tuberculosis_1_1.fastq",
+        ],
+        aligner=lib.ALIGNER.minimap2,
+        index=data_dir / "sars-cov-2/sars-cov-2.fasta.gz",
+        out_dir=out_dir,
+        force=True,
+        batch=True,
+    )
+    assert stats[0]["reads_out"] == 0
+    assert stats[1]["reads_out"] == 1
+    assert stats[2]["reads_out"] == 1
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_batch_paired_fastqs_bowtie2():
+    stats = lib.clean_paired_fastqs(
+        fastqs=[
+            (data_dir / "sars-cov-2_1_1.fastq", data_dir / "sars-cov-2_1_2.fastq"),
+            (data_dir / "human_1_1.fastq.gz", data_dir / "human_1_2.fastq.gz"),
+            (
+                data_dir / "sars-cov-2_100_1.fastq.gz",
+                data_dir / "sars-cov-2_100_2.fastq.gz",
+            ),
+        ],
+        aligner=lib.ALIGNER.bowtie2,
+        index=data_dir / "sars-cov-2/sars-cov-2",
+        rename=True,
+        out_dir=out_dir,
+        force=True,
+        batch=True,
+    )
+    assert stats[0]["reads_out"] == 0
+    assert stats[1]["reads_out"] == 2
+    assert stats[2]["reads_in"] == 100 and stats[2]["reads_out"] == 6
+    first_line = get_nth_line_of_gzip_file(out_dir / "human_1_1.clean_1.fastq.gz")
+    assert first_line == "@1 /1"
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_clean_many_cli():
+    shutil.rmtree(out_dir, ignore_errors=True)
+    out_dir.mkdir(parents=True)
+    samplesheet = out_dir / "samples.csv"
+    samplesheet.write_text(
+        "fastq1,fastq2\n"
+        f"{(data_dir / 'tuberculosis_1_1.fastq.gz').resolve()},"
+        f"{(data_dir / 'tuberculosis_1_2.fastq.gz').resolve()}\n"
+        f"{(data_dir / 'tuberculosis_2.fastq').resolve()},\n"
+    )
+    run(
+        f"hostile clean-many --samplesheet {samplesheet} --index {data_dir}/sars-cov-2/sars-cov-2 --aligner bowtie2 --out-dir {out_dir} --force"
+    )
+    assert (out_dir / "tuberculosis_1_1.clean_1.fastq.gz").exists()
+    assert (out_dir / "tuberculosis_2.clean.fastq.gz").exists()
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_concurrent_fastqs_bowtie2():
+    stats = lib.clean_fastqs(
+        fastqs=[
+            data_dir / "sars-cov-2_1_1.fastq",
+            data_dir / "human_1_1.fastq.gz",
+            data_dir / "tuberculosis_1_1.fastq",
+        ],
+        aligner=lib.ALIGNER.bowtie2,
+        index=data_dir / "sars-cov-2/sars-cov-2",
+        out_dir=out_dir,
+        force=True,
+        concurrency=3,
+    )
+    assert [s["reads_out"] for s in stats] == [0, 1, 1]
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_sharded_paired_fastqs_bowtie2(monkeypatch):
+    monkeypatch.setattr(stream, "SHARD_CHUNK_SIZE", 2**12)  # Spread reads over shards
+    stats = lib.clean_paired_fastqs(
+        fastqs=[
+            (
+                data_dir / "sars-cov-2_100_1.fastq.gz",
+                data_dir / "sars-cov-2_100_2.fastq.gz",
+            )
+        ],
+        aligner=lib.ALIGNER.bowtie2,
+        index=data_dir / "sars-cov-2/sars-cov-2",
+        rename=True,
+        out_dir=out_dir,
+        force=True,
+        shards=3,
+    )
+    assert stats[0]["reads_in"] == 100 and stats[0]["reads_out"] == 6
+    assert not list(out_dir.glob(".*shard*"))
+    with stream.open_input(stats[0]["fastq1_out_path"]) as fh:
+        names = [name for name, _, _ in stream.read_fastq(fh)]
+    assert len(set(names)) == 3  # Renaming strides keep names unique across shards
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_plan_resources():
+    plan = lib.plan_resources(
+        n_samples=96,
+        concurrency=0,
+        threads=48,
+        cpu_count=96,
+        memory=32 * 2**30,
+        index_memory=8 * 2**30,
+        shared_index=False,
+    )
+    assert plan.concurrency == 4  # Memory bound for unshared Minimap2 indexes
+    assert plan.aligner_threads + plan.compression_threads <= 96 // 4
+    plan = lib.plan_resources(
+        n_samples=2,
+        concurrency=4,
+        threads=4,
+        cpu_count=16,
+        memory=8 * 2**30,
+        index_memory=4 * 2**30,
+        shared_index=True,
+    )
+    assert plan.concurrency == 2 and plan.aligner_threads == 4
+    assert lib.plan_resources(10, 1, 5, 96, 0, 0, True) == lib.ResourcePlan(1, 5, 19)
+    plan = lib.plan_resources(1, 1, 0, 64, 0, 0, True)  # Whole node for one sample
+    assert plan.aligner_threads > 10
+    assert plan.aligner_threads + plan.compression_threads + lib.STREAM_CORES == 64
+    assert lib.plan_resources(1, 1, 0, 1, 0, 0, True) == lib.ResourcePlan(1, 1, 1)
+    plan = lib.plan_resources(1, 1, 4, 16, 0, 0, True, prefilter=True)
+    assert plan.aligner_threads == 4 and plan.screen_processes == 8  # Keeps pace
+    plan = lib.plan_resources(1, 1, 0, 16, 0, 0, True, prefilter=True)
+    assert plan.screen_processes == 1  # No spare cores, so check_prefilter_plan warns
+
+
+def test_stream_filter_counts():
+    sam = io.BytesIO(
+        b"@HD\tVN:1.6\n"
+        b"r1\t4\t*\t0\t0\t*\t*\t0\t0\tACGT\tIIII\n"
+        b"r2\t0\tref\t1\t42\t4M\t*\t0\t0\tACGT\tIIII\n"
+        b"r2\t256\tref\t9\t0\t4M\t*\t0\t0\t*\t*\n"
+        b"r3\t4\t*\t0\t0\t*\t*\t0\t0\tTTTT\tIIII\n"
+    )
+    out = io.BytesIO()
+    out_dir.mkdir(exist_ok=True, parents=True)
+    count_paths = (str(out_dir / "in.txt"), str(out_dir / "out.txt"))
+    stream.filter_sam(sam, paired=False, count_paths=count_paths, sam_out=out)
+    assert out.getvalue().count(b"\n") == 2 and b"r2" not in out.getvalue()
+    assert util.parse_count_file(Path(count_paths[0])) == 3
+    assert util.parse_count_file(Path(count_paths[1])) == 2
+    with pytest.raises(ValueError):  # A failed aligner writes no SAM header
+        stream.filter_sam(io.BytesIO(b""), False, count_paths, sam_out=io.BytesIO())
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+@pytest.mark.parametrize("compression", ["gzip", "bgzf", "zstd", "none"])
+@pytest.mark.parametrize("n_records", [0, 200_000])
+def test_block_writer_round_trip(compression, n_records):
+    if compression == "zstd":
+        zstandard = pytest.importorskip("zstandard")
+    out_dir.mkdir(exist_ok=True, parents=True)
+    path = out_dir / f"reads.fastq{compress.SUFFIXES[compression]}"
+    data = b"@read\nACGT\n+\nIIII\n" * n_records  # Spans several blocks, or none
+    with compress.open_writer(path, compression, level=1, threads=3) as writer:
+        for i in range(0, len(data), 1000):
+            writer.write(data[i : i + 1000])
+    if compression in ("gzip", "bgzf"):
+        assert gzip.decompress(path.read_bytes()) == data
+    elif compression == "zstd":
+        with zstandard.open(path, "rb") as fh:
+            assert fh.read() == data
+    else:
+        assert path.read_bytes() == data
+    if compression == "bgzf":
+        assert path.read_bytes().endswith(compress.BGZF_EOF)
+    if compression != "none":  # Even empty output is a valid member or frame
+        assert path.stat().st_size > 0
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+@pytest.mark.parametrize("compression", ["gzip", "bgzf", "none"])
+def test_parallel_decompression(tmp_path, compression):
+    data = b"".join(b"@r%d\nACGTACGT\n+\nIIIIIIII\n" % i for i in range(200_000))
+    path = tmp_path / f"reads.fastq{compress.SUFFIXES[compression]}"
+    with compress.open_writer(path, compression) as writer:
+        writer.write(data)
+    with compress.open_reader(path, threads=4) as fh:
+        assert fh.read() == data
+    truncated = tmp_path / "truncated.fastq.gz"
+    truncated.write_bytes(path.read_bytes()[:-100])
+    if compression == "bgzf":
+        with pytest.raises(EOFError):
+            compress.open_reader(truncated, threads=4).read()
+
+
+def test_pipeline_paths_are_quoted(tmp_path):
+    hostile_dir = tmp_path / "a'\"$(touch pwned)`touch pwned`"
+    hostile_dir.mkdir()
+    fastq = hostile_dir / "reads.fastq.gz"
+    fastq.write_bytes(gzip.compress(b"@r\nACGT\n+\nIIII\n"))
+    cmd, (fifo,), wait_cmd = lib.ALIGNER.bowtie2.value.gen_decompress_cmd(
+        [fastq], hostile_dir / ".reads", threads=2
+    )
+    subprocess.run(
+        ["/bin/bash", "-c", f"{cmd} cat {util.quote(fifo)} > /dev/null{wait_cmd}"],
+        cwd=tmp_path,
+        check=True,
+    )
+    assert not list(tmp_path.rglob("pwned")) and not Path(fifo).exists()
+
+
+def test_compression_level_cli():
+    run(
+        f"hostile clean --index {data_dir}/sars-cov-2/sars-cov-2 --fastq1 {data_dir}/tuberculosis_1_1.fastq.gz --fastq2 {data_dir}/tuberculosis_1_2.fastq.gz --out-dir {out_dir} --compression bgzf --compression-level 1 --force"
+    )
+    assert gzip.decompress(
+        (out_dir / "tuberculosis_1_1.clean_1.fastq.gz").read_bytes()
+    ).startswith(b"@Mycobacterium_tuberculosis/1")
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Stand-in for the CDN, adding byte range support to python -m http.server"""
+
+    def log_message(self, *args):
+        pass
+
+    def end_headers(self):
+        self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+    def do_GET(self):
+        if "Range" not in self.headers:
+            return super().do_GET()
+        data = Path(self.translate_path(self.path)).read_bytes()
+        start, end = self.headers["Range"].removeprefix("bytes=").split("-")
+        body = data[int(start) : int(end) + 1]
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def cdn():
+    handler = functools.partial(RangeRequestHandler, directory=".")
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_download_ranges_resume_and_checksum(cdn):
+    shutil.rmtree(out_dir, ignore_errors=True)
+    out_dir.mkdir(parents=True)
+    source = (data_dir / "human_1_1.fastq.gz").read_bytes()
+    sha256 = hashlib.sha256(source).hexdigest()
+    path = out_dir / "human_1_1.fastq.gz"
+    util.download(
+        f"{cdn}/{data_dir}/human_1_1.fastq.gz", path, sha256=sha256, chunk_size=100
+    )
+    assert path.read_bytes() == source
+    assert not Path(f"{path}.part").exists()
+
+    # Resume with the first chunk already present, and the rest corrupted
+    part_path, state_path = Path(f"{path}.part"), Path(f"{path}.part.json")
+    part_path.write_bytes(source[:100] + b"x" * (len(source) - 100))
+    state_path.write_text(
+        f'{{"size": {len(source)}, "etag": "", "chunk_size": 100, "done": [0]}}'
+    )
+    path.unlink()
+    util.download(
+        f"{cdn}/{data_dir}/human_1_1.fastq.gz", path, sha256=sha256, chunk_size=100
+    )
+    assert path.read_bytes() == source
+
+    with pytest.raises(RuntimeError):
+        util.download(f"{cdn}/{data_dir}/human_1_1.fastq.gz", path, sha256="0" * 64)
+    assert not Path(f"{path}.part").exists()
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_download_and_untar(cdn):
+    shutil.rmtree(out_dir, ignore_errors=True)
+    (out_dir / "extracted").mkdir(parents=True)
+    tar_path = out_dir / "sars-cov-2.tar"
+    with tarfile.open(tar_path, "w") as tar:
+        for path in (data_dir / "sars-cov-2").glob("*.bt2"):
+            tar.add(path, arcname=path.name)
+    sha256 = hashlib.sha256(tar_path.read_bytes()).hexdigest()
+    with pytest.raises(RuntimeError):
+        util.download_and_untar(
+            f"{cdn}/{tar_path}", out_dir / "extracted", sha256="0" * 64
+        )
+    assert not list((out_dir / "extracted").iterdir())
+    util.download_and_untar(f"{cdn}/{tar_path}", out_dir / "extracted", sha256)
+    for path in (data_dir / "sars-cov-2").glob("*.bt2"):
+        assert (out_dir / "extracted" / path.name).read_bytes() == path.read_bytes()
+    assert len(list((out_dir / "extracted").iterdir())) == 6
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_stream_paired_rename():
+    sam = io.BytesIO(
+        b"a\t141\t*\t0\t0\t*\t*\t0\t0\tAAAA\tIIII\n"  # Mate 2 first
+        b"a\t77\t*\t0\t0\t*\t*\t0\t0\tCCCC\tIIII\n"
+        b"b\t77\t*\t0\t0\t*\t*\t0\t0\tGGGG\tIIII\n"
+        b"b\t141\t*\t0\t0\t*\t*\t0\t0\tTTTT\tIIII\n"
+    )
+    out_dir.mkdir(exist_ok=True, parents=True)
+    paths = [str(out_dir / "r1.fastq"), str(out_dir / "r2.fastq")]
+    fastq_out = stream.FastqOutput(paths, paired=True, compression="none", rename=True)
+    stream.sam_to_fastq(sam, fastq_out)
+    r1, r2 = (Path(path).read_text().splitlines() for path in paths)
+    assert r1[0::4] == ["@1 /1", "@2 /1"] and r1[1::4] == ["CCCC", "GGGG"]
+    assert r2[0::4] == ["@1 /2", "@2 /2"] and r2[1::4] == ["AAAA", "TTTT"]
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_stream_reorder_window():
+    out_dir.mkdir(exist_ok=True, parents=True)
+    fastq = out_dir / "reads.fastq"
+    fastq.write_bytes(b"".join(b"@r%d/1\nACGT\n+\nIIII\n" % i for i in range(6)))
+    numbered = io.BytesIO()
+    stream.number([fastq], numbered)
+    names = [line[1:] for line in numbered.getvalue().splitlines()[0::4]]
+    assert names[:2] == [b"0|r0", b"1|r1"]
+    order = [2, 0, 1, 5, 3, 4]  # Shuffled as by a multithreaded aligner
+    sam = io.BytesIO(
+        b"@HD\tVN:1.6\n"
+        + b"".join(
+            b"%b\t%d\t*\t0\t0\t*\t*\t0\t0\tACGT\tIIII\n"
+            % (names[i], 0 if i == 3 else 4)
+            for i in order
+        )
+    )
+    out = io.BytesIO()
+    count_paths = (str(out_dir / "in.txt"), str(out_dir / "out.txt"))
+    stream.filter_sam(sam, False, count_paths, sam_out=out, reorder_window=4)
+    qnames = [line.split(b"\t")[0] for line in out.getvalue().splitlines()]
+    assert qnames == [b"r0", b"r1", b"r2", b"r4", b"r5"]
+    assert util.parse_count_file(Path(count_paths[1])) == 5
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_prefilter_screen():
+    out_dir.mkdir(exist_ok=True, parents=True)
+    filter_path = out_dir / "sars-cov-2.bloom"
+    with prefilter.open_fasta(data_dir / "sars-cov-2/sars-cov-2.fasta.gz") as fh:
+        prefilter.build(fh, filter_path, size_bits=20)
+    kmer_filter = prefilter.KmerFilter.load(filter_path)
+    with stream.open_input(data_dir / "sars-cov-2_100_1.fastq.gz") as fh:
+        host_seqs = [seq for _, seq, _ in stream.read_fastq(fh)]
+    with stream.open_input(data_dir / "tuberculosis_2.fastq") as fh:
+        other_seqs = [seq for _, seq, _ in stream.read_fastq(fh)]
+    assert sum(not kmer_filter.is_host_free(seq) for seq in host_seqs) >= 45
+    assert all(kmer_filter.is_host_free(seq) for seq in other_seqs)
+    assert not kmer_filter.is_host_free(b"ACGT")  # Too short to screen
+    fastq = out_dir / "mix.fastq"  # Several batches of host and other reads
+    fastq.write_bytes(
+        b"".join(
+            b"@r%d\n%b\n+\n%b\n" % (i, seq, b"I" * len(seq))
+            for i, seq in enumerate((host_seqs + other_seqs) * 40)
+        )
+    )
+    outputs = []
+    for processes in (1, 2):
+        out, bypass_path = io.BytesIO(), out_dir / f"bypass{processes}.fastq"
+        stream.screen([fastq], out, filter_path, bypass_path, processes=processes)
+        outputs.append((out.getvalue(), bypass_path.read_bytes()))
+    assert outputs[0] == outputs[1] and all(outputs[0])
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_stream_filter_bypass_keeps_mates_together(tmp_path):
+    n_pairs = 2000
+    bypass_path = tmp_path / "bypass.fastq"
+    bypass_path.write_bytes(
+        b"".join(
+            b"@b%d\nACGT\n+\nIIII\n@b%d\nTTTT\n+\nIIII\n" % (i, i)
+            for i in range(n_pairs)
+        )
+    )
+    sam = io.BytesIO(
+        b"@HD\tVN:1.6\n"
+        + b"".join(
+            b"a%d\t77\t*\t0\t0\t*\t*\t0\t0\tACGT\tIIII\n"
+            b"a%d\t141\t*\t0\t0\t*\t*\t0\t0\tTTTT\tIIII\n" % (i, i)
+            for i in range(n_pairs)
+        )
+    )
+    out_paths = [str(tmp_path / "out_1.fastq"), str(tmp_path / "out_2.fastq")]
+    fastq_out = stream.FastqOutput(out_paths, paired=True, compression="none")
+    count_paths = (str(tmp_path / "in.txt"), str(tmp_path / "out.txt"))
+    stream.filter_sam(
+        sam, True, count_paths, fastq_out=fastq_out, bypass_path=bypass_path
+    )
+    names = []
+    for path in out_paths:
+        with open(path, "rb") as fh:
+            names.append([name for name, _, _ in stream.read_fastq(fh)])
+    assert len(names[0]) == 2 * n_pairs
+    assert names[0] == names[1]
+    assert util.parse_count_file(Path(count_paths[1])) == 4 * n_pairs
+
+
+def test_stream_stage_timings():
+    out_dir.mkdir(exist_ok=True, parents=True)
+    timings_path = out_dir / "sample.timings.jsonl"
+    run(
+        f"echo ACGT | python -m hostile.stream time --label align"
+        f" --out {timings_path} -- cat > /dev/null"
+    )
+    stream.write_timing(timings_path, stage="align", bytes_out=5)
+    timings = util.parse_timings_file(timings_path)
+    assert set(timings["align"]) == {"wall_s", "cpu_s", "peak_rss_mb", "bytes_out"}
+    with pytest.raises(subprocess.CalledProcessError):
+        run(f"python -m hostile.stream time --label x --out {timings_path} -- false")
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_run_bash_stderr_tail():
+    cmd = (
+        "echo '[M::main] Peak RSS: 0.1 GB' >&2;"
+        " for i in $(seq 1000); do echo line $i >&2; done; exit 3"
+    )
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        util.run_bash(cmd, tail_lines=10)
+    lines = e.value.stderr.splitlines()
+    assert lines[0].endswith("Peak RSS: 0.1 GB") and lines[-1] == "line 1000"
+    assert len(lines) == 11 and e.value.returncode == 3
+
+
+def test_run_bash_progress(tmp_path):
+    reported = []
+    fastq = tmp_path / "reads.fastq"
+    fastq.write_text("@r\nACGT\n+\nIIII\n" * 100)
+    on_progress = lib.track_progress(reported.append, [fastq], paired=True)
+    util.run_bash(
+        f"echo '{stream.PROGRESS_PREFIX}50' >&2; echo '{stream.PROGRESS_PREFIX}200' >&2",
+        on_progress=functools.partial(on_progress, 0),
+    )
+    assert [p.reads for p in reported] == [50, 200]
+    assert reported[-1].reads_total == 200 and reported[-1].bases == 800
+    reported.clear()  # Interleaved fastq1 already counts both mates
+    on_progress = lib.track_progress(
+        reported.append, [fastq], paired=True, interleaved=[True]
+    )
+    on_progress(0, 50)
+    assert reported[-1].reads_total == 100
+
+
+def test_stream_shard_and_concat(tmp_path):
+    fastq = tmp_path / "reads.fastq"
+    fastq.write_bytes(b"".join(b"@r%d\nACGT\n+\nIIII\n" % i for i in range(10)))
+    fifos = [tmp_path / f"{i}.fifo" for i in range(2)]
+    for fifo in fifos:
+        os.mkfifo(fifo)
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        parts = [executor.submit(Path(fifo).read_bytes) for fifo in fifos]
+        stream.shard([fastq], fifos, chunk_size=20)  # One record per chunk
+        parts = [part.result() for part in parts]
+    assert all(parts)
+    assert sorted(b"".join(parts).splitlines()) == sorted(
+        fastq.read_bytes().splitlines()
+    )
+    paths = [tmp_path / f"part{i}.fastq.gz" for i in range(2)]
+    for path, part in zip(paths, parts):
+        with compress.open_writer(path, "bgzf") as writer:
+            writer.write(part)
+    stream.concat(paths, tmp_path / "out.fastq.gz")
+    data = (tmp_path / "out.fastq.gz").read_bytes()
+    assert gzip.decompress(data) == b"".join(parts)
+    assert data.count(compress.BGZF_EOF) == 1 and not paths[1].exists()
+
+
+def test_bam_output_round_trip(tmp_path):
+    bam_path = tmp_path / "reads.bam"
+    out = stream.open_output([str(bam_path)], paired=True, output_format="bam")
+    out.write(b"r1", 99, b"ACGTN", b"IIII#")
+    out.write(b"r1", 147 | 16, b"AACCG", b"ABCDE")  # Aligned to the reverse strand
+    out.write(b"r2", 77, b"GGGG", b"*")
+    out.write(b"r2", 141, b"TT", b"II")
+    out.close()
+    assert bam.detect_format(bam_path) == "bam" and bam.is_paired(bam_path)
+    assert list(stream.read_input([bam_path])) == [
+        (b"r1", [(b"ACGTN", b"IIII#"), (b"CGGTT", b"EDCBA")]),
+        (b"r2", [(b"GGGG", b"*"), (b"TT", b"II")]),
+    ]
+    assert util.fastq_path_to_stem(bam_path) == "reads"
+    assert util.estimate_fastq_reads(bam_path)[0] >= 1
+
+
+def test_stream_stdin_stdout_interleaved(tmp_path):
+    reads = b"".join(
+        b"@r%d/%d\nACGT\n+\nIIII\n" % (i // 2, i % 2 + 1) for i in range(6)
+    )
+    run = subprocess.run(
+        [sys.executable, "-m", "hostile.stream", "cat", "--interleaved", "-"],
+        input=gzip.compress(reads),
+        capture_output=True,
+        check=True,
+    )
+    assert run.stdout == reads.replace(b"/1", b"").replace(b"/2", b"")
+    assert util.fastq_path_to_stem("-") == f"stdin-{os.getpid()}"
+    fastq = tmp_path / "reads.fastq"
+    fastq.write_bytes(reads)
+    with pytest.raises(ValueError):
+        lib.clean_fastqs([fastq, fastq], out_dir=tmp_path, stdout=True)
+
+
+def test_interleaved_input(tmp_path):
+    fastq = tmp_path / "reads.fastq"
+    fastq.write_bytes(
+        b"@a/1\nAC\n+\nII\n@a/2\nGT\n+\nII\n@b/1\nAA\n+\nII\n@c/2\nTT\n+\nII\n"
+    )
+    reads = stream.read_input([fastq], interleaved=True)
+    assert next(reads) == (b"a", [(b"AC", b"II"), (b"GT", b"II")])
+    with pytest.raises(ValueError):
+        next(reads)
+    odd = tmp_path / "odd.fastq"
+    odd.write_bytes(b"@a/1\nAC\n+\nII\n@a/2\nGT\n+\nII\n@b/1\nAA\n+\nII\n")
+    with pytest.raises(ValueError):
+        list(stream.read_input([odd], interleaved=True))
+    fastq1, fastq2 = tmp_path / "reads_1.fastq", tmp_path / "reads_2.fastq"
+    fastq1.write_bytes(b"@a/1\nAC\n+\nII\n@b/1\nAA\n+\nII\n")
+    fastq2.write_bytes(b"@a/2\nGT\n+\nII\n")
+    with pytest.raises(ValueError):  # Shorter fastq2
+        list(stream.read_input([fastq1, fastq2]))
+    fastq2.write_bytes(b"@a/2\nGT\n+\nII\n@c/2\nTT\n+\nII\n")
+    with pytest.raises(ValueError):  # Mismatched names
+        list(stream.read_input([fastq1, fastq2]))
+    samplesheet = tmp_path / "samples.csv"
+    samplesheet.write_text(
+        "fastq1,fastq2,interleaved\nreads.fastq,,true\nreads.fastq,,\n"
+    )
+    assert lib.parse_samplesheet(samplesheet) == ([fastq], [(fastq, None)])
+
+
+def test_server_status_and_errors(tmp_path):
+    job_server = server.make_server(port=0, concurrency=2, threads=1)
+    threading.Thread(target=job_server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{job_server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(f"{url}/status") as response:
+            assert json.load(response)["concurrency"] == 2
+        headers = {"Content-Type": "application/json"}
+        missing = json.dumps({"fastq1": str(tmp_path / "missing.fastq.gz")}).encode()
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(
+                urllib.request.Request(f"{url}/clean", missing, headers)
+            )
+        assert (
+            e.value.code == 400 and "FileNotFoundError" in json.load(e.value)["error"]
+        )
+        with urllib.request.urlopen(f"{url}/status") as response:
+            assert json.load(response)["failed"] == 1
+        with pytest.raises(urllib.error.HTTPError) as e:  # Form posts are refused
+            urllib.request.urlopen(f"{url}/clean", data=missing)
+        assert e.value.code == 415
+        for job in (
+            {"fastq1": "/data/reads.fastq.gz", "aligner_args": "; touch pwned"},
+            {"fastq1": "/data/reads'; touch pwned; '.fastq.gz"},
+            {"fastq1": "/data/reads.fastq.gz", "compression": "gzip; touch pwned"},
+            {"fastq1": "/data/reads.fastq.gz", "out_dir": f"{tmp_path}/$(touch pwned)"},
+            {"fastq1": "/data/reads.fastq.gz", "out_dir": f'{tmp_path}/"`touch pwned`'},
+        ):
+            with pytest.raises(urllib.error.HTTPError) as e:
+                urllib.request.urlopen(
+                    urllib.request.Request(
+                        f"{url}/clean", json.dumps(job).encode(), headers
+                    )
+                )
+            assert e.value.code == 400
+        assert not list(tmp_path.rglob("pwned"))
+    finally:
+        job_server.shutdown()
+        job_server.server_close()
+
+
+def test_server_clean_job_bowtie2():
+    job_server = server.make_server(port=0)
+    threading.Thread(target=job_server.serve_forever, daemon=True).start()
+    job = {
+        "fastq1": str((data_dir / "sars-cov-2_100_1.fastq.gz").resolve()),
+        "fastq2": str((data_dir / "sars-cov-2_100_2.fastq.gz").resolve()),
+        "index": str((data_dir / "sars-cov-2/sars-cov-2").resolve()),
+        "out_dir": str(out_dir.resolve()),
+        "force": True,
+    }
+    url = f"http://127.0.0.1:{job_server.server_address[1]}/clean"
+    try:
+        request = urllib.request.Request(
+            url, json.dumps(job).encode(), {"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request) as response:
+            stats = json.load(response)
+        assert stats[0]["reads_in"] == 100 and stats[0]["reads_out"] == 6
+    finally:
+        job_server.shutdown()
+        job_server.server_close()
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_pin_and_unpin(tmp_path):
+    index_path = tmp_path / "index.bin"
+    index_path.write_bytes(os.urandom(2**20))
+    state = pin.pin([index_path], tmp_path)
+    try:
+        assert pin.read_state(tmp_path)["paths"] == [str(index_path.resolve())]
+        assert pin.resident_fraction([index_path]) == 1.0
+        (tmp_path / pin.STATE_FILENAME).write_text(
+            json.dumps({**state, "pid": os.getpid()})  # As if the pid were reused
+        )
+        assert pin.read_state(tmp_path) is None
+        (tmp_path / pin.STATE_FILENAME).write_text(json.dumps(state))
+    finally:
+        assert pin.unpin(tmp_path)["pid"] == state["pid"]
+    assert pin.read_state(tmp_path) is None
+
+
+def test_aligner_check_cache(tmp_path):
+    bin_path = tmp_path / "aligner"
+    bin_path.write_text("#!/bin/sh\necho 'aligner 1.0 --interleaved'\n")
+    bin_path.chmod(0o755)
+    aligner = lib.Aligner(
+        name="Bowtie2",
+        short_name="bt2",
+        bin_path=bin_path,
+        cdn_base_url="",
+        data_dir=tmp_path,
+        cmd="",
+        paired_cmd="",
+        flags=("--interleaved", "--mm"),
+    )
+    aligner.check(using_custom_index=True)
+    cached = json.loads(aligner.capabilities_path.read_text())["Bowtie2"]
+    assert cached["version"] == "aligner 1.0 --interleaved"
+    assert cached["flags"] == ["--interleaved"]
+    assert aligner.load_capabilities() == cached
+    bin_path.write_text("#!/bin/sh\necho 'aligner 2.0'\n")  # Upgrade invalidates
+    assert aligner.load_capabilities() is None
+    aligner.check(using_custom_index=True)
+    assert aligner.version == "aligner 2.0"
+    capabilities = aligner.load_capabilities()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        saves = [  # As threads of a server process might
+            executor.submit(
+                aligner.save_capabilities, {**capabilities, "index": {"sr": i}}
+            )
+            for i in range(32)
+        ]
+        for save in saves:
+            save.result()
+    assert json.loads(aligner.capabilities_path.read_text())["Bowtie2"]
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_cli_import_is_light(tmp_path):
+    """Startup must not load download/progress dependencies or touch the data dir"""
+    code = (
+        "import sys, hostile.cli; print(sorted({'httpx', 'tqdm'} & set(sys.modules)))"
+    )
+    env = {**os.environ, "XDG_DATA_HOME": str(tmp_path)}
+    run = subprocess.run(
+        [sys.executable, "-c", code], env=env, capture_output=True, text=True
+    )
+    assert run.returncode == 0, run.stderr
+    assert run.stdout.strip() == "[]"
+    assert not (tmp_path / "hostile").exists()
+
+
+def test_route_reads(tmp_path):
+    def write_fastq(name: str, read_names: list[str], length: int, quality: int):
+        path = tmp_path / f"{name}.fastq"
+        with open(path, "w") as fh:
+            for read_name in read_names:
+                fh.write(
+                    f"@{read_name}\n{'A' * length}\n+\n{chr(33 + quality) * length}\n"
+                )
+        return path
+
+    short = write_fastq("short", [f"r{i}" for i in range(10)], 150, 35)
+    ont = write_fastq("ont", [f"{i}-uuid runid=1" for i in range(10)], 5000, 15)
+    hifi = write_fastq(
+        "hifi", [f"m64011_190830_220126/{i}/ccs" for i in range(10)], 9000, 30
+    )
+    clr = write_fastq(
+        "clr", [f"m54006_190830_220126/{i}/0_9000" for i in range(10)], 9000, 8
+    )
+    assert lib.route_reads(short)["aligner"] == "bowtie2"
+    assert lib.route_reads(short, aligner="minimap2")["preset"] == "map-ont"
+    amplicons = write_fastq("amplicons", [f"{i}-uuid" for i in range(10)], 400, 14)
+    assert lib.route_reads(amplicons)["aligner"] == "minimap2"
+    assert lib.route_reads(amplicons)["preset"] == "map-ont"
+    assert lib.route_reads(
+        short, index=data_dir / "sars-cov-2/sars-cov-2.fasta.gz"
+    ) == {
+        "aligner": "minimap2",
+        "preset": "sr",
+        "reads_sampled": 10,
+        "median_length": 150,
+        "mean_quality": 35.0,
+    }
+    assert lib.route_reads(ont)["preset"] == "map-ont"
+    assert lib.route_reads(hifi)["preset"] == "map-hifi"
+    assert lib.route_reads(clr)["preset"] == "map-pb"
+    assert lib.route_reads(clr, n_sample=3)["reads_sampled"] == 3